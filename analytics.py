@@ -0,0 +1,209 @@
+# analytics.py
+import io
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+import numpy as np
+from sqlalchemy import func
+from models import User, LeaveRequest, LeaveSummary
+from data_versions import validators
+
+# Department analytics on dense arrays instead of per-row Python loops.
+#   busy[t, d, s]     day-based schedule: teacher t is Busy on weekday d, session s + 1
+#   defined[t, d, s]  the cell exists in the teacher's grid
+# Leaves are kept as parallel arrays (teacher index, weekday, session index, substitute index or -1).
+# Archived months only count per teacher, from LeaveSummary: archived[t] = (leaves, covered, covers).
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+CHARTS = ("availability", "leaves")
+
+
+class DepartmentData:
+    def __init__(self, department, teacher_ids, usernames, busy, defined,
+                 leave_teacher, leave_day, leave_session, leave_substitute, archived=None):
+        self.department = department
+        self.teacher_ids = teacher_ids
+        self.usernames = usernames
+        self.busy = busy
+        self.defined = defined
+        self.leave_teacher = leave_teacher
+        self.leave_day = leave_day
+        self.leave_session = leave_session
+        self.leave_substitute = leave_substitute
+        self.archived = archived if archived is not None else np.zeros((len(teacher_ids), 3), dtype=np.int64)
+
+    @classmethod
+    def load(cls, db, store, department, since=None):
+        # One query for the members, one for their grids (via the store), one for the leaves and one
+        # for the archived months
+        members = db.session.query(User.id, User.username).filter(
+            User.department == department, User.role.in_(["Teacher", "HOD"])
+        ).order_by(User.id).all()
+        teacher_ids = np.array([member[0] for member in members], dtype=np.int64)
+        usernames = [member[1] for member in members]
+        position = {teacher_id: i for i, teacher_id in enumerate(teacher_ids.tolist())}
+
+        grids = store.load(teacher_ids.tolist())
+        num_sessions = max(
+            (max(sessions) for grid in grids.values() for sessions in grid.values() if sessions),
+            default=0
+        )
+        busy = np.zeros((len(teacher_ids), len(DAYS), num_sessions), dtype=bool)
+        defined = np.zeros_like(busy)
+        day_index = {day: i for i, day in enumerate(DAYS)}
+        for teacher_id, grid in grids.items():
+            t = position[teacher_id]
+            for day, sessions in grid.items():
+                d = day_index[day]
+                cells = np.fromiter(sessions.keys(), dtype=np.int64, count=len(sessions)) - 1
+                flags = np.fromiter((status == "Busy" for status in sessions.values()), dtype=bool, count=len(sessions))
+                defined[t, d, cells] = True
+                busy[t, d, cells] = flags
+
+        query = db.session.query(
+            LeaveRequest.teacher_id, LeaveRequest.date, LeaveRequest.session, LeaveRequest.substitute_id
+        ).filter(LeaveRequest.teacher_id.in_(teacher_ids.tolist()))
+        if since is not None:
+            query = query.filter(LeaveRequest.date >= since)
+        rows = query.all()
+        leave_teacher = np.array([position[row[0]] for row in rows], dtype=np.int64)
+        leave_day = np.array([row[1].weekday() for row in rows], dtype=np.int64)
+        leave_session = np.array([row[2] - 1 for row in rows], dtype=np.int64)
+        # Substitutes outside the department (or removed since) count as -1
+        leave_substitute = np.array([position.get(row[3], -1) for row in rows], dtype=np.int64)
+
+        archived = np.zeros((len(teacher_ids), 3), dtype=np.int64)
+        query = db.session.query(
+            LeaveSummary.teacher_id, func.sum(LeaveSummary.leaves), func.sum(LeaveSummary.covered),
+            func.sum(LeaveSummary.covers)
+        ).filter(LeaveSummary.teacher_id.in_(teacher_ids.tolist()))
+        if since is not None:
+            # Whole months only: a month is counted when it starts on or after since
+            query = query.filter(LeaveSummary.month >= since)
+        for teacher_id, leaves, covered, covers in query.group_by(LeaveSummary.teacher_id):
+            archived[position[teacher_id]] = (leaves, covered, covers)
+        return cls(department, teacher_ids, usernames, busy, defined,
+                   leave_teacher, leave_day, leave_session, leave_substitute, archived)
+
+    @property
+    def num_sessions(self):
+        return self.busy.shape[2]
+
+    def utilisation(self):
+        # Share of each teacher's scheduled cells that are Busy
+        scheduled = self.defined.sum(axis=(1, 2))
+        return np.divide(self.busy.sum(axis=(1, 2)), scheduled, out=np.zeros(len(scheduled)), where=scheduled > 0)
+
+    def free_capacity(self):
+        # Free teachers per (weekday, session): the pool substitutes are drawn from
+        return (self.defined & ~self.busy).sum(axis=0)
+
+    def leave_frequency(self):
+        # Leaves per teacher (archived months included), and per (weekday, session) (LeaveRequest only)
+        per_teacher = np.bincount(self.leave_teacher, minlength=len(self.teacher_ids)) + self.archived[:, 0]
+        per_slot = np.zeros((len(DAYS), max(self.num_sessions, 1)), dtype=np.int64)
+        inside = self.leave_session < per_slot.shape[1]
+        np.add.at(per_slot, (self.leave_day[inside], self.leave_session[inside]), 1)
+        return per_teacher, per_slot
+
+    def substitute_load(self):
+        # Covers taken by each teacher
+        covered = self.leave_substitute[self.leave_substitute >= 0]
+        return np.bincount(covered, minlength=len(self.teacher_ids)) + self.archived[:, 2]
+
+    def leave_count(self):
+        return int(len(self.leave_teacher) + self.archived[:, 0].sum())
+
+    def coverage_rate(self):
+        if not self.leave_count():
+            return 1.0
+        covered = (self.leave_substitute >= 0).sum() + self.archived[:, 1].sum()
+        return float(covered / self.leave_count())
+
+    def summary(self):
+        per_teacher, _ = self.leave_frequency()
+        load = self.substitute_load()
+        utilisation = self.utilisation()
+        return {
+            'teachers': [
+                {
+                    'id': int(teacher_id),
+                    'username': username,
+                    'utilisation': round(float(utilisation[i]), 3),
+                    'leaves': int(per_teacher[i]),
+                    'covers': int(load[i]),
+                }
+                for i, (teacher_id, username) in enumerate(zip(self.teacher_ids.tolist(), self.usernames))
+            ],
+            'free_capacity': self.free_capacity().tolist(),
+            'leaves': self.leave_count(),
+            'coverage_rate': round(self.coverage_rate(), 3),
+        }
+
+
+def render_chart(data, chart):
+    # PNG bytes for one chart; matplotlib is imported here so the rest of the app does not pay for it
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(8, 4.5), dpi=100)
+    axes = figure.subplots()
+    if chart == "availability":
+        capacity = data.free_capacity()
+        image = axes.imshow(capacity, aspect="auto", cmap="YlGn")
+        axes.set_yticks(range(len(DAYS)), DAYS)
+        axes.set_xticks(range(data.num_sessions), [str(s + 1) for s in range(data.num_sessions)])
+        axes.set_xlabel("Session")
+        axes.set_title(f"Free teachers per session - {data.department}")
+        figure.colorbar(image, ax=axes)
+    elif chart == "leaves":
+        per_teacher, _ = data.leave_frequency()
+        load = data.substitute_load()
+        positions = np.arange(len(data.teacher_ids))
+        axes.bar(positions - 0.2, per_teacher, width=0.4, label="Leaves")
+        axes.bar(positions + 0.2, load, width=0.4, label="Covers")
+        axes.set_xticks(positions, data.usernames, rotation=60, ha="right", fontsize=7)
+        axes.set_title(f"Leaves and substitute load - {data.department}")
+        axes.legend()
+    else:
+        raise ValueError(f"Unknown chart: {chart}")
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+class ChartCache:
+    # Rendered PNGs keyed by (department, chart, data version); see data_version. Every worker computes
+    # the same version from the database, so a worker only renders a chart it has not cached yet.
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, department, chart, version, render):
+        key = (department, chart, version)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                return image
+        image = render()
+        with self._lock:
+            self._images[key] = image
+            while len(self._images) > self.max_entries:
+                self._images.popitem(last=False)
+        return image
+
+
+def data_version(db, department, since=None):
+    # Version of the department's analytics from the persisted DataVersion rows of its members (every
+    # schedule or leave change bumps them), plus the leave window start, which moves daily
+    member_ids = [row[0] for row in db.session.query(User.id).filter(User.department == department)]
+    etag, _ = validators(db, member_ids)
+    return f"{etag}-{since or 'all'}"
+
+
+def leave_window_start(days):
+    return date.today() - timedelta(days=days) if days else None
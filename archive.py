@@ -0,0 +1,187 @@
+# archive.py
+import json
+import zlib
+from collections import namedtuple, defaultdict
+from datetime import date, timedelta
+from sqlalchemy import select, insert, delete
+from sqlalchemy.orm import aliased
+from models import User, Timetable, LeaveRequest, LeaveSummary, ArchivedLeaves, ArchivedOverrides
+from ranking import covers_changed
+from signals import schedule_touched
+
+# Hot/cold split of the date-specific history. Leaves and date-specific Timetable rows dated before
+# the archive cutoff (the first of the month ARCHIVE_AFTER_DAYS ago) move out of the hot tables into
+# the archive bind, as one compressed row per teacher and month. Each archived month also has
+# LeaveSummary rows in the main database for analytics. /report and its export read both sides. The
+# calendar, the iCalendar feed and substitute ranking only see hot rows.
+#
+# A batch is written to the archive and committed before its hot rows are deleted. Months are merged
+# by (date, session), so a batch interrupted between the two commits is archived again on the next run.
+
+LeaveRow = namedtuple('LeaveRow', ['id', 'date', 'session', 'teacher', 'substitute'])
+
+
+def month_of(day):
+    return day.replace(day=1)
+
+
+def archive_cutoff(days, today=None):
+    # First day of the month `days` ago; everything dated before it is archived
+    return month_of((today or date.today()) - timedelta(days=days))
+
+
+def pack(rows):
+    return zlib.compress(json.dumps(rows, separators=(",", ":")).encode())
+
+
+def unpack(data):
+    return json.loads(zlib.decompress(data))
+
+
+def _merge(db, model, months, count_column, extra=None):
+    # Merge {(teacher_id, month): rows} into the model's archive rows. Rows are keyed by (day, session),
+    # and a new row replaces an archived one for the same slot.
+    key = (1, 2) if model is ArchivedLeaves else (0, 1)
+    teacher_ids = sorted({teacher_id for teacher_id, _ in months})
+    existing = {
+        (row.teacher_id, row.month): row
+        for row in db.session.execute(
+            select(model).where(model.teacher_id.in_(teacher_ids),
+                                model.month.in_(sorted({month for _, month in months})))
+        ).scalars()
+    }
+    for (teacher_id, month), rows in months.items():
+        archived = existing.get((teacher_id, month))
+        merged = {(row[key[0]], row[key[1]]): row for row in unpack(archived.rows)} if archived else {}
+        merged.update(((row[key[0]], row[key[1]]), row) for row in rows)
+        merged = [merged[slot] for slot in sorted(merged)]
+        if archived:
+            archived.rows = pack(merged)
+            setattr(archived, count_column, len(merged))
+        else:
+            db.session.add(model(teacher_id=teacher_id, month=month, rows=pack(merged),
+                                 **{count_column: len(merged)}, **(extra(teacher_id) if extra else {})))
+
+
+def _rebuild_summaries(db, months):
+    # Recount the LeaveSummary rows of the given months from the whole archive of those months
+    counts = defaultdict(lambda: [0, 0, 0])  # (teacher_id, month) -> [leaves, covered, covers]
+    for teacher_id, month, data in db.session.execute(
+        select(ArchivedLeaves.teacher_id, ArchivedLeaves.month, ArchivedLeaves.rows)
+        .where(ArchivedLeaves.month.in_(sorted(months)))
+    ):
+        for _, _, _, substitute_id, _ in unpack(data):
+            counts[(teacher_id, month)][0] += 1
+            if substitute_id is not None:
+                counts[(teacher_id, month)][1] += 1
+                counts[(substitute_id, month)][2] += 1
+    # Removed teachers keep their archived leaves but have no summary
+    users = {row[0] for row in db.session.execute(
+        select(User.id).where(User.id.in_(sorted({teacher_id for teacher_id, _ in counts})))
+    )}
+    db.session.execute(delete(LeaveSummary).where(LeaveSummary.month.in_(sorted(months))))
+    rows = [
+        {'teacher_id': teacher_id, 'month': month, 'leaves': leaves, 'covered': covered, 'covers': covers}
+        for (teacher_id, month), (leaves, covered, covers) in sorted(counts.items()) if teacher_id in users
+    ]
+    if rows:
+        db.session.execute(insert(LeaveSummary), rows)
+
+
+def _delete_ids(db, model, ids, chunk_size=500):
+    for i in range(0, len(ids), chunk_size):
+        db.session.execute(delete(model).where(model.id.in_(ids[i:i + chunk_size])))
+
+
+def _archive_batch(db, teachers, cutoff):
+    # teachers: {teacher_id: (username, department)}. Returns (leaves, overrides) archived.
+    teacher_ids = sorted(teachers)
+    substitute = aliased(User)
+    leaves = db.session.execute(
+        select(LeaveRequest.id, LeaveRequest.teacher_id, LeaveRequest.date, LeaveRequest.session,
+               LeaveRequest.substitute_id, substitute.username)
+        .outerjoin(substitute, LeaveRequest.substitute_id == substitute.id)
+        .where(LeaveRequest.teacher_id.in_(teacher_ids), LeaveRequest.date < cutoff)
+    ).all()
+    overrides = db.session.execute(
+        select(Timetable.id, Timetable.teacher_id, Timetable.date, Timetable.session, Timetable.status,
+               Timetable.substitute_id)
+        .where(Timetable.teacher_id.in_(teacher_ids), Timetable.date < cutoff)
+    ).all()
+    if not leaves and not overrides:
+        return 0, 0
+
+    leave_months = defaultdict(list)
+    for leave_id, teacher_id, leave_date, session, substitute_id, substitute_name in leaves:
+        leave_months[(teacher_id, month_of(leave_date))].append(
+            [leave_id, leave_date.day, session, substitute_id, substitute_name]
+        )
+    override_months = defaultdict(list)
+    for _, teacher_id, override_date, session, status, substitute_id in overrides:
+        override_months[(teacher_id, month_of(override_date))].append(
+            [override_date.day, session, status, substitute_id]
+        )
+    _merge(db, ArchivedLeaves, leave_months, 'leaves',
+           extra=lambda teacher_id: {'teacher': teachers[teacher_id][0], 'department': teachers[teacher_id][1]})
+    _merge(db, ArchivedOverrides, override_months, 'overrides')
+    db.session.commit()  # The archive holds the batch before anything leaves the hot tables
+
+    # The deletes below bypass the ORM, so the substitutes' counters are adjusted here
+    covers_changed(db.session, [
+        (substitute_id, leave_date, -1) for _, _, leave_date, _, substitute_id, _ in leaves if substitute_id
+    ])
+    _delete_ids(db, LeaveRequest, [row[0] for row in leaves])
+    _delete_ids(db, Timetable, [row[0] for row in overrides])
+    if leave_months:
+        _rebuild_summaries(db, {month for _, month in leave_months})
+    # Substitutes appear in the absent teachers' leaves; both calendars lose the archived dates
+    schedule_touched(db.session, {row[1] for row in overrides} | {row[1] for row in leaves}
+                     | {row[4] for row in leaves if row[4]})
+    db.session.commit()
+    return len(leaves), len(overrides)
+
+
+def archive(db, cutoff, batch_size=200):
+    # Archive every leave and date-specific row dated before cutoff (a first of the month),
+    # batch_size teachers at a time. Returns (leaves, overrides) archived.
+    teachers = db.session.execute(select(User.id, User.username, User.department).order_by(User.id)).all()
+    total_leaves = total_overrides = 0
+    for i in range(0, len(teachers), batch_size):
+        batch = {teacher_id: (username, department) for teacher_id, username, department in teachers[i:i + batch_size]}
+        leaves, overrides = _archive_batch(db, batch, cutoff)
+        total_leaves += leaves
+        total_overrides += overrides
+    return total_leaves, total_overrides
+
+
+def archived_leaves(db, department, start_date=None, end_date=None, teacher_id=None, before=None, batch_size=100):
+    # LeaveRows of the department's archived leaves, newest first by (date, id), optionally only those
+    # before the (date, id) keyset position. Months are read newest first and unpacked one at a time.
+    statement = (
+        select(ArchivedLeaves.month, ArchivedLeaves.teacher, ArchivedLeaves.rows)
+        .where(ArchivedLeaves.department == department)
+    )
+    if start_date:
+        statement = statement.where(ArchivedLeaves.month >= month_of(start_date))
+    if end_date:
+        statement = statement.where(ArchivedLeaves.month <= end_date)
+    if before:
+        statement = statement.where(ArchivedLeaves.month <= before[0])
+    if teacher_id:
+        statement = statement.where(ArchivedLeaves.teacher_id == teacher_id)
+    result = db.session.execute(statement.order_by(ArchivedLeaves.month.desc()).execution_options(yield_per=batch_size))
+    try:
+        current, rows = None, []
+        for month, teacher, data in result:
+            if month != current:
+                yield from sorted(rows, key=lambda row: (row.date, row.id), reverse=True)
+                current, rows = month, []
+            for leave_id, day, session, _, substitute in unpack(data):
+                leave_date = month.replace(day=day)
+                if ((start_date and leave_date < start_date) or (end_date and leave_date > end_date)
+                        or (before and (leave_date, leave_id) >= before)):
+                    continue
+                rows.append(LeaveRow(leave_id, leave_date, session, teacher, substitute))
+        yield from sorted(rows, key=lambda row: (row.date, row.id), reverse=True)
+    finally:
+        result.close()
@@ -0,0 +1,122 @@
+# auth.py
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask_login import UserMixin
+from werkzeug.security import generate_password_hash, check_password_hash
+from instrumentation import timed
+
+
+class SessionUser(UserMixin):
+    # Read-only snapshot of a User for current_user; carries only what routes and templates read
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.role = user.role
+        self.department = user.department
+        self.feed_version = user.feed_version
+
+
+class UserCache:
+    # Flask-Login identity cache: user id -> (SessionUser, expiry), LRU-bounded.
+    # Entries are dropped when user_changed fires (removal, password reset); the TTL bounds how long
+    # another worker process can keep serving a removed user.
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, user_id, fetch):
+        # fetch(user_id) -> User or None, called on a miss
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                return entry[0]
+        user = fetch(user_id)
+        if user is None:
+            return None
+        snapshot = SessionUser(user)
+        with self._lock:
+            self._entries[user_id] = (snapshot, now + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def on_user_changed(self, sender, user_ids=()):
+        self.invalidate(user_ids)
+
+
+class LoginOverloaded(Exception):
+    # More password checks are queued than the pool accepts; the caller should answer 503
+    pass
+
+
+class PasswordHasher:
+    # Admission control for password hashing and checks, not offloading: the request thread still waits
+    # for its hash, so a worker stays busy for as long as the hash takes. What the pool adds is a bound.
+    # At most `workers` hashes run at once (they release the GIL, so that many cores), at most
+    # workers + queue_size requests wait for one, and the rest fail fast with LoginOverloaded instead of
+    # tying up every request thread behind a backlog of slow hashes.
+    def __init__(self, method=None, workers=None, queue_size=None, timeout=10):
+        self.method = method  # Werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = self.workers * 4 if queue_size is None else queue_size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._prefix = None
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password")
+            return self._executor
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise LoginOverloaded()
+        try:
+            future = self._pool().submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is held until the hash finishes, even if this request stops waiting for it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise LoginOverloaded()
+
+    def generate(self, password):
+        # Hash with the configured method (inline: used on the rarer write paths)
+        if self.method:
+            return generate_password_hash(password, self.method)
+        return generate_password_hash(password)
+
+    @timed('password.check')
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    @timed('password.hash')
+    def rehash(self, password):
+        return self._run(self.generate, password)
+
+    def needs_rehash(self, password_hash):
+        # True when the stored hash was made with other parameters than the configured method
+        if self._prefix is None:
+            # Werkzeug fills in default parameters, so take the prefix from a real hash once
+            self._prefix = self.generate("").split("$", 1)[0]
+        return password_hash.split("$", 1)[0] != self._prefix
@@ -0,0 +1,102 @@
+# availability.py
+from sqlalchemy import select, union_all, literal
+from models import Timetable, User, LeaveRequest
+
+# Upper bound on sessions per day (matches the limit enforced by generate_timetable)
+MAX_SESSIONS = 24
+ALL_SESSIONS = (1 << MAX_SESSIONS) - 1
+
+
+def session_bit(session):
+    # Sessions are 1-based; session 1 lives in bit 0
+    return 1 << (session - 1)
+
+
+def availability_query(department, date, store):
+    # Day-based schedules, date-specific overrides and leaves of a department for one date in one round trip
+    day_rows = store.department_day_query(department, date.strftime('%A'))
+    date_rows = (
+        select(Timetable.teacher_id, Timetable.session, Timetable.status, literal('date').label('kind'))
+        .join(User, Timetable.teacher_id == User.id)
+        .where(User.department == department, Timetable.date == date)
+    )
+    leave_rows = (
+        select(LeaveRequest.teacher_id, LeaveRequest.session, literal('On Leave'), literal('leave').label('kind'))
+        .join(User, LeaveRequest.teacher_id == User.id)
+        .where(User.department == department, LeaveRequest.date == date)
+    )
+    return union_all(day_rows, date_rows, leave_rows)
+
+
+class AvailabilityIndex:
+    # Free/busy bitmasks for every teacher of a department on one specific date.
+    # Bit (session - 1) of free_masks[teacher_id] is set when the teacher is free in that session.
+    def __init__(self, department, date, teacher_ids, free_masks):
+        self.department = department
+        self.date = date
+        self.day = date.strftime('%A')
+        self.teacher_ids = teacher_ids  # Department members in database order
+        self.free_masks = free_masks
+
+    @classmethod
+    def build(cls, db, department, date, store):
+        # Department members eligible to substitute
+        teacher_ids = [row[0] for row in db.session.execute(
+            select(User.id)
+            .where(User.role.in_(["Teacher", "HOD"]), User.department == department)
+            .order_by(User.id)
+        )]
+
+        day_busy, date_busy, date_set, on_leave = {}, {}, {}, {}
+        for teacher_id, session, status, kind in db.session.execute(availability_query(department, date, store)):
+            if kind == 'mask':
+                # Packed layout: the whole day's busy sessions in one bitmask
+                day_busy[teacher_id] = day_busy.get(teacher_id, 0) | (session & ALL_SESSIONS)
+                continue
+            if session < 1 or session > MAX_SESSIONS:
+                continue
+            bit = session_bit(session)
+            if kind == 'day':
+                if status == "Busy":
+                    day_busy[teacher_id] = day_busy.get(teacher_id, 0) | bit
+            elif kind == 'date':
+                date_set[teacher_id] = date_set.get(teacher_id, 0) | bit
+                if status == "Busy":
+                    date_busy[teacher_id] = date_busy.get(teacher_id, 0) | bit
+            else:
+                on_leave[teacher_id] = on_leave.get(teacher_id, 0) | bit
+
+        # Same precedence as get_timetable: date-specific > leave requests > day-based
+        free_masks = {}
+        for teacher_id in teacher_ids:
+            overridden = date_set.get(teacher_id, 0)
+            leave = on_leave.get(teacher_id, 0) & ~overridden
+            busy = (
+                date_busy.get(teacher_id, 0)
+                | leave
+                | (day_busy.get(teacher_id, 0) & ~overridden & ~leave)
+            )
+            free_masks[teacher_id] = ALL_SESSIONS & ~busy
+
+        return cls(department, date, teacher_ids, free_masks)
+
+    def is_free(self, teacher_id, session):
+        return bool(self.free_masks.get(teacher_id, 0) & session_bit(session))
+
+    def free_teachers(self, session):
+        # Set of teachers free in the given session
+        bit = session_bit(session)
+        return {teacher_id for teacher_id, mask in self.free_masks.items() if mask & bit}
+
+    def find_free(self, session, exclude=()):
+        # First free teacher in database order, intersecting the free set with the candidates
+        candidates = self.free_teachers(session).difference(exclude)
+        for teacher_id in self.teacher_ids:
+            if teacher_id in candidates:
+                return teacher_id
+        return None
+
+    def mark_busy(self, teacher_id, session):
+        # Keep the index consistent after booking a teacher as a substitute
+        if teacher_id in self.free_masks:
+            self.free_masks[teacher_id] &= ~session_bit(session)
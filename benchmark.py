@@ -0,0 +1,443 @@
+# benchmark.py
+# Times TimetableLogic and the main routes against synthetic data and compares runs.
+#   python benchmark.py --departments 4 --teachers 100 --save instance/benchmark_baseline.json
+#   python benchmark.py --departments 4 --teachers 100 --compare instance/benchmark_baseline.json
+#   python benchmark.py --startup 10   (worker cold start and fork after preload)
+#   python benchmark.py --departments 8 --teachers 80 --generate 8   (batch generation speedup by workers)
+#   python benchmark.py --import 10000 --hash-method pbkdf2:sha256:1000   (roster import time)
+#   python benchmark.py --archive-before 2025-10-01 --compare ...   (the same run with older history archived)
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class QueryCounter:
+    # Counts SQL statements sent to the engines
+    def __init__(self, *engines):
+        from sqlalchemy import event
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def measure(name, iterations, operation, counter, results):
+    latencies, queries = [], []
+    for i in range(iterations):
+        before = counter.count
+        started = time.perf_counter()
+        operation(i)
+        latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(counter.count - before)
+    record(name, latencies, queries, results)
+
+
+def record(name, latencies, queries, results):
+    results[name] = {
+        'n': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p90_ms': round(percentile(latencies, 0.90), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'queries_mean': round(sum(queries) / len(queries), 2),
+        'queries_max': max(queries),
+    }
+    print(f"{name:<20} p50 {results[name]['p50_ms']:>9.2f} ms  p90 {results[name]['p90_ms']:>9.2f} ms  "
+          f"p99 {results[name]['p99_ms']:>9.2f} ms  queries {results[name]['queries_mean']:>7.1f}")
+
+
+def prepare(args):
+    # flask_app keeps its SQLite file under <cwd>/instance, so run inside a scratch directory
+    workdir = args.workdir or tempfile.mkdtemp(prefix="timetable-bench-")
+    os.makedirs(os.path.join(workdir, 'instance'), exist_ok=True)
+    database = os.path.join(workdir, 'instance', 'timetable.db')
+    if os.path.exists(database):
+        os.remove(database)
+    os.chdir(workdir)
+    os.environ['TIMETABLE_STORAGE'] = args.storage
+    sys.path.insert(0, REPO_DIR)
+    return workdir
+
+
+def run(args):
+    workdir = prepare(args)
+
+    from flask_app import create_app, services, db
+    from migrations import init_database
+    from models import User, Timetable, LeaveRequest
+    from synthetic_data import generate
+
+    app = create_app({'MAIL_OUTBOX_ENABLED': False})
+    timetable_logic = services(app).timetable_logic
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        init_database(db, log=lambda message: None)
+        started = time.perf_counter()
+        summary = generate(db, timetable_logic.store, args.departments, args.teachers, year=args.year, seed=args.seed)
+        print(f"Generated {summary['users']} users, {summary['leaves']} leaves in {time.perf_counter() - started:.1f}s")
+        if args.archive_before:
+            from archive import archive, month_of
+            started = time.perf_counter()
+            leaves, overrides = archive(db, month_of(args.archive_before))
+            print(f"Archived {leaves} leaves, {overrides} date-specific rows in {time.perf_counter() - started:.1f}s")
+        teachers = [(user.id, user.department) for user in User.query.filter_by(role="Teacher")]
+        hods = [user.id for user in User.query.filter_by(role="HOD")]
+        counter = QueryCounter(*db.engines.values())
+
+    results = {}
+    client = app.test_client()
+
+    def login(user_id):
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+
+    with app.app_context():
+        generated = {}
+
+        def generate_op(i):
+            teacher_id = rng.choice(teachers)[0]
+            generated[i] = timetable_logic.generate_timetable(teacher_id, 5, 5)
+            db.session.rollback()
+
+        measure("generate_timetable", args.iterations, generate_op, counter, results)
+        measure("apply_constraints", args.iterations,
+                lambda i: timetable_logic.apply_constraints(generated[i], None), counter, results)
+
+        # Leaves in the following year never collide with the generated history
+        grids = timetable_logic.store.load([teacher_id for teacher_id, _ in teachers])
+        slots = []
+        first = date(args.year + 1, 1, 1)
+        while len(slots) < args.iterations:
+            teacher_id = rng.choice(teachers)[0]
+            leave_date = first + timedelta(days=rng.randrange(365))
+            busy = [s for s, status in grids.get(teacher_id, {}).get(leave_date.strftime('%A'), {}).items()
+                    if status == "Busy"]
+            if busy and (teacher_id, leave_date) not in {(t, d) for t, d, _ in slots}:
+                slots.append((teacher_id, leave_date, rng.choice(busy)))
+        measure("assign_substitute", args.iterations,
+                lambda i: timetable_logic.assign_substitute(*slots[i]), counter, results)
+
+    def get_timetable_op(i):
+        login(rng.choice(teachers)[0])
+        day = date(args.year, 1, 1) + timedelta(days=rng.randrange(365))
+        client.get(f"/get_timetable?date={day.isoformat()}")
+
+    def report_op(i):
+        login(rng.choice(hods))
+        client.get("/report")
+
+    def dashboard_op(i):
+        login(rng.choice(hods))
+        client.get("/dashboard")
+
+    measure("/get_timetable", args.iterations, get_timetable_op, counter, results)
+    measure("/report", args.iterations, report_op, counter, results)
+    measure("/dashboard", args.iterations, dashboard_op, counter, results)
+
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+# Run in a fresh interpreter: import, create the app and serve one signed-in request
+COLD_START = """
+import json, sys, time
+started = time.perf_counter()
+import flask_app
+imported = time.perf_counter()
+app = flask_app.create_app()
+created = time.perf_counter()
+from benchmark import first_request
+queries = first_request(app, flask_app.db, int(sys.argv[1]), sys.argv[2])
+served = time.perf_counter()
+print(json.dumps([imported - started, created - imported, served - created, queries]))
+"""
+
+
+def first_request(app, db, teacher_id, day):
+    # One signed-in /get_timetable request; returns the number of SQL statements it took
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(teacher_id)
+        session['_fresh'] = True
+    client.get(f"/get_timetable?date={day}")
+    return counter.count
+
+
+def startup(args):
+    # Worker start-up cost: N fresh interpreters (cold start), and N children forked from a process that
+    # has already imported and created the app (gunicorn --preload), each serving its first request.
+    workdir = prepare(args)
+
+    from flask_app import create_app, db
+    from migrations import init_database, upgrade_database
+    from models import User
+    from synthetic_data import generate
+    from timetable_store import make_store
+
+    setup = create_app({'MAIL_OUTBOX_ENABLED': False})
+    with setup.app_context():
+        init_database(db, log=lambda message: None)
+        generate(db, make_store(db, setup.config['TIMETABLE_STORAGE']), args.departments, args.teachers, year=args.year, seed=args.seed)
+        teacher_id = User.query.filter_by(role="Teacher").first().id
+        # What every worker used to pay at boot: the schema check on an up-to-date database
+        counter = QueryCounter(db.engine)
+        checks, check_queries = [], []
+        for _ in range(args.startup):
+            before = counter.count
+            started = time.perf_counter()
+            upgrade_database(db, log=lambda message: None)
+            checks.append((time.perf_counter() - started) * 1000)
+            check_queries.append(counter.count - before)
+        db.engine.dispose()
+    day = date(args.year, 3, 2).isoformat()
+
+    results = {}
+    record("schema check", checks, check_queries, results)
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    imports, creates, firsts, queries, totals = [], [], [], [], []
+    for _ in range(args.startup):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', COLD_START, str(teacher_id), day],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        totals.append((time.perf_counter() - started) * 1000)
+        imported, created, served, count = json.loads(output.strip().splitlines()[-1])
+        imports.append(imported * 1000)
+        creates.append(created * 1000)
+        firsts.append(served * 1000)
+        queries.append(count)
+    record("cold import", imports, [0] * len(imports), results)
+    record("cold create_app", creates, [0] * len(creates), results)
+    record("cold first request", firsts, queries, results)
+    record("cold start total", totals, queries, results)
+
+    if not hasattr(os, 'fork'):
+        print("fork after preload: not available on this platform")
+    else:
+        # Created like a preloading server master: no connection or thread exists when the children fork
+        preloaded = create_app({'MAIL_OUTBOX_ENABLED': False})
+        forks, firsts, queries = [], [], []
+        for _ in range(args.startup):
+            read_end, write_end = os.pipe()
+            started = time.perf_counter()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_end)
+                forked = time.perf_counter()
+                count = first_request(preloaded, db, teacher_id, day)
+                os.write(write_end, json.dumps([forked - started, time.perf_counter() - forked, count]).encode())
+                os._exit(0)
+            os.close(write_end)
+            with os.fdopen(read_end) as pipe:
+                fork_seconds, first_seconds, count = json.loads(pipe.read())
+            os.waitpid(pid, 0)
+            forks.append(fork_seconds * 1000)
+            firsts.append(first_seconds * 1000)
+            queries.append(count)
+        record("fork", forks, [0] * len(forks), results)
+        record("fork first request", firsts, queries, results)
+
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def generation(args):
+    # The same batch generation job (every department, one seed) with 1, 2, 4, ... up to N solver
+    # processes: wall time, speedup over one process, and whether the timetables came out identical.
+    # "solve" times the solves alone on a pool of that size, without writing the results.
+    workdir = prepare(args)
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from flask_app import create_app, services, db
+    from migrations import init_database
+    from models import User
+    from solver import department_seed, solve_department
+    from synthetic_data import generate
+
+    app = create_app({'MAIL_OUTBOX_ENABLED': False, 'COVER_PLAN_ENABLED': False})
+    generator = services(app).generator
+    results = {}
+    with app.app_context():
+        init_database(db, log=lambda message: None)
+        generate(db, services(app).timetable_logic.store, args.departments, args.teachers, year=args.year, seed=args.seed)
+        departments = [row[0] for row in db.session.query(User.department).distinct().order_by(User.department)]
+        teacher_ids = [row[0] for row in db.session.query(User.id)]
+        counts = [1]
+        while counts[-1] * 2 <= args.generate:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != args.generate:
+            counts.append(args.generate)
+        tasks = [services(app).timetable_logic.department_task(department, 5, args.generate_sessions,
+                                                                seed=department_seed(args.seed, department),
+                                                                keep_existing=False)
+                 for department in departments]
+        db.session.commit()
+        reference, baseline, solve_baseline = None, None, None
+        print(f"{len(departments)} department(s), {len(teacher_ids)} teacher(s), {os.cpu_count()} CPU(s)")
+        for workers in counts:
+            started = time.perf_counter()
+            if workers == 1:
+                list(map(solve_department, tasks))
+            else:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    list(executor.map(solve_department, tasks))
+            solve_elapsed = time.perf_counter() - started
+            solve_baseline = solve_baseline or solve_elapsed
+
+            # Start every timed run from the same timetables (another seed's), so each one rewrites them all
+            generator.run(generator.create_job(departments, 5, args.generate_sessions, seed=args.seed + 1).id,
+                          workers=args.generate)
+            job = generator.create_job(departments, 5, args.generate_sessions, seed=args.seed)
+            started = time.perf_counter()
+            generator.run(job.id, workers=workers)
+            elapsed = time.perf_counter() - started
+            grids = services(app).timetable_logic.store.load(teacher_ids)
+            reference = reference if reference is not None else grids
+            baseline = baseline or elapsed
+            results[f"generate x{workers}"] = {
+                'n': 1, 'p50_ms': round(elapsed * 1000, 3), 'p90_ms': round(elapsed * 1000, 3),
+                'p99_ms': round(elapsed * 1000, 3), 'mean_ms': round(elapsed * 1000, 3),
+                'queries_mean': 0, 'queries_max': 0,
+            }
+            print(f"{workers:>3} worker(s) job {elapsed:>8.2f}s  speedup {baseline / elapsed:>5.2f}x   "
+                  f"solve {solve_elapsed:>8.2f}s  speedup {solve_baseline / solve_elapsed:>5.2f}x   "
+                  f"{'identical' if grids == reference else 'DIFFERENT'} timetables")
+
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def roster_import(args):
+    # A roster of N new teachers through import_roster, as flask import-teachers runs it: total time with
+    # the given hash method and IMPORT_HASH_WORKERS (or --workers) hashing processes
+    workdir = prepare(args)
+
+    from flask_app import create_app, db
+    from migrations import init_database
+    from bulk_import import import_roster
+
+    app = create_app({'MAIL_OUTBOX_ENABLED': False, 'COVER_PLAN_ENABLED': False, 'METRICS_ENABLED': False})
+    lines = ["username,email,password\n"] + [
+        f"teacher{i},teacher{i}@example.com,password-{i}\n" for i in range(args.import_rows)
+    ]
+    with app.app_context():
+        init_database(db, log=lambda message: None)
+        workers = args.workers or app.config['IMPORT_HASH_WORKERS']
+        started = time.perf_counter()
+        report = import_roster(db, lines, "Imported", hash_method=args.hash_method, workers=workers)
+        elapsed = time.perf_counter() - started
+    print(f"Imported {report.teachers} teacher(s) in {elapsed:.2f}s ({report.teachers / elapsed:.0f}/s): "
+          f"{workers} hashing process(es) on {os.cpu_count()} CPU(s), {args.hash_method or 'Werkzeug default'} hashes")
+    results = {f"import {args.import_rows}": {
+        'n': 1, 'p50_ms': round(elapsed * 1000, 3), 'p90_ms': round(elapsed * 1000, 3),
+        'p99_ms': round(elapsed * 1000, 3), 'mean_ms': round(elapsed * 1000, 3),
+        'queries_mean': 0, 'queries_max': 0,
+    }}
+
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Returns the operations whose p50 grew by more than `threshold` times
+    regressions = []
+    print("\nComparison with baseline (p50 / queries):")
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        ratio = current['p50_ms'] / previous['p50_ms'] if previous['p50_ms'] else 1.0
+        flag = ""
+        if ratio > threshold or current['queries_mean'] > previous['queries_mean'] * threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<20} {previous['p50_ms']:>9.2f} -> {current['p50_ms']:>9.2f} ms ({ratio:.2f}x)  "
+              f"{previous['queries_mean']:>7.1f} -> {current['queries_mean']:>7.1f} queries{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark TimetableLogic and routes on synthetic data.")
+    parser.add_argument('--departments', type=int, default=2)
+    parser.add_argument('--teachers', type=int, default=50, help="Teachers per department")
+    parser.add_argument('--year', type=int, default=date.today().year, help="Year of generated leaves")
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage', choices=("rows", "packed"), default="rows")
+    parser.add_argument('--archive-before', type=date.fromisoformat, metavar='DATE',
+                        help="Archive the leaves and date-specific rows of the months before DATE's month before timing")
+    parser.add_argument('--workdir', help="Keep the generated database in this directory")
+    parser.add_argument('--save', help="Write results to this JSON file")
+    parser.add_argument('--compare', help="Baseline JSON file to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25, help="Allowed slowdown factor before failing")
+    parser.add_argument('--startup', type=int, metavar='RUNS',
+                        help="Instead of timing operations, time worker cold start and fork after preload")
+    parser.add_argument('--generate', type=int, metavar='WORKERS',
+                        help="Instead of timing operations, time batch generation with 1, 2, 4 ... WORKERS processes")
+    parser.add_argument('--generate-sessions', type=int, default=8, help="Sessions per day for --generate")
+    parser.add_argument('--import', dest='import_rows', type=int, metavar='ROWS',
+                        help="Instead of timing operations, time a roster import of ROWS teachers")
+    parser.add_argument('--hash-method', help="Werkzeug password hash method for --import (default: Werkzeug's)")
+    parser.add_argument('--workers', type=int, help="Hashing processes for --import (default: IMPORT_HASH_WORKERS)")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(os.path.abspath(args.compare)) as f:
+            baseline = json.load(f)
+    save_path = os.path.abspath(args.save) if args.save else None
+
+    if args.generate:
+        results = generation(args)
+    elif args.import_rows:
+        results = roster_import(args)
+    elif args.startup:
+        results = startup(args)
+    else:
+        results = run(args)
+
+    if save_path:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        with open(save_path, 'w') as f:
+            json.dump({
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'parameters': {key: value for key, value in vars(args).items() if key not in ('save', 'compare')},
+                'results': results,
+            }, f, indent=2)
+        print(f"Saved results to {save_path}")
+    if baseline and compare(results, baseline, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
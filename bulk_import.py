@@ -0,0 +1,268 @@
+# bulk_import.py
+import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import insert, select, or_
+from werkzeug.security import generate_password_hash
+from models import User
+from repair import RepairReport
+from signals import schedule_touched
+from solver import DEFAULT_MAX_CONSECUTIVE
+
+# Department onboarding from CSV files, read row by row and written in batches.
+#
+# Roster CSV:    username,email,password[,role][,department][,teacher_id]
+#                (a password_hash column may replace password for already hashed exports)
+# Timetable CSV: teacher_id,day,session,status - the "data analysis/schedule.csv" layout.
+#                status is 1/0 or Busy/Free; teacher_id is the roster's teacher_id column when the roster
+#                is imported in the same run, otherwise the id of an existing user of the department.
+#                Grids are saved through CoverageRepair.save_grids, so substitute bookings they break are
+#                repaired in the same commit.
+#
+# Invalid rows are skipped and reported as (line, message); valid rows are imported.
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+MAX_ERRORS = 1000
+
+
+def _hash_password(args):
+    # Runs in the worker processes
+    password, method = args
+    return generate_password_hash(password, method) if method else generate_password_hash(password)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ImportReport:
+    def __init__(self):
+        self.teachers = 0
+        self.timetables = 0
+        self.errors = []  # (line, message); capped at MAX_ERRORS
+        self.error_count = 0
+        self.id_map = {}  # Roster teacher_id -> new User.id
+        self.repair = RepairReport()  # Bookings repaired by the imported timetables
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, message))
+
+
+def import_roster(db, lines, department=None, roles=("Teacher",), report=None,
+                  batch_size=1000, hash_method=None, workers=None):
+    # lines: any iterable of CSV text lines (an open file, or decoded upload chunks).
+    # department: forced for every row when given (the uploading HOD's); otherwise read from the file.
+    report = report or ImportReport()
+    reader = csv.DictReader(lines)
+    missing = {'username', 'email'} - set(reader.fieldnames or ())
+    if missing or not {'password', 'password_hash'} & set(reader.fieldnames or ()):
+        raise ValueError("Roster needs username, email and password (or password_hash) columns.")
+
+    seen_usernames, seen_emails = set(), set()
+
+    def validated():
+        for row in reader:
+            line = reader.line_num
+            username = (row.get('username') or '').strip()
+            email = (row.get('email') or '').strip()
+            role = (row.get('role') or 'Teacher').strip() or 'Teacher'
+            row_department = department or (row.get('department') or '').strip()
+            if not username or not email or not row_department:
+                report.error(line, "username, email and department are required.")
+                continue
+            if not row.get('password') and not row.get('password_hash'):
+                report.error(line, "password is required.")
+                continue
+            if role not in roles:
+                report.error(line, f"role must be one of {', '.join(roles)}.")
+                continue
+            if username in seen_usernames or email in seen_emails:
+                report.error(line, "duplicate username or email in file.")
+                continue
+            seen_usernames.add(username)
+            seen_emails.add(email)
+            yield line, {
+                'username': username,
+                'email': email,
+                'role': role,
+                'department': row_department,
+                'password': row.get('password'),
+                'password_hash': row.get('password_hash') or None,
+                'key': (row.get('teacher_id') or '').strip() or None,
+            }
+
+    workers = workers or 1
+    # spawn, not fork: the importing process may have other threads (outbox, planner) running
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        pending = None
+        for batch in _batches(validated(), batch_size):
+            # Hashing of this batch runs in the pool while the previous batch is written
+            to_hash = [(row['password'], hash_method) for _, row in batch if not row['password_hash']]
+            hashes = executor.map(_hash_password, to_hash, chunksize=max(1, len(to_hash) // (workers * 4)))
+            if pending:
+                _insert_users(db, *pending, report)
+            pending = (batch, hashes)
+        if pending:
+            _insert_users(db, *pending, report)
+    return report
+
+
+def _insert_users(db, batch, hashes, report):
+    # Drop rows that clash with existing users, then insert the rest in one statement and commit
+    usernames = [row['username'] for _, row in batch]
+    emails = [row['email'] for _, row in batch]
+    taken_usernames, taken_emails = set(), set()
+    for username, email in db.session.execute(
+        select(User.username, User.email).where(or_(User.username.in_(usernames), User.email.in_(emails)))
+    ):
+        taken_usernames.add(username)
+        taken_emails.add(email)
+
+    hashes = iter(hashes)
+    rows, keys = [], {}
+    for line, row in batch:
+        password_hash = row['password_hash'] or next(hashes)
+        if row['username'] in taken_usernames or row['email'] in taken_emails:
+            report.error(line, "username or email already exists.")
+            continue
+        rows.append({
+            'username': row['username'],
+            'email': row['email'],
+            'password_hash': password_hash,
+            'role': row['role'],
+            'department': row['department'],
+        })
+        if row['key']:
+            keys[row['username']] = row['key']
+    if not rows:
+        return
+    db.session.execute(insert(User), rows)
+    if keys:
+        for user_id, username in db.session.execute(
+            select(User.id, User.username).where(User.username.in_(list(keys)))
+        ):
+            report.id_map[keys[username]] = user_id
+    schedule_touched(db.session, departments={row['department'] for row in rows})  # New substitute candidates
+    db.session.commit()
+    report.teachers += len(rows)
+
+
+def _parse_status(value):
+    value = (value or '').strip()
+    if value in ("1", "Busy"):
+        return "Busy"
+    if value in ("0", "Free"):
+        return "Free"
+    raise ValueError("status must be 1/0 or Busy/Free.")
+
+
+def day_violation(sessions, max_consecutive=DEFAULT_MAX_CONSECUTIVE):
+    # The rules apply_constraints enforces, as a check: returns a message or None
+    run = 0
+    for session in sorted(sessions):
+        run = run + 1 if sessions[session] == "Busy" else 0
+        if run > max_consecutive:
+            return f"more than {max_consecutive} consecutive busy sessions"
+    if sessions and all(status == "Busy" for status in sessions.values()):
+        return "no free session"
+    return None
+
+
+def import_timetables(db, repair, lines, department=None, report=None, batch_size=500, notify=None):
+    # Rows of one teacher must be contiguous (as in schedule.csv), so each grid is complete when the
+    # next teacher starts and at most one batch of grids is held in memory.
+    # Grids replace the teachers' day-based schedules; date-specific overrides are kept.
+    # repair is the app's CoverageRepair; notify(RepairReport) runs before each batch commits, e.g. to queue emails.
+    report = report or ImportReport()
+    reader = csv.DictReader(lines)
+    if {'teacher_id', 'day', 'session', 'status'} - set(reader.fieldnames or ()):
+        raise ValueError("Timetable needs teacher_id, day, session and status columns.")
+
+    done, invalid = set(), set()
+    batch = {}  # key -> (first line, grid)
+    current = None
+
+    def finish(key):
+        line, grid = batch[key]
+        for day, sessions in grid.items():
+            problem = day_violation(sessions)
+            if problem:
+                report.error(line, f"teacher {key}: {day} has {problem}.")
+                del batch[key]
+                return
+
+    for row in reader:
+        line = reader.line_num
+        key = (row['teacher_id'] or '').strip()
+        if key != current:
+            if current in batch:
+                finish(current)
+            if current is not None:
+                done.add(current)
+            if key in done:
+                report.error(line, f"rows for teacher {key} must be grouped together.")
+                invalid.add(key)
+                batch.pop(key, None)
+            current = key
+            if len(batch) >= batch_size:
+                _save_grids(db, repair, batch, department, report, notify)
+                batch = {}
+        if key in invalid:
+            continue
+        try:
+            day = row['day'].strip()
+            if day not in DAYS:
+                raise ValueError(f"unknown day {day}.")
+            session = int(row['session'])
+            if session < 1 or session > 24:
+                raise ValueError("session must be between 1 and 24.")
+            status = _parse_status(row['status'])
+        except (AttributeError, ValueError) as e:
+            report.error(line, f"teacher {key}: {e}")
+            invalid.add(key)
+            batch.pop(key, None)
+            continue
+        batch.setdefault(key, (line, {}))[1].setdefault(day, {})[session] = status
+    if current in batch:
+        finish(current)
+    if batch:
+        _save_grids(db, repair, batch, department, report, notify)
+    return report
+
+
+def _save_grids(db, repair, batch, department, report, notify):
+    # Resolve file keys to users of the department, save the grids and repair their bookings in one transaction
+    resolved = {}
+    existing = [key for key in batch if key not in report.id_map and key.isdigit()]
+    members = set()
+    if existing:
+        query = select(User.id).where(User.id.in_([int(key) for key in existing]))
+        if department:
+            query = query.where(User.department == department)
+        members = {row[0] for row in db.session.execute(query)}
+    for key, (line, grid) in batch.items():
+        user_id = report.id_map.get(key)
+        if user_id is None and key.isdigit() and int(key) in members:
+            user_id = int(key)
+        if user_id is None:
+            report.error(line, f"teacher {key} is not in the roster or the department.")
+            continue
+        resolved[user_id] = grid
+    if resolved:
+        _, repaired = repair.save_grids(resolved)
+        if notify:
+            notify(repaired)
+        db.session.commit()
+        report.timetables += len(resolved)
+        report.repair.reassigned.extend(repaired.reassigned)
+        report.repair.uncovered.extend(repaired.uncovered)
+        report.repair.released.extend(repaired.released)
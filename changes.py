@@ -0,0 +1,275 @@
+# changes.py
+import json
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect, select, insert, delete, func
+from models import User, LeaveRequest, ChangeLog
+from signals import pending_teachers
+
+# Append-only log of calendar changes per user, streamed to dashboards as server-sent events.
+# Every commit that calls schedule_touched for a teacher appends one ChangeLog row for them, with
+# what changed ("leave", "cover" or "timetable") and, for leaves and covers, which dates. The row id
+# is the SSE event id, so a reconnecting client resumes from Last-Event-ID.
+#
+# Ids are not committed in order on every database: on PostgreSQL or MySQL a transaction holding a
+# lower id may commit after one holding a higher id. The hub therefore remembers the ids it skipped
+# and reads them again until they appear or CHANGE_GAP_TIMEOUT seconds pass (rolled back ids never
+# appear). On SQLite writers are serialised and ids are committed in order, so there are no gaps.
+# The replay on reconnect still reads strictly after Last-Event-ID, so a row committing late
+# while the client is disconnected is only picked up by its next full reload.
+
+_DETAILS = 'change_log'
+
+
+def init_change_log(db):
+    def collect(session, flush_context, instances):
+        # Leaves about to be flushed: the absent teacher's "leave" and the substitute's "cover" dates
+        details = session.info.setdefault(_DETAILS, {})
+
+        def add(user_id, kind, date):
+            if user_id is not None:
+                kinds, dates = details.setdefault(user_id, (set(), set()))
+                kinds.add(kind)
+                dates.add(date)
+
+        changed = [leave for leave in list(session.new) + list(session.deleted) if isinstance(leave, LeaveRequest)]
+        for leave in changed:
+            add(leave.teacher_id, "leave", leave.date)
+            add(leave.substitute_id, "cover", leave.date)
+        for leave in session.dirty:
+            if isinstance(leave, LeaveRequest) and session.is_modified(leave):
+                history = inspect(leave).attrs.substitute_id.history
+                for substitute_id in list(history.deleted) + list(history.added):
+                    add(substitute_id, "cover", leave.date)
+                add(leave.teacher_id, "leave", leave.date)
+
+    def append(session):
+        session.flush()
+        details = session.info.pop(_DETAILS, {})
+        touched = pending_teachers(session)
+        user_ids = touched | set(details)
+        if not user_ids:
+            return
+        # Removed teachers are gone by now and get no row
+        existing = [row[0] for row in session.execute(select(User.id).where(User.id.in_(user_ids)))]
+        now = datetime.utcnow()
+        rows = []
+        for user_id in sorted(existing):
+            kinds, dates = details.get(user_id, (set(), set()))
+            if user_id in touched and not kinds:
+                kinds = {"timetable"}  # A day-based save: the whole calendar may have changed
+            rows.append({
+                'user_id': user_id,
+                'kinds': ",".join(sorted(kinds)),
+                'dates': ",".join(sorted(date.isoformat() for date in dates)),
+                'created_at': now,
+            })
+        if rows:
+            session.execute(insert(ChangeLog), rows)
+
+    def discard(session):
+        session.info.pop(_DETAILS, None)
+
+    event.listen(db.session, "before_flush", collect)
+    event.listen(db.session, "before_commit", append)
+    event.listen(db.session, "after_rollback", discard)
+
+
+def change_payload(row):
+    return {
+        'kinds': row.kinds.split(",") if row.kinds else [],
+        'dates': row.dates.split(",") if row.dates else [],
+    }
+
+
+def format_event(event_id, name=None, payload=None):
+    # One SSE message; an id-only message just moves the client's Last-Event-ID forward
+    lines = [f"id: {event_id}"]
+    if name:
+        lines.append(f"event: {name}")
+    if payload is not None:
+        lines.append(f"data: {json.dumps(payload)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def head_id(db):
+    return db.session.query(func.max(ChangeLog.id)).scalar() or 0
+
+
+def replay(db, user_id, cursor, limit):
+    # (changes after cursor for the user, complete). complete is False when the client is too far
+    # behind (more than limit changes, or rows it missed were pruned) and should reload instead.
+    oldest = db.session.query(func.min(ChangeLog.id)).scalar()
+    if oldest is not None and cursor < oldest - 1:
+        return [], False
+    rows = db.session.execute(
+        select(ChangeLog).where(ChangeLog.user_id == user_id, ChangeLog.id > cursor)
+        .order_by(ChangeLog.id).limit(limit + 1)
+    ).scalars().all()
+    if len(rows) > limit:
+        return [], False
+    return [(row.id, change_payload(row)) for row in rows], True
+
+
+def prune(db, days):
+    # Drop log rows older than the given number of days. Returns the number of rows deleted.
+    deleted = db.session.execute(
+        delete(ChangeLog).where(ChangeLog.created_at < datetime.utcnow() - timedelta(days=days))
+    ).rowcount
+    db.session.commit()
+    return deleted
+
+
+class Subscription:
+    # One open stream: its user and how far it has read the hub's broadcast log
+    def __init__(self, user_id, position):
+        self.user_id = user_id
+        self.position = position  # Sequence number of the last broadcast this stream has read
+        self.overflowed = False  # The stream fell behind the retained broadcasts; it gets a reset and reconnects
+        self.closed = False
+
+
+class ChangeHub:
+    # Fan-out of ChangeLog rows to the open streams of this process. One thread reads new rows for
+    # all subscribers at once (woken by local commits, otherwise every CHANGE_POLL_INTERVAL seconds
+    # for commits made by other workers) and appends them, grouped by user id, to a short broadcast
+    # log. Every stream waits on the one condition that announces a new broadcast and picks its user's
+    # changes out of it: an open stream holds no thread, queue, lock, connection or query of its own,
+    # only its position in the log. Under gevent workers the condition is monkey-patched, so a waiting
+    # stream is a parked greenlet.
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self.poll_interval = app.config.get('CHANGE_POLL_INTERVAL', 1.0)
+        self.batch_size = app.config.get('CHANGE_BATCH_SIZE', 1000)
+        self.gap_timeout = app.config.get('CHANGE_GAP_TIMEOUT', 60)
+        self._streams = Counter()  # user_id -> open streams
+        self._broadcasts = deque(maxlen=app.config.get('CHANGE_BROADCASTS_KEPT', 256))  # (seq, {user_id: changes})
+        self._seq = 0
+        self._last_id = None
+        self._gaps = {}  # Skipped id below _last_id -> time.monotonic() after which it is given up
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="change-hub", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def subscribe(self, user_id, limit=None):
+        # Call before replaying the backlog: rows committed from here on reach the subscription,
+        # earlier ones come from the replay (the stream skips ids it already sent).
+        # Returns None when limit streams are already open in this process (overload).
+        with self._lock:
+            if limit is not None and sum(self._streams.values()) >= limit:
+                return None
+            if self._last_id is None:
+                self._last_id = head_id(self.db)
+            self._streams[user_id] += 1
+            subscription = Subscription(user_id, self._seq)
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            self._streams[subscription.user_id] -= 1
+            if not self._streams[subscription.user_id]:
+                del self._streams[subscription.user_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(self._streams.values())
+
+    def wait(self, subscription, timeout):
+        # The subscription's changes broadcast since it last read, or [] after timeout
+        with self._changed:
+            self._changed.wait_for(lambda: self._seq > subscription.position or self._stop.is_set(), timeout)
+            if self._seq == subscription.position:
+                # Stopping hands the client a reset, so it reconnects to a running process
+                subscription.overflowed = self._stop.is_set()
+                return []
+            if not self._broadcasts or self._broadcasts[0][0] > subscription.position + 1:
+                # Broadcasts it has not read were already dropped
+                subscription.overflowed = True
+                return []
+            unread = []
+            for seq, changes in reversed(self._broadcasts):
+                if seq <= subscription.position:
+                    break
+                unread.append(changes)
+            subscription.position = self._seq
+        return [change for changes in reversed(unread) for change in changes.get(subscription.user_id, ())]
+
+    def wake(self, *args, **kwargs):
+        # Connected to schedule_changed: a local commit appended rows
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                with self.app.app_context():
+                    self._dispatch()
+            except Exception as e:
+                self.app.logger.exception("Change hub failed: %s", e)
+        with self._changed:
+            self._changed.notify_all()
+
+    def _broadcast(self, rows):
+        # One log entry for the rows of users with open streams, then every waiting stream is woken
+        with self._changed:
+            changes = {}
+            for row in rows:
+                if row.user_id in self._streams:
+                    changes.setdefault(row.user_id, []).append((row.id, change_payload(row)))
+            if changes:
+                self._seq += 1
+                self._broadcasts.append((self._seq, changes))
+                self._changed.notify_all()
+
+    def _dispatch(self):
+        with self._lock:
+            if not self._streams:
+                # Nobody to tell; the next subscriber starts tracking from the head again
+                self._last_id = None
+                self._gaps = {}
+                return
+        now = time.monotonic()
+        self._gaps = {change_id: expires for change_id, expires in self._gaps.items() if expires > now}
+        while True:
+            condition = ChangeLog.id > self._last_id
+            if self._gaps:
+                condition = condition | ChangeLog.id.in_(sorted(self._gaps))
+            rows = self.db.session.execute(
+                select(ChangeLog).where(condition).order_by(ChangeLog.id).limit(self.batch_size)
+            ).scalars().all()
+            if not rows:
+                return
+            self._broadcast(rows)
+            for row in rows:
+                if row.id in self._gaps:
+                    del self._gaps[row.id]
+                elif row.id > self._last_id:
+                    # Ids skipped on the way may belong to transactions that have not committed yet
+                    if row.id - self._last_id - 1 <= self.batch_size:
+                        self._gaps.update(dict.fromkeys(range(self._last_id + 1, row.id), now + self.gap_timeout))
+                    self._last_id = row.id
+            if len(rows) < self.batch_size:
+                return
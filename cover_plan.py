@@ -0,0 +1,269 @@
+# cover_plan.py
+import threading
+from datetime import date as date_type, datetime, timedelta
+from sqlalchemy import select, insert, update, delete, union_all, literal
+from sqlalchemy.exc import IntegrityError
+from models import User, Timetable, LeaveRequest, CoverPlan, CoverPlanRun
+from availability import ALL_SESSIONS, session_bit
+
+# Substitute candidates planned ahead, so apply_leave does not search at submission time.
+# For every session of the next COVER_PLAN_WEEKS weeks in which some member of a department is
+# day-based Busy, CoverPlan keeps the members free in that slot, fewest recent covers first. A department
+# is re-planned from its grids, overrides and leaves in a few queries whenever schedule_changed
+# names it; only rows whose candidates changed are written.
+#
+# schedule_changed only fires in the process that committed, so each change is re-planned once. The
+# daily full re-plan is elected through CoverPlanRun: of all the processes running a planner, the one
+# that inserts the day's row runs it. The others only re-plan the departments their own commits change.
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def encode_candidates(teacher_ids):
+    return ",".join(str(teacher_id) for teacher_id in teacher_ids)
+
+
+def decode_candidates(value):
+    return [int(teacher_id) for teacher_id in value.split(",")] if value else []
+
+
+class CoverPlanner:
+    # Keeps CoverPlan current in a background thread. Departments named by schedule_changed are
+    # queued and re-planned together; the whole horizon is refreshed once a day as it moves forward.
+    def __init__(self, app, db, store, ranking):
+        self.app = app
+        self.db = db
+        self.store = store
+        self.ranking = ranking
+        self.enabled = app.config.get('COVER_PLAN_ENABLED', True)
+        self.weeks = app.config.get('COVER_PLAN_WEEKS', 4)
+        self.max_candidates = app.config.get('COVER_PLAN_CANDIDATES', 8)
+        self.poll_interval = app.config.get('COVER_PLAN_POLL_INTERVAL', 3600)
+        self.debounce = app.config.get('COVER_PLAN_DEBOUNCE', 1.0)  # Seconds to gather changes before re-planning
+        self.lease = app.config.get('COVER_PLAN_LEASE', 1800)  # Seconds before an unfinished full run is taken over
+        self._dirty = set()
+        self._planned_on = None  # Date of the last full run
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="cover-planner", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def on_schedule_changed(self, sender, teacher_ids=(), departments=()):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._dirty.update(departments)
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    today = date_type.today()
+                    if self._planned_on != today and self._claim_full_run(today):
+                        self.plan_all(today)
+                        self.db.session.execute(
+                            update(CoverPlanRun).where(CoverPlanRun.planned_on == today)
+                            .values(finished_at=datetime.utcnow())
+                        )
+                        self.db.session.commit()
+                    with self._lock:
+                        departments, self._dirty = self._dirty, set()
+                    for department in departments:
+                        self.plan_department(department)
+            except Exception as e:
+                self.app.logger.exception("Cover planner failed: %s", e)
+                self.db.session.rollback()
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            # A burst of commits (e.g. a bulk leave) is re-planned once
+            self._stop.wait(self.debounce)
+
+    def _claim_full_run(self, today):
+        # True when this process should run today's full re-plan: it inserted today's CoverPlanRun row,
+        # or took over a claim that has not finished within COVER_PLAN_LEASE seconds (its process died).
+        # Once another process has finished the run, this one stops asking until tomorrow.
+        now = datetime.utcnow()
+        try:
+            self.db.session.add(CoverPlanRun(planned_on=today, started_at=now))
+            self.db.session.commit()
+            return True
+        except IntegrityError:
+            self.db.session.rollback()
+        taken = self.db.session.execute(
+            update(CoverPlanRun)
+            .where(CoverPlanRun.planned_on == today, CoverPlanRun.finished_at.is_(None),
+                   CoverPlanRun.started_at < now - timedelta(seconds=self.lease))
+            .values(started_at=now)
+        ).rowcount
+        self.db.session.commit()
+        if not taken and self.db.session.execute(
+            select(CoverPlanRun.id).where(CoverPlanRun.planned_on == today, CoverPlanRun.finished_at.isnot(None))
+        ).first():
+            self._planned_on = today
+        return bool(taken)
+
+    def horizon(self, today=None):
+        today = today or date_type.today()
+        return today, today + timedelta(days=7 * self.weeks - 1)
+
+    def plan_all(self, today=None):
+        # Re-plan every department and drop rows for past dates. Returns the number of rows written.
+        start, _ = self.horizon(today)
+        self.db.session.execute(delete(CoverPlan).where(CoverPlan.date < start))
+        self.db.session.execute(delete(CoverPlanRun).where(CoverPlanRun.planned_on < start))
+        self.db.session.commit()
+        written = 0
+        for (department,) in self.db.session.query(User.department).distinct():
+            written += self.plan_department(department, today)
+        self._planned_on = start
+        return written
+
+    def plan_department(self, department, today=None):
+        # Recompute the department's plan over the horizon and write the difference. Returns rows written.
+        start, end = self.horizon(today)
+        members = [row[0] for row in self.db.session.execute(
+            select(User.id)
+            .where(User.role.in_(["Teacher", "HOD"]), User.department == department)
+            .order_by(User.id)
+        )]
+
+        # Day-based busy masks per (teacher, weekday)
+        day_busy = {}
+        for teacher_id, grid in self.store.load(members).items():
+            for day, sessions in grid.items():
+                mask = 0
+                for session, status in sessions.items():
+                    if status == "Busy":
+                        mask |= session_bit(session)
+                day_busy[(teacher_id, day)] = mask
+
+        # Date-specific overrides and leaves in the horizon (same precedence as AvailabilityIndex)
+        date_set, date_busy, on_leave = {}, {}, {}
+        for teacher_id, date, session, status in self.db.session.execute(
+            select(Timetable.teacher_id, Timetable.date, Timetable.session, Timetable.status)
+            .join(User, Timetable.teacher_id == User.id)
+            .where(User.department == department, Timetable.date >= start, Timetable.date <= end)
+        ):
+            bit = session_bit(session)
+            date_set[(teacher_id, date)] = date_set.get((teacher_id, date), 0) | bit
+            if status == "Busy":
+                date_busy[(teacher_id, date)] = date_busy.get((teacher_id, date), 0) | bit
+        for teacher_id, date, session in self.db.session.execute(
+            select(LeaveRequest.teacher_id, LeaveRequest.date, LeaveRequest.session)
+            .join(User, LeaveRequest.teacher_id == User.id)
+            .where(User.department == department, LeaveRequest.date >= start, LeaveRequest.date <= end)
+        ):
+            on_leave[(teacher_id, date)] = on_leave.get((teacher_id, date), 0) | session_bit(session)
+
+        # Fewest covers over the counter window up to the horizon's end first, then lowest id
+        ranked = self.ranking.ranked(members, end)
+        plan = {}
+        for offset in range((end - start).days + 1):
+            date = start + timedelta(days=offset)
+            day = DAYS[date.weekday()]
+            needed = 0
+            free_masks = {}
+            for teacher_id in members:
+                overridden = date_set.get((teacher_id, date), 0)
+                leave = on_leave.get((teacher_id, date), 0) & ~overridden
+                day_mask = day_busy.get((teacher_id, day), 0)
+                needed |= day_mask
+                busy = date_busy.get((teacher_id, date), 0) | leave | (day_mask & ~overridden & ~leave)
+                free_masks[teacher_id] = ALL_SESSIONS & ~busy
+            session = 1
+            while needed:
+                if needed & 1:
+                    bit = session_bit(session)
+                    plan[(date, session)] = encode_candidates(
+                        [teacher_id for teacher_id in ranked if free_masks[teacher_id] & bit][:self.max_candidates]
+                    )
+                needed >>= 1
+                session += 1
+
+        # Write only what changed
+        stored = {
+            (date, session): (plan_id, candidates)
+            for plan_id, date, session, candidates in self.db.session.execute(
+                select(CoverPlan.id, CoverPlan.date, CoverPlan.session, CoverPlan.candidates)
+                .where(CoverPlan.department == department, CoverPlan.date >= start, CoverPlan.date <= end)
+            )
+        }
+        inserts, updates = [], []
+        for (date, session), candidates in plan.items():
+            current = stored.pop((date, session), None)
+            if current is None:
+                inserts.append({'department': department, 'date': date, 'session': session,
+                                'candidates': candidates})
+            elif current[1] != candidates:
+                updates.append({'id': current[0], 'candidates': candidates})
+        deletes = [plan_id for plan_id, _ in stored.values()]
+        if deletes:
+            self.db.session.execute(delete(CoverPlan).where(CoverPlan.id.in_(deletes)))
+        if updates:
+            self.db.session.execute(update(CoverPlan), updates)
+        if inserts:
+            self.db.session.execute(insert(CoverPlan), inserts)
+        self.db.session.commit()
+        return len(inserts) + len(updates) + len(deletes)
+
+    def candidates(self, department, date, session):
+        # Planned substitutes for the slot, or None when the slot is not planned (e.g. past the horizon)
+        if not self.enabled:
+            return None
+        row = self.db.session.execute(
+            select(CoverPlan.candidates).where(
+                CoverPlan.department == department, CoverPlan.date == date, CoverPlan.session == session
+            )
+        ).first()
+        return decode_candidates(row[0]) if row is not None else None
+
+    def still_free(self, department, date, session, teacher_ids):
+        # Re-check planned candidates against the committed state in one round trip (the plan may trail
+        # a recent write). Same precedence as AvailabilityIndex: date-specific > leave > day-based.
+        # Returns the candidates that are free, in plan order.
+        if not teacher_ids:
+            return []
+        day = DAYS[date.weekday()]
+        bit = session_bit(session)
+        day_rows = self.store.department_day_query(department, day).where(User.id.in_(teacher_ids))
+        date_rows = select(
+            Timetable.teacher_id, Timetable.session, Timetable.status, literal('date').label('kind')
+        ).where(Timetable.teacher_id.in_(teacher_ids), Timetable.date == date, Timetable.session == session)
+        leave_rows = select(
+            LeaveRequest.teacher_id, LeaveRequest.session, literal('On Leave'), literal('leave').label('kind')
+        ).where(LeaveRequest.teacher_id.in_(teacher_ids), LeaveRequest.date == date, LeaveRequest.session == session)
+        day_busy, overrides, on_leave = set(), {}, set()
+        for teacher_id, value, status, kind in self.db.session.execute(union_all(day_rows, date_rows, leave_rows)):
+            if kind == 'mask':
+                if value & bit:
+                    day_busy.add(teacher_id)
+            elif kind == 'day':
+                if value == session and status == "Busy":
+                    day_busy.add(teacher_id)
+            elif kind == 'date':
+                overrides[teacher_id] = status
+            else:
+                on_leave.add(teacher_id)
+        free = []
+        for teacher_id in teacher_ids:
+            if teacher_id in overrides:
+                if overrides[teacher_id] == "Free":
+                    free.append(teacher_id)
+            elif teacher_id not in on_leave and teacher_id not in day_busy:
+                free.append(teacher_id)
+        return free
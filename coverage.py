@@ -0,0 +1,81 @@
+# coverage.py
+from collections import deque
+
+
+def assign_cover(needs, free, load=None):
+    # Assign substitutes to many absences at once.
+    # needs: slot -> list of absent teacher ids needing cover in that slot
+    # free:  slot -> list of substitute ids free in that slot (in preference order)
+    # load:  substitute id -> covers already held (counted towards balancing)
+    # Every slot is a bipartite matching between absences and free colleagues; cover is maximised
+    # per slot and the total load is then balanced with augmenting paths (min-cost flow with convex costs).
+    # Returns ({(slot, teacher_id): substitute_id}, [(slot, teacher_id) left uncovered])
+    load = dict(load or {})
+    used = {}  # slot -> substitutes already covering that slot
+    held = {}  # substitute -> set of (slot, teacher_id) it covers
+    assignment = {}
+    uncovered = []
+
+    # Scarce slots first so they get first pick of the least loaded colleagues
+    order = sorted(needs, key=lambda slot: len(free.get(slot, ())) - len(needs[slot]))
+    for slot in order:
+        candidates = list(free.get(slot, ()))
+        taken = used.setdefault(slot, set())
+        for teacher_id in needs[slot]:
+            choices = [sub for sub in candidates if sub not in taken and sub != teacher_id]
+            if not choices:
+                uncovered.append((slot, teacher_id))
+                continue
+            substitute = min(choices, key=lambda sub: load.get(sub, 0))
+            assignment[(slot, teacher_id)] = substitute
+            taken.add(substitute)
+            held.setdefault(substitute, set()).add((slot, teacher_id))
+            load[substitute] = load.get(substitute, 0) + 1
+
+    # Balance: move cover off the busiest substitutes along alternating paths until none shortens
+    improved = True
+    while improved:
+        improved = False
+        for start in sorted(held, key=lambda sub: -load.get(sub, 0)):
+            path_end = _find_relief(start, held, free, used, load)
+            if path_end is None:
+                continue
+            _shift(path_end, start, held, used, assignment, load)
+            improved = True
+            break
+
+    return assignment, uncovered
+
+
+def _find_relief(start, held, free, used, load):
+    # BFS over "substitute x could hand slot s to substitute y" edges, looking for someone
+    # with at least two fewer covers than `start`
+    target = load.get(start, 0) - 1
+    parent = {start: None}
+    queue = deque([start])
+    while queue:
+        current = queue.popleft()
+        for slot, teacher_id in held.get(current, ()):
+            for candidate in free.get(slot, ()):
+                if candidate in parent or candidate in used[slot] or candidate == teacher_id:
+                    continue
+                parent[candidate] = (current, slot, teacher_id)
+                if load.get(candidate, 0) < target:
+                    return candidate, parent
+                queue.append(candidate)
+    return None
+
+
+def _shift(path_end, start, held, used, assignment, load):
+    # Apply the path found by _find_relief: each hop hands one cover to the next substitute
+    node, parent = path_end
+    while node != start:
+        previous, slot, teacher_id = parent[node]
+        held[previous].discard((slot, teacher_id))
+        held.setdefault(node, set()).add((slot, teacher_id))
+        used[slot].discard(previous)
+        used[slot].add(node)
+        assignment[(slot, teacher_id)] = node
+        node = previous
+    load[start] -= 1
+    load[path_end[0]] = load.get(path_end[0], 0) + 1
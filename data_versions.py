@@ -0,0 +1,90 @@
+# data_versions.py
+import hashlib
+from datetime import datetime
+from sqlalchemy import event, select, update, insert
+from models import User, DataVersion
+from signals import pending_teachers
+
+# Per-teacher version of everything the calendar endpoints return (timetable, overrides, leaves).
+# Every commit that calls schedule_touched for a teacher bumps their DataVersion row in the same
+# transaction, so a conditional GET can answer 304 from this one row without reading the schedule.
+
+API_VERSION = "v1"  # Part of every ETag; bump when the JSON shape changes
+
+
+def init_data_versions(db):
+    def bump(session):
+        teacher_ids = pending_teachers(session)
+        if not teacher_ids:
+            return
+        # Removed teachers are gone by now and get no row
+        existing = [row[0] for row in session.execute(select(User.id).where(User.id.in_(teacher_ids)))]
+        if not existing:
+            return
+        now = datetime.utcnow()
+        table = DataVersion.__table__
+        session.execute(
+            update(table).where(table.c.teacher_id.in_(existing))
+            .values(version=table.c.version + 1, updated_at=now)
+        )
+        versioned = {row[0] for row in session.execute(
+            select(table.c.teacher_id).where(table.c.teacher_id.in_(existing))
+        )}
+        missing = [teacher_id for teacher_id in existing if teacher_id not in versioned]
+        if missing:
+            session.execute(insert(table), [
+                {'teacher_id': teacher_id, 'version': 1, 'updated_at': now} for teacher_id in missing
+            ])
+
+    event.listen(db.session, "before_commit", bump)
+
+
+def seed_versions(db):
+    # Version 1 for every user without a row (used when the table is created)
+    now = datetime.utcnow()
+    versioned = select(DataVersion.teacher_id)
+    user_ids = [row[0] for row in db.session.execute(select(User.id).where(User.id.not_in(versioned)))]
+    if user_ids:
+        db.session.execute(insert(DataVersion), [
+            {'teacher_id': user_id, 'version': 1, 'updated_at': now} for user_id in user_ids
+        ])
+    db.session.commit()
+
+
+def validators(db, teacher_ids):
+    # (etag, last_modified) for a response built from the given teachers' data.
+    # Teachers without a row (never written) count as version 0.
+    teacher_ids = sorted(set(teacher_ids))
+    rows = {
+        teacher_id: (version, updated_at)
+        for teacher_id, version, updated_at in db.session.execute(
+            select(DataVersion.teacher_id, DataVersion.version, DataVersion.updated_at)
+            .where(DataVersion.teacher_id.in_(teacher_ids))
+        )
+    }
+    if len(teacher_ids) == 1:
+        tag = f"{teacher_ids[0]}-{rows.get(teacher_ids[0], (0, None))[0]}"
+    else:
+        state = ",".join(f"{teacher_id}:{rows.get(teacher_id, (0, None))[0]}" for teacher_id in teacher_ids)
+        tag = hashlib.sha1(state.encode()).hexdigest()[:20]
+    modified = [updated_at for _, updated_at in rows.values() if updated_at is not None]
+    return f"{API_VERSION}-{tag}", max(modified) if modified else None
+
+
+def teacher_version(db, teacher_id):
+    # The teacher's persisted version; 0 before anything was written for them
+    return db.session.execute(
+        select(DataVersion.version).where(DataVersion.teacher_id == teacher_id)
+    ).scalar() or 0
+
+
+def department_version(db, department):
+    # Digest of the department's substitute-eligible members and their versions. It changes with any
+    # member's schedule or leaves, and when someone joins or leaves the department.
+    rows = db.session.execute(
+        select(User.id, DataVersion.version)
+        .outerjoin(DataVersion, DataVersion.teacher_id == User.id)
+        .where(User.department == department, User.role.in_(["Teacher", "HOD"]))
+        .order_by(User.id)
+    )
+    return hashlib.sha1(",".join(f"{user_id}:{version or 0}" for user_id, version in rows).encode()).hexdigest()[:16]
@@ -1,64 +1,393 @@
 # app.py
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, current_app, jsonify
+import codecs
+import threading
+import click
+from flask import Flask, render_template, request, redirect, url_for, flash, current_app, jsonify, Response, stream_with_context
+from flask.cli import AppGroup
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from flask_mail import Mail, Message
+from flask_mail import Mail
 from werkzeug.security import generate_password_hash, check_password_hash
-from itsdangerous import URLSafeTimedSerializer
+from werkzeug.http import is_resource_modified
+from werkzeug.local import LocalProxy
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from database import db
 from timetable_logic import TimetableLogic
 import random
-from datetime import datetime
-from models import User, Timetable, LeaveRequest
-
-# Initialize Flask app
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your_secret_key'  
-
-# Define the path for the database
-os.makedirs(os.path.join(os.getcwd(), 'instance'), exist_ok=True)
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.getcwd(), 'instance', 'timetable.db')}"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['MAIL_SERVER'] = 'smtp.mail.server'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USERNAME'] = 'smtp_email'
-app.config['MAIL_PASSWORD'] = 'mail_pass'
-
-# Initialize extensions
-db.init_app(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
-mail = Mail(app)
-serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
-
-# Flask-Login user loader
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
-
-# Timetable logic instance
-timetable_logic = TimetableLogic(db, app)
+from datetime import datetime, date as date_type, timedelta
+from models import User, Timetable, LeaveRequest, GenerationJob
+from migrations import init_database, upgrade_database
+from query_plans import full_table_scans
+from notifications import NotificationOutbox, queue_email
+from signals import init_signals, schedule_touched, schedule_changed, user_touched, user_changed
+from ranking import init_cover_counts
+from data_versions import init_data_versions, validators
+from changes import init_change_log, ChangeHub, format_event, replay, head_id, prune
+from auth import UserCache, PasswordHasher, LoginOverloaded
+from timetable_store import LAYOUTS, make_store, convert_layout
+from instrumentation import init_instrumentation
+from db_config import configure_database, install_sqlite_pragmas, archive_uri
+from repair import CoverageRepair
+from bulk_import import ImportReport, import_roster, import_timetables
+from archive import archive, archive_cutoff
+from reports import parse_filters, report_page, export_rows, csv_stream, json_stream
+from generation import BatchGenerator, job_status
+from ical import feed_token, feed_identity, calendar_stream
+from analytics import CHARTS, DepartmentData, ChartCache, render_chart, leave_window_start, data_version
+
+# Routes and CLI commands are collected at import and added to every app create_app() builds
+_routes = []
+cli = AppGroup(__name__)
+
+def route(rule, **options):
+    def decorator(view):
+        _routes.append((rule, view, options))
+        return view
+    return decorator
+
+def configure(app, config=None):
+    app.config['SECRET_KEY'] = 'your_secret_key'
+
+    # Database URI and engine/pool options come from the environment (DATABASE_URL etc., see db_config.py);
+    # without DATABASE_URL the SQLite file instance/timetable.db is used
+    configure_database(app)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Day-based timetable layout: "rows" (one row per session) or "packed" (one bitmask row per day)
+    app.config['TIMETABLE_STORAGE'] = os.environ.get('TIMETABLE_STORAGE', 'rows')
+    # Resolved-schedule cache: "memory" (per process), "sqlite:<path>" (shared by workers on one host) or "none"
+    app.config['SCHEDULE_CACHE'] = os.environ.get('SCHEDULE_CACHE', 'memory')
+    # Substitutes planned ahead for the next COVER_PLAN_WEEKS weeks by a background thread (cover_plan.py)
+    app.config['COVER_PLAN_ENABLED'] = os.environ.get('COVER_PLAN_ENABLED', '1') == '1'
+    app.config['COVER_PLAN_WEEKS'] = int(os.environ.get('COVER_PLAN_WEEKS', 4))
+    # Substitutes are ranked by their covers over the last COVER_WINDOW_WEEKS weeks (ranking.py)
+    app.config['COVER_WINDOW_WEEKS'] = int(os.environ.get('COVER_WINDOW_WEEKS', 8))
+    # Outgoing mail (Flask-Mail); MAIL_SERVER / MAIL_PORT can point at a local SMTP stand-in for testing
+    app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.mail.server')
+    app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+    app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') == '1'
+    app.config['MAIL_USE_SSL'] = os.environ.get('MAIL_USE_SSL', '0') == '1'
+    app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME', 'smtp_email')
+    app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', 'mail_pass')
+
+    # Per-request SQL/latency instrumentation and the /metrics endpoint
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+    app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500))
+    # Bearer token for /metrics; without one, /metrics only answers direct requests from localhost
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    # Lifetime of calendar feed links in seconds, default 400 days (a school year with room to spare); 0 never expires.
+    # The dashboard always shows a fresh link, and "Replace link" there revokes the old ones at once.
+    app.config['ICAL_TOKEN_MAX_AGE'] = int(os.environ.get('ICAL_TOKEN_MAX_AGE', 400 * 24 * 3600)) or None
+    # Werkzeug password hash method, e.g. "scrypt:32768:8:1" (default) or "pbkdf2:sha256:600000";
+    # stored hashes made with other parameters are rehashed when their owner logs in
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD')
+    # Password hashing processes per CSV import (bulk_import.py), default one per CPU; import-teachers --workers
+    # overrides it. IMPORT_HASH_METHOD picks a cheaper hash for imports; it is upgraded at each first login.
+    app.config['IMPORT_HASH_WORKERS'] = int(os.environ.get('IMPORT_HASH_WORKERS', 0)) or os.cpu_count() or 1
+    app.config['IMPORT_HASH_METHOD'] = os.environ.get('IMPORT_HASH_METHOD')
+    # Run pending migrations when the app is created (single-process development); otherwise use flask init-db
+    app.config['DB_AUTO_MIGRATE'] = os.environ.get('DB_AUTO_MIGRATE', '0') == '1'
+    # Leaves and date-specific rows are archived by month once the month ended ARCHIVE_AFTER_DAYS ago (archive.py)
+    app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+    app.config.update(config or {})
+    # The archive bind: ARCHIVE_DATABASE_URL, or by default a file next to the main SQLite database
+    app.config['SQLALCHEMY_BINDS'] = {
+        'archive': os.environ.get('ARCHIVE_DATABASE_URL') or archive_uri(app.config['SQLALCHEMY_DATABASE_URI']),
+        **app.config.get('SQLALCHEMY_BINDS', {})
+    }
+
+_session_events = threading.Lock()
+_session_events_installed = False
+
+def init_session_events():
+    # db.session is shared by every app in the process, so its listeners are installed once
+    global _session_events_installed
+    with _session_events:
+        if _session_events_installed:
+            return
+        init_signals(db)
+        # Cover counters follow every leave written or deleted (ranking.py)
+        init_cover_counts(db)
+        # Per-teacher data versions behind the calendar endpoints' ETag / Last-Modified (data_versions.py)
+        init_data_versions(db)
+        # Per-user calendar change log behind the live update stream (changes.py)
+        init_change_log(db)
+        _session_events_installed = True
+
+class Services:
+    # The app's long-lived objects, each built on first use. Creating the app therefore opens no
+    # database connection, SMTP client, thread pool or background thread, so a server can import it
+    # once and fork its workers from there.
+    def __init__(self, app):
+        self.app = app
+        self._built = {}
+        self._lock = threading.RLock()
+
+    def _get(self, name, build):
+        value = self._built.get(name)
+        if value is None:
+            with self._lock:
+                value = self._built.get(name)
+                if value is None:
+                    value = self._built[name] = build()
+        return value
+
+    @property
+    def mail(self):
+        return self._get('mail', lambda: Mail(self.app))
+
+    @property
+    def outbox(self):
+        # Emails are written to the Notification outbox and sent by background workers
+        return self._get('outbox', lambda: NotificationOutbox(self.app, db, self.mail))
+
+    @property
+    def serializer(self):
+        return self._get('serializer', lambda: URLSafeTimedSerializer(self.app.config['SECRET_KEY']))
+
+    @property
+    def user_cache(self):
+        # Flask-Login user loader, served from a bounded TTL cache of user snapshots
+        def build():
+            cache = UserCache(self.app.config.get('USER_CACHE_SIZE', 10000), self.app.config.get('USER_CACHE_TTL', 300))
+            user_changed.connect(cache.on_user_changed)
+            return cache
+        return self._get('user_cache', build)
+
+    @property
+    def passwords(self):
+        # Admission control for password checks at login: requests wait for their hash, past the limit they get 503
+        return self._get('passwords', lambda: PasswordHasher(
+            method=self.app.config.get('PASSWORD_HASH_METHOD'),
+            workers=self.app.config.get('LOGIN_HASH_WORKERS'),
+            queue_size=self.app.config.get('LOGIN_HASH_QUEUE'),
+            timeout=self.app.config.get('LOGIN_HASH_TIMEOUT', 10)
+        ))
+
+    @property
+    def timetable_logic(self):
+        return self._get('timetable_logic', lambda: TimetableLogic(db, self.app))
+
+    @property
+    def coverage_repair(self):
+        # Re-covers bookings broken by teacher removal or timetable edits
+        return self._get('coverage_repair', lambda: CoverageRepair(self.timetable_logic))
+
+    @property
+    def generator(self):
+        # Batch timetable generation jobs, solved on a process pool one department per task
+        return self._get('generator', lambda: BatchGenerator(
+            self.app, db, self.timetable_logic, self.coverage_repair, notify=queue_repair_emails
+        ))
+
+    @property
+    def chart_cache(self):
+        # Rendered analytics charts, re-rendered only after the department's schedules or leaves change
+        return self._get('chart_cache', lambda: ChartCache(self.app.config.get('CHART_CACHE_SIZE', 64)))
+
+    @property
+    def change_hub(self):
+        # Fans change log rows out to the open /api/v1/changes streams of this process
+        def build():
+            hub = ChangeHub(self.app, db)
+            schedule_changed.connect(hub.wake)
+            return hub
+        return self._get('change_hub', build)
+
+def services(app=None):
+    return (app or current_app).extensions['timetable']
+
+# The current app's services under the names the routes use
+outbox = LocalProxy(lambda: services().outbox)
+serializer = LocalProxy(lambda: services().serializer)
+user_cache = LocalProxy(lambda: services().user_cache)
+passwords = LocalProxy(lambda: services().passwords)
+timetable_logic = LocalProxy(lambda: services().timetable_logic)
+coverage_repair = LocalProxy(lambda: services().coverage_repair)
+chart_cache = LocalProxy(lambda: services().chart_cache)
+generator = LocalProxy(lambda: services().generator)
 
-# Initialize database tables before any routes are accessed
-with app.app_context():
+def load_user(user_id):
+    return user_cache.load(int(user_id), lambda user_id: db.session.get(User, user_id))
+
+def create_app(config=None):
+    # Application factory: gunicorn "flask_app:create_app()", or flask --app flask_app.
+    # Builds the app without touching the database; the schema is created by flask init-db
+    # (or flask migrate) before the app is served.
+    app = Flask(__name__)
+    configure(app, config)
+
+    db.init_app(app)
+    install_sqlite_pragmas(app, db)
+    init_session_events()
+    init_instrumentation(app, db)
+    login_manager = LoginManager(app)
+    login_manager.login_view = 'login'
+    login_manager.user_loader(load_user)
+    app.extensions['timetable'] = Services(app)
+
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    for command in cli.commands.values():
+        app.cli.add_command(command)
+
+    if app.config['DB_AUTO_MIGRATE']:
+        with app.app_context():
+            upgrade_database(db)
+    return app
+
+def queue_repair_emails(report):
+    # Tell new substitutes about their covers, and the absent teachers' HODs about leaves left uncovered
+    user_ids = {item[0] for item in report.reassigned + report.uncovered} | {item[3] for item in report.reassigned}
+    if not user_ids:
+        return
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+    by_substitute = {}
+    for teacher_id, date, session, substitute_id in report.reassigned:
+        by_substitute.setdefault(substitute_id, []).append(f"{users[teacher_id].username} on {date}, session {session}")
+    for substitute_id, lines in by_substitute.items():
+        queue_email(db, "Substitute Assignment", [users[substitute_id].email],
+                    "You are substituting for:\n" + "\n".join(lines), sender=current_app.config['MAIL_USERNAME'])
+    by_department = {}
+    for teacher_id, date, session in report.uncovered:
+        teacher = users[teacher_id]
+        by_department.setdefault(teacher.department, []).append(f"{teacher.username} on {date}, session {session}")
+    for department, lines in by_department.items():
+        hod = User.query.filter_by(role="HOD", department=department).first()
+        if hod:
+            queue_email(db, "Uncovered Leave", [hod.email],
+                        "No substitute could be found for:\n" + "\n".join(lines), sender=current_app.config['MAIL_USERNAME'])
+
+def flash_repair_report(report):
+    if report.reassigned:
+        flash(f'{len(report.reassigned)} substitute booking(s) were reassigned.', 'info')
+    if report.released:
+        flash(f'{len(report.released)} leave(s) no longer needed a substitute; their covers were released.', 'info')
+    if report.uncovered:
+        flash(f'{len(report.uncovered)} leave session(s) could not be covered.', 'warning')
+
+# Create the schema in a new database, or upgrade an existing one: flask init-db
+@cli.command('init-db')
+def init_db_command():
+    version = init_database(db)
+    print(f"Database is at schema version {version}.")
+
+# Upgrade an existing database in place: flask migrate
+@cli.command('migrate')
+def migrate_command():
+    version = upgrade_database(db)
+    print(f"Database is at schema version {version}.")
+
+# Fail when a query sent by a route or job would scan a whole table: flask check-query-plans
+@cli.command('check-query-plans')
+def check_query_plans_command():
+    problems = full_table_scans(db)
+    for name, scans in problems.items():
+        print(f"{name}: {'; '.join(scans)}")
+    if problems:
+        raise SystemExit(1)
+    print("No full table scans in the queries of the routes and jobs.")
+
+# Move day-based schedules between layouts, then set TIMETABLE_STORAGE: flask convert-timetable-storage packed
+@cli.command('convert-timetable-storage')
+@click.argument('layout', type=click.Choice(LAYOUTS))
+def convert_timetable_storage_command(layout):
+    source = make_store(db, 'packed' if layout == 'rows' else 'rows')
+    converted = convert_layout(db, source, make_store(db, layout))
+    print(f"Converted {converted} timetable(s) to the {layout} layout. Set TIMETABLE_STORAGE={layout}.")
+
+# Onboard a department from CSV files:
+#   flask import-teachers --roster teachers.csv --timetable schedule.csv --department CS
+@cli.command('import-teachers')
+@click.option('--roster', type=click.File('r', encoding='utf-8-sig'), help="username,email,password[,role][,department][,teacher_id]")
+@click.option('--timetable', type=click.File('r', encoding='utf-8-sig'), help="teacher_id,day,session,status")
+@click.option('--department', help="Department for every roster row (default: the file's department column)")
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--hash-method', help="Werkzeug password hash method (default: IMPORT_HASH_METHOD, else Werkzeug's)")
+@click.option('--workers', type=int, help="Password hashing processes (default: IMPORT_HASH_WORKERS, one per CPU)")
+def import_teachers_command(roster, timetable, department, batch_size, hash_method, workers):
+    report = ImportReport()
+    if roster:
+        import_roster(db, roster, department, roles=("Teacher", "HOD"), report=report,
+                      batch_size=batch_size, hash_method=hash_method or current_app.config.get('IMPORT_HASH_METHOD')
+                      or current_app.config.get('PASSWORD_HASH_METHOD'),
+                      workers=workers or current_app.config['IMPORT_HASH_WORKERS'])
+    if timetable:
+        import_timetables(db, coverage_repair, timetable, department, report=report, batch_size=batch_size,
+                          notify=queue_repair_emails)
+    for line, message in report.errors:
+        print(f"line {line}: {message}")
+    print(f"Imported {report.teachers} user(s) and {report.timetables} timetable(s); {report.error_count} row error(s).")
+    if report.repair:
+        print(f"Bookings: {len(report.repair.reassigned)} reassigned, {len(report.repair.released)} released, "
+              f"{len(report.repair.uncovered)} left uncovered.")
+
+# Rebuild the coverage plan for every department now: flask plan-cover
+@cli.command('plan-cover')
+def plan_cover_command():
+    written = timetable_logic.planner.plan_all()
+    print(f"Wrote {written} coverage plan row(s) for the next {timetable_logic.planner.weeks} week(s).")
+
+# Rebuild the substitute cover counters from the leave history: flask backfill-cover-counts
+@cli.command('backfill-cover-counts')
+def backfill_cover_counts_command():
+    rows = timetable_logic.ranking.backfill()
+    print(f"Rebuilt {rows} weekly cover counter(s).")
+
+# Drop old calendar change log rows: flask prune-changes --days 7
+@cli.command('prune-changes')
+@click.option('--days', default=7, show_default=True)
+def prune_changes_command(days):
+    deleted = prune(db, days)
+    print(f"Deleted {deleted} change log row(s) older than {days} day(s).")
+
+# Move leaves and date-specific rows of months that ended ARCHIVE_AFTER_DAYS ago to the archive: flask archive
+@cli.command('archive')
+@click.option('--days', type=int, help="Archive months that ended at least this many days ago (default: ARCHIVE_AFTER_DAYS)")
+@click.option('--batch-size', default=200, show_default=True, help="Teachers per commit")
+def archive_command(days, batch_size):
+    cutoff = archive_cutoff(days if days is not None else current_app.config['ARCHIVE_AFTER_DAYS'])
+    leaves, overrides = archive(db, cutoff, batch_size=batch_size)
+    print(f"Archived {leaves} leave(s) and {overrides} date-specific timetable row(s) dated before {cutoff}.")
+
+# Regenerate the day-based timetables of whole departments, solved in parallel:
+#   flask generate-timetables --department CS --department Maths --days 5 --sessions 6 --seed 42
+@cli.command('generate-timetables')
+@click.option('--department', 'departments', multiple=True, help="Repeatable (default: every department)")
+@click.option('--days', default=5, show_default=True)
+@click.option('--sessions', default=5, show_default=True)
+@click.option('--seed', type=int, help="Job seed (default: random; printed so the run can be repeated)")
+@click.option('--workers', type=int, help="Solver processes (default: GENERATION_WORKERS or CPU count)")
+@click.option('--keep-existing', is_flag=True, help="Keep existing cells and fill in around them")
+def generate_timetables_command(departments, days, sessions, seed, workers, keep_existing):
+    if not departments:
+        departments = [row[0] for row in db.session.query(User.department).distinct().order_by(User.department)]
     try:
-        db.create_all()
-        print("Database tables created successfully.")
-    except Exception as e:
-        print(f"Error creating database tables: {e}")
+        job = generator.create_job(departments, days, sessions, seed=seed, keep_existing=keep_existing)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    print(f"Job {job.id}: {job.total} department(s), seed {job.seed}.")
+    job = generator.run(job.id, workers=workers, progress=lambda job: print(
+        f"  {job.done}/{job.total} department(s), {job.teachers} timetable(s)"
+    ))
+    elapsed = (job.finished_at - job.created_at).total_seconds()
+    print(f"Generated {job.teachers} timetable(s) in {elapsed:.1f}s; {job.shortfall} unmet session(s).")
+
+# Send every due outbox email now, on this process: flask drain-outbox
+@cli.command('drain-outbox')
+def drain_outbox_command():
+    sent = outbox.drain()
+    print(f"Processed {sent} notification(s).")
 
 # Root route: Redirect to login if not authenticated
-@app.route('/')
+@route('/')
 def index():
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
     return redirect(url_for('login'))
 
 # Registration route
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
-    from models import User
     if request.method == 'POST':
         username = request.form['username']
         email = request.form['email']
@@ -79,6 +408,7 @@ def register():
         new_hod = User(username=username, email=email, role="HOD", department=department)
         new_hod.set_password(password)
         db.session.add(new_hod)
+        schedule_touched(db.session, departments=[department])  # New substitute candidate
         db.session.commit()
 
         login_user(new_hod)
@@ -88,7 +418,7 @@ def register():
     return render_template('register.html')
 
 # Add Teacher route 
-@app.route('/add_teacher', methods=['GET', 'POST'])
+@route('/add_teacher', methods=['GET', 'POST'])
 @login_required
 def add_teacher():
     if current_user.role != "HOD":
@@ -115,6 +445,7 @@ def add_teacher():
         new_teacher = User(username=username, email=email, role="Teacher", department=department)
         new_teacher.set_password(password)
         db.session.add(new_teacher)
+        schedule_touched(db.session, departments=[department])  # New substitute candidate
         db.session.commit()
 
         flash(f'Teacher {username} added successfully!', 'success')
@@ -122,9 +453,48 @@ def add_teacher():
 
     return render_template('add_teacher.html')
 
+# Bulk onboarding for the HOD's department: roster and/or timetable CSV upload
+@route('/bulk_import', methods=['GET', 'POST'])
+@login_required
+def bulk_import():
+    if current_user.role != "HOD":
+        flash('Only HODs can import teachers.', 'danger')
+        return redirect(url_for('dashboard'))
+
+    if request.method == 'POST':
+        roster = request.files.get('roster')
+        timetable = request.files.get('timetable')
+        if not (roster and roster.filename) and not (timetable and timetable.filename):
+            flash('Choose a roster or timetable file.', 'danger')
+            return redirect(url_for('bulk_import'))
+
+        report = ImportReport()
+        try:
+            # Uploads are decoded line by line, never read into memory as a whole
+            if roster and roster.filename:
+                import_roster(db, codecs.iterdecode(roster.stream, 'utf-8-sig'), current_user.department,
+                              report=report,
+                              hash_method=current_app.config.get('IMPORT_HASH_METHOD') or current_app.config.get('PASSWORD_HASH_METHOD'),
+                              workers=current_app.config['IMPORT_HASH_WORKERS'])
+            if timetable and timetable.filename:
+                import_timetables(db, coverage_repair, codecs.iterdecode(timetable.stream, 'utf-8-sig'),
+                                  current_user.department, report=report, notify=queue_repair_emails)
+        except (ValueError, UnicodeDecodeError) as e:
+            db.session.rollback()
+            flash(f'Import failed: {e}', 'danger')
+            return redirect(url_for('bulk_import'))
+
+        outbox.wake()
+        flash(f'Imported {report.teachers} teacher(s) and {report.timetables} timetable(s).',
+              'success' if not report.error_count else 'warning')
+        flash_repair_report(report.repair)
+        return render_template('bulk_import.html', report=report)
+
+    return render_template('bulk_import.html', report=None)
+
 # Create Timetable route (Modified to generate and allow editing, with no session limit)
-@app.route('/create_timetable/<int:user_id>', methods=['GET', 'POST'])
-@app.route('/create_timetable', methods=['GET', 'POST'])
+@route('/create_timetable/<int:user_id>', methods=['GET', 'POST'])
+@route('/create_timetable', methods=['GET', 'POST'])
 @login_required
 def create_timetable(user_id=None):
     if current_user.role != "HOD":
@@ -189,34 +559,116 @@ def create_timetable(user_id=None):
 
         # Check if the form is submitting the edited timetable
         if 'save' in request.form:
-            # Clear existing day-based timetable for the user (preserve date-specific entries)
-            Timetable.query.filter_by(teacher_id=target_user.id, date=None).delete()
-
-            # Save the edited timetable based on checkbox inputs
+            # Build the edited timetable from the checkbox inputs
+            grid = {}
             for day in selected_days:
+                grid[day] = {}
                 for session in range(1, num_sessions + 1):
                     checkbox_name = f"busy-{day}-{session}"
-                    status = "Busy" if checkbox_name in request.form else "Free"
-                    entry = Timetable(
-                        teacher_id=target_user.id,
-                        day=day,
-                        session=session,
-                        status=status,
-                        date=None  # Day-based entry
-                    )
-                    db.session.add(entry)
+                    grid[day][session] = "Busy" if checkbox_name in request.form else "Free"
 
+            # Replace the day-based timetable (date-specific entries are preserved)
+            # Bookings the new grid breaks are repaired in the same transaction
+            _, repair_report = coverage_repair.save_grids({target_user.id: grid})
+            queue_repair_emails(repair_report)
             db.session.commit()
+            outbox.wake()
             flash(f'Timetable created/updated for {target_user.username}!', 'success')
+            flash_repair_report(repair_report)
             return redirect(url_for('dashboard'))
 
     return render_template('create_timetable.html', target_user=target_user)
 
+# Batch timetable save (HOD only): grids for many teachers of the department in one request.
+# JSON body: {"timetables": {"<teacher_id>": {"<day>": {"<session>": "Busy" | "Free"}}}}
+@route('/create_timetables', methods=['POST'])
+@login_required
+def create_timetables():
+    if current_user.role != "HOD":
+        return jsonify({'error': 'Only HODs can create timetables.'}), 403
+
+    data = request.get_json(silent=True) or {}
+    submitted = data.get('timetables')
+    if not isinstance(submitted, dict) or not submitted:
+        return jsonify({'error': 'Expected a "timetables" object keyed by teacher id.'}), 400
+
+    days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+    grids = {}
+    try:
+        for teacher_id, grid in submitted.items():
+            parsed = {}
+            for day, sessions in grid.items():
+                if day not in days:
+                    return jsonify({'error': f'Unknown day: {day}.'}), 400
+                parsed[day] = {}
+                for session, status in sessions.items():
+                    session = int(session)
+                    if session < 1 or session > 24:
+                        return jsonify({'error': 'Sessions must be between 1 and 24.'}), 400
+                    if status not in ("Busy", "Free"):
+                        return jsonify({'error': 'Status must be "Busy" or "Free".'}), 400
+                    parsed[day][session] = status
+            grids[int(teacher_id)] = parsed
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({'error': 'Malformed timetable grid.'}), 400
+
+    # Same rules as create_timetable: teachers of the HOD's department, or the HOD themselves
+    allowed = {
+        user.id for user in User.query.filter(
+            User.id.in_(list(grids)),
+            User.department == current_user.department,
+            User.role == "Teacher"
+        )
+    }
+    allowed.add(current_user.id)
+    rejected = sorted(set(grids) - allowed)
+    if rejected:
+        return jsonify({'error': 'You can only create timetables for teachers in your department.',
+                        'teacher_ids': rejected}), 403
+
+    changed, repair_report = coverage_repair.save_grids(grids)
+    queue_repair_emails(repair_report)
+    db.session.commit()
+    outbox.wake()
+    return jsonify({'saved': len(grids), 'cells_changed': changed})
+
+# Regenerate the whole department's day-based timetables in the background (HOD only).
+# JSON body: {"num_days": 5, "num_sessions": 5, "seed": 42, "keep_existing": false}, all optional.
+# Answers 202 with the job; poll the Location URL for progress.
+@route('/generate_timetables', methods=['POST'])
+@login_required
+def generate_timetables():
+    if current_user.role != "HOD":
+        return jsonify({'error': 'Only HODs can generate timetables.'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        seed = data.get('seed')
+        job = generator.create_job(
+            [current_user.department],
+            int(data.get('num_days', 5)),
+            int(data.get('num_sessions', 5)),
+            seed=int(seed) if seed is not None else None,
+            keep_existing=bool(data.get('keep_existing', False)),
+            created_by=current_user.id
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    generator.submit(job.id)
+    return jsonify(job_status(job)), 202, {'Location': url_for('generation_status', job_id=job.id)}
+
+@route('/generate_timetables/<int:job_id>')
+@login_required
+def generation_status(job_id):
+    job = db.session.get(GenerationJob, job_id)
+    if job is None or job.created_by != current_user.id:
+        return jsonify({'error': 'Job not found.'}), 404
+    return jsonify(job_status(job))
+
 # Reset Teacher Password (HOD only, restricted to their department)
-@app.route('/reset_teacher_password/<int:teacher_id>', methods=['POST'])
+@route('/reset_teacher_password/<int:teacher_id>', methods=['POST'])
 @login_required
 def reset_teacher_password(teacher_id):
-    from models import User
     if current_user.role != "HOD":
         flash('Only HODs can reset teacher passwords.', 'danger')
         return redirect(url_for('dashboard'))
@@ -235,15 +687,15 @@ def reset_teacher_password(teacher_id):
         return redirect(url_for('dashboard'))
 
     teacher.set_password(new_password)
+    user_touched(db.session, [teacher.id])
     db.session.commit()
     flash(f'Password reset for {teacher.username}.', 'success')
     return redirect(url_for('dashboard'))
 
 # Remove Teacher (HOD only, restricted to their department)
-@app.route('/remove_teacher/<int:teacher_id>', methods=['POST'])
+@route('/remove_teacher/<int:teacher_id>', methods=['POST'])
 @login_required
 def remove_teacher(teacher_id):
-    from models import User, Timetable, LeaveRequest
     if current_user.role != "HOD":
         flash('Only HODs can remove teachers.', 'danger')
         return redirect(url_for('dashboard'))
@@ -256,23 +708,34 @@ def remove_teacher(teacher_id):
         flash('You can only remove teachers in your department.', 'danger')
         return redirect(url_for('dashboard'))
 
-    Timetable.query.filter_by(teacher_id=teacher.id).delete()
-    LeaveRequest.query.filter_by(teacher_id=teacher.id).delete()
-    LeaveRequest.query.filter_by(substitute_id=teacher.id).delete()
-    db.session.delete(teacher)
+    # Upcoming leaves this teacher covered get new substitutes; bookings for their own leaves are released
+    username = teacher.username
+    user_touched(db.session, [teacher.id])
+    repair_report = coverage_repair.remove_teacher(teacher)
+    queue_repair_emails(repair_report)
     db.session.commit()
-    flash(f'Teacher {teacher.username} has been removed.', 'success')
+    outbox.wake()
+    flash(f'Teacher {username} has been removed.', 'success')
+    flash_repair_report(repair_report)
     return redirect(url_for('dashboard'))
 
 # Login route
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
-    from models import User
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
-        if user and user.check_password(password):
+        try:
+            valid = user is not None and passwords.verify(user.password_hash, password)
+            if valid and passwords.needs_rehash(user.password_hash):
+                # Transparently move the stored hash to the configured method
+                user.password_hash = passwords.rehash(password)
+                db.session.commit()
+        except LoginOverloaded:
+            flash('Too many sign-ins right now. Please try again in a moment.', 'warning')
+            return render_template('login.html'), 503
+        if valid:
             login_user(user)
             flash('Logged in successfully!', 'success')
             return redirect(url_for('dashboard'))
@@ -280,7 +743,7 @@ def login():
     return render_template('login.html')
 
 # Logout route
-@app.route('/logout')
+@route('/logout')
 @login_required
 def logout():
     logout_user()
@@ -288,83 +751,261 @@ def logout():
     return redirect(url_for('login'))
 
 # Dashboard route (Updated to show calendar)
-@app.route('/dashboard')
+@route('/dashboard')
 @login_required
 def dashboard():
-    from models import User, Timetable
     teachers = []
     if current_user.role == "HOD":
         teachers = User.query.filter_by(role="Teacher", department=current_user.department).all()
-    return render_template('dashboard.html', teachers=teachers)
+    # Calendar apps subscribe to this URL; it carries a signed token instead of needing a login
+    ical_url = url_for('ical_feed', token=feed_token(serializer, current_user), _external=True)
+    return render_template('dashboard.html', teachers=teachers, ical_url=ical_url)
+
+def versioned_json(teacher_ids, build):
+    # JSON built from the given teachers' calendar data, with ETag / Last-Modified from their data versions.
+    # A client whose copy is current gets 304 before build() runs, so no schedule table is read.
+    # Schedule cache entries are keyed on the persisted versions read inside build(), after the ETag's:
+    # a version newer than a cached entry's misses it, so the body is never older than the ETag.
+    etag, last_modified = validators(db, teacher_ids)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # Always revalidate; the answer is usually a 304
+    return response
+
+def leave_event(leave):
+    return {
+        'title': 'On Leave',
+        'start': leave.date.isoformat(),
+        'allDay': True,
+        'color': 'red'
+    }
 
 # Fetch leave events for the calendar
-@app.route('/get_leave_events')
+@route('/api/v1/leave_events')
+@route('/get_leave_events')
 @login_required
 def get_leave_events():
-    from models import LeaveRequest
-    leave_requests = LeaveRequest.query.filter_by(teacher_id=current_user.id).all()
-    events = [
-        {
-            'title': 'On Leave',
-            'start': leave.date.isoformat(),
-            'allDay': True,
-            'color': 'red'
-        } for leave in leave_requests
-    ]
-    return jsonify(events)
+    return versioned_json([current_user.id], lambda: [
+        leave_event(leave) for leave in LeaveRequest.query.filter_by(teacher_id=current_user.id).all()
+    ])
 
 # Fetch timetable for a specific date (Updated to prioritize date-specific entries)
-@app.route('/get_timetable')
+@route('/api/v1/timetable')
+@route('/get_timetable')
 @login_required
 def get_timetable():
-    from models import Timetable, LeaveRequest, User
     date_str = request.args.get('date')
     try:
         selected_date = datetime.strptime(date_str, '%Y-%m-%d').date()
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD.'}), 400
 
-    day_of_week = selected_date.strftime('%A')  # e.g., "Tuesday"
+    # Combine and prioritize entries: date-specific > leave requests > day-based
+    return versioned_json([current_user.id], lambda: timetable_logic.effective_schedule(
+        current_user.id, selected_date, selected_date
+    )[selected_date])
 
-    # Get day-based timetable entries
-    day_based_entries = Timetable.query.filter_by(teacher_id=current_user.id, day=day_of_week, date=None).all()
-    # Get date-specific timetable entries
-    date_specific_entries = Timetable.query.filter_by(teacher_id=current_user.id, date=selected_date).all()
-    # Get leave requests for the specific date
-    leave_requests = LeaveRequest.query.filter_by(teacher_id=current_user.id, date=selected_date).all()
-    on_leave_sessions = {leave.session: leave for leave in leave_requests}
+def parse_date_window(args):
+    # (start, end) from ?start=&end= (YYYY-MM-DD); raises ValueError with a message for the client
+    try:
+        start_date = datetime.strptime(args.get('start', ''), '%Y-%m-%d').date()
+        end_date = datetime.strptime(args.get('end', ''), '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('Invalid date format. Use YYYY-MM-DD.')
+    if end_date < start_date:
+        raise ValueError('End date must not be before start date.')
+    if (end_date - start_date).days + 1 > current_app.config.get('SCHEDULE_RANGE_MAX_DAYS', 62):
+        raise ValueError('Date range is too long.')
+    return start_date, end_date
+
+# Fetch the resolved timetable for a whole date window (e.g. the visible calendar month) in one round trip
+@route('/api/v1/timetable_range')
+@route('/get_timetable_range')
+@login_required
+def get_timetable_range():
+    try:
+        start_date, end_date = parse_date_window(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def build():
+        schedule = timetable_logic.effective_schedule(current_user.id, start_date, end_date)
+        return {date.isoformat(): entries for date, entries in schedule.items()}
+    return versioned_json([current_user.id], build)
+
+# iCalendar subscription feed of a teacher's schedule, leaves and covers from ICAL_PAST_DAYS ago to
+# ICAL_FUTURE_DAYS ahead. Calendar clients poll it without a session; a poll that finds the teacher's
+# data version unchanged is answered 304 after one small query.
+@route('/calendar/<token>.ics')
+def ical_feed(token):
+    try:
+        user_id, version = feed_identity(serializer, token, current_app.config['ICAL_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return jsonify({'error': 'Invalid or expired calendar link.'}), 404
+    teacher = user_cache.load(user_id, lambda user_id: db.session.get(User, user_id))
+    if teacher is None or teacher.feed_version != version:  # Removed user, or a link revoked from the dashboard
+        return jsonify({'error': 'Invalid or expired calendar link.'}), 404
+
+    today = date_type.today()
+    start_date = today - timedelta(days=current_app.config.get('ICAL_PAST_DAYS', 30))
+    end_date = today + timedelta(days=current_app.config.get('ICAL_FUTURE_DAYS', 180))
+    etag, last_modified = validators(db, [teacher.id])
+    etag = f"{etag}-{start_date.isoformat()}"  # The window moves forward every day
+    window_moved = datetime.combine(today, datetime.min.time())
+    last_modified = max(last_modified, window_moved) if last_modified else window_moved
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        db.session.close()  # The stream reads in its own transactions, one window at a time
+        response = Response(stream_with_context(calendar_stream(
+            db, timetable_logic.store, teacher, start_date, end_date, last_modified,
+            day_start=current_app.config.get('ICAL_DAY_START', '08:00'),
+            session_minutes=current_app.config.get('ICAL_SESSION_MINUTES', 60),
+            chunk_days=current_app.config.get('ICAL_CHUNK_DAYS', 31)
+        )), mimetype='text/calendar', headers={
+            'Content-Disposition': f'inline; filename="{teacher.username}.ics"'
+        })
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# Replace the signed-in user's calendar feed link; every link handed out before stops working
+@route('/rotate_calendar_link', methods=['POST'])
+@login_required
+def rotate_calendar_link():
+    User.query.filter_by(id=current_user.id).update({'feed_version': User.feed_version + 1})
+    user_touched(db.session, [current_user.id])
+    db.session.commit()
+    flash('Your calendar link has been replaced. Subscribe again with the new link below.', 'success')
+    return redirect(url_for('dashboard'))
 
-    # Combine and prioritize entries: date-specific > leave requests > day-based
-    timetable_data = []
-    all_sessions = set(entry.session for entry in day_based_entries + date_specific_entries)
-    for session in sorted(all_sessions):
-        # Check date-specific entry first
-        date_entry = next((entry for entry in date_specific_entries if entry.session == session), None)
-        if date_entry:
-            status = date_entry.status
-            substitute = None
-        # Check leave request next
-        elif session in on_leave_sessions:
-            status = 'On Leave'
-            leave = on_leave_sessions[session]
-            substitute = User.query.get(leave.substitute_id).username if leave.substitute_id else None
-        # Fall back to day-based entry
+# Live calendar updates as server-sent events. Each event names what changed for the user
+# ({"kinds": [...], "dates": [...]}); a "reset" event asks the client to reload everything.
+# Reconnects resume after the Last-Event-ID header (or ?last_event_id=).
+@route('/api/v1/changes')
+@login_required
+def change_stream():
+    user_id = current_user.id
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        cursor = None
+
+    # Open streams wait on the hub's shared broadcast condition. CHANGE_MAX_STREAMS only guards against
+    # overload: past it this process answers 503 and the dashboard reconnects later.
+    hub = services().change_hub  # The stream outlives the app context, so hold the hub itself
+    subscription = hub.subscribe(user_id, current_app.config.get('CHANGE_MAX_STREAMS', 1000))
+    if subscription is None:
+        response = jsonify({'error': 'Too many open change streams; try again later.'})
+        response.status_code = 503
+        response.retry_after = current_app.config.get('CHANGE_OVERLOAD_RETRY', 30)
+        return response
+    try:
+        if cursor is None:
+            backlog, complete, cursor = [], True, head_id(db)
         else:
-            day_entry = next((entry for entry in day_based_entries if entry.session == session), None)
-            status = day_entry.status if day_entry else "Free"
-            substitute = None
-        timetable_data.append({
-            'session': session,
-            'status': status,
-            'substitute': substitute
-        })
-    return jsonify(timetable_data)
+            backlog, complete = replay(db, user_id, cursor, current_app.config.get('CHANGE_REPLAY_LIMIT', 500))
+            if not complete:
+                cursor = head_id(db)
+    except Exception:
+        hub.unsubscribe(subscription)
+        raise
+    heartbeat = current_app.config.get('CHANGE_HEARTBEAT', 15)
+    db.session.close()
+
+    # Runs after the request context is gone: no session or connection is held while the stream idles
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            last_sent = cursor
+            yield format_event(last_sent, "reset", {}) if not complete else format_event(last_sent)
+            for change_id, payload in backlog:
+                last_sent = change_id
+                yield format_event(change_id, "change", payload)
+            # The hub hands over each row once, but rows committed during the replay come from both
+            replayed = {change_id for change_id, _ in backlog}
+            while not subscription.overflowed:
+                changes = hub.wait(subscription, heartbeat)
+                for change_id, payload in changes:
+                    if change_id in replayed:
+                        continue
+                    # A row that committed late can have a lower id than one already sent; the event
+                    # carries the highest id so the client's Last-Event-ID never moves back
+                    last_sent = max(last_sent, change_id)
+                    yield format_event(last_sent, "change", payload)
+                if not changes and not subscription.overflowed:
+                    yield ": keepalive\n\n"
+            yield format_event(last_sent, "reset", {})
+        finally:
+            hub.unsubscribe(subscription)
+
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Let nginx pass events through unbuffered
+    })
+    response.call_on_close(lambda: hub.unsubscribe(subscription))  # Also when the stream never started
+    return response
+
+# Leave events and resolved schedules of several teachers in one response, for the HOD dashboard:
+#   /api/v1/calendar?start=YYYY-MM-DD&end=YYYY-MM-DD[&teachers=1,2,3]
+# HODs may ask for any members of their department (default: all of them); teachers only for themselves.
+@route('/api/v1/calendar')
+@login_required
+def calendar_batch():
+    try:
+        start_date, end_date = parse_date_window(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        requested = [int(value) for value in request.args.get('teachers', '').split(',') if value.strip()]
+    except ValueError:
+        return jsonify({'error': 'teachers must be a comma-separated list of ids.'}), 400
+
+    if current_user.role == "HOD":
+        members = {row[0] for row in db.session.query(User.id).filter(
+            User.department == current_user.department, User.role.in_(["Teacher", "HOD"])
+        )}
+        teacher_ids = requested or sorted(members)
+        if not set(teacher_ids) <= members:
+            return jsonify({'error': 'Teachers must be members of your department.'}), 403
+    else:
+        teacher_ids = requested or [current_user.id]
+        if teacher_ids != [current_user.id]:
+            return jsonify({'error': 'Teachers can only view their own calendar.'}), 403
+    if len(teacher_ids) > current_app.config.get('CALENDAR_BATCH_MAX_TEACHERS', 100):
+        return jsonify({'error': 'Too many teachers.'}), 400
+
+    def build():
+        names = dict(db.session.query(User.id, User.username).filter(User.id.in_(teacher_ids)))
+        calendars = {
+            teacher_id: {'id': teacher_id, 'username': names.get(teacher_id), 'events': [], 'schedule': {}}
+            for teacher_id in teacher_ids
+        }
+        for leave in LeaveRequest.query.filter(
+            LeaveRequest.teacher_id.in_(teacher_ids),
+            LeaveRequest.date >= start_date,
+            LeaveRequest.date <= end_date
+        ).order_by(LeaveRequest.date, LeaveRequest.session):
+            calendars[leave.teacher_id]['events'].append(leave_event(leave))
+        for teacher_id in teacher_ids:
+            schedule = timetable_logic.effective_schedule(teacher_id, start_date, end_date)
+            calendars[teacher_id]['schedule'] = {date.isoformat(): entries for date, entries in schedule.items()}
+        return {'teachers': [calendars[teacher_id] for teacher_id in teacher_ids]}
+    return versioned_json(teacher_ids, build)
 
 # Apply Leave route (Updated to handle date-specific assignments)
-@app.route('/apply_leave', methods=['POST'])
+@route('/apply_leave', methods=['POST'])
 @login_required
 def apply_leave():
-    from models import User, Timetable, LeaveRequest
     if current_user.role not in ["Teacher", "HOD"]:
         flash('Only teachers and HODs can apply for leave.', 'danger')
         return redirect(url_for('dashboard'))
@@ -380,13 +1021,7 @@ def apply_leave():
     day_of_week = selected_date.strftime('%A')
 
     # Check if the user is busy on that day
-    day_entry = Timetable.query.filter_by(
-        teacher_id=current_user.id,
-        day=day_of_week,
-        session=session,
-        date=None
-    ).first()
-    if not day_entry or day_entry.status != "Busy":
+    if timetable_logic.store.status(current_user.id, day_of_week, session) != "Busy":
         flash('You are not scheduled for that session on that day.', 'warning')
         return redirect(url_for('dashboard'))
 
@@ -395,58 +1030,223 @@ def apply_leave():
         flash('Leave already requested for that date and session.', 'warning')
         return redirect(url_for('dashboard'))
 
-    # Find a substitute using TimetableLogic
-    substitute = timetable_logic.assign_substitute(current_user.id, selected_date, session)
+    # Find a substitute using TimetableLogic; the booking is committed together with the notifications
+    substitute = timetable_logic.assign_substitute(current_user.id, selected_date, session, commit=False)
     if not substitute:
+        db.session.rollback()
         flash('No substitute available.', 'danger')
         return redirect(url_for('dashboard'))
 
-    # Notify HOD and substitute
+    # Notify HOD and substitute through the outbox
     if current_user.role == "Teacher":
         hod = User.query.filter_by(role="HOD", department=current_user.department).first()
         if hod:
-            msg = Message("New Leave Request", sender=app.config['MAIL_USERNAME'], recipients=[hod.email])
-            msg.body = f"Teacher {current_user.username} requested leave on {selected_date}, session {session}."
-            try:
-                mail.send(msg)
-            except Exception as e:
-                flash('Leave request submitted, but email notification to HOD failed.', 'warning')
+            queue_email(db, "New Leave Request", [hod.email],
+                        f"Teacher {current_user.username} requested leave on {selected_date}, session {session}.",
+                        sender=current_app.config['MAIL_USERNAME'])
     else:
         other_hod = User.query.filter_by(role="HOD", department=current_user.department).filter(User.id != current_user.id).first()
         if other_hod:
-            msg = Message("New Leave Request", sender=app.config['MAIL_USERNAME'], recipients=[other_hod.email])
-            msg.body = f"HOD {current_user.username} requested leave on {selected_date}, session {session}."
-            try:
-                mail.send(msg)
-            except Exception as e:
-                flash('Leave request submitted, but email notification to other HOD failed.', 'warning')
+            queue_email(db, "New Leave Request", [other_hod.email],
+                        f"HOD {current_user.username} requested leave on {selected_date}, session {session}.",
+                        sender=current_app.config['MAIL_USERNAME'])
 
-    msg_sub = Message("Substitute Assignment", sender=app.config['MAIL_USERNAME'], recipients=[substitute.email])
-    msg_sub.body = f"You are substituting for {current_user.username} on {selected_date}, session {session}."
-    try:
-        mail.send(msg_sub)
-    except Exception as e:
-        flash('Leave request submitted, but email notification to substitute failed.', 'warning')
+    queue_email(db, "Substitute Assignment", [substitute.email],
+                f"You are substituting for {current_user.username} on {selected_date}, session {session}.",
+                sender=current_app.config['MAIL_USERNAME'])
+    db.session.commit()
+    outbox.wake()
 
     flash('Leave request submitted successfully!', 'success')
     return redirect(url_for('dashboard'))
 
+# Bulk leave route: a date range, an optional session set and (for HODs) several teachers at once
+@route('/apply_leave_bulk', methods=['POST'])
+@login_required
+def apply_leave_bulk():
+    data = request.get_json(silent=True)
+    wants_json = data is not None
+    if data is None:
+        data = {
+            'start_date': request.form.get('start_date'),
+            'end_date': request.form.get('end_date') or request.form.get('start_date'),
+            'sessions': [part for value in request.form.getlist('sessions') for part in value.split(',')],
+            'teacher_ids': request.form.getlist('teacher_ids'),
+        }
+
+    def fail(message, status=400):
+        if wants_json:
+            return jsonify({'error': message}), status
+        flash(message, 'danger')
+        return redirect(url_for('dashboard'))
+
+    if current_user.role not in ["Teacher", "HOD"]:
+        return fail('Only teachers and HODs can apply for leave.', 403)
+
+    try:
+        start_date = datetime.strptime(data.get('start_date') or '', '%Y-%m-%d').date()
+        end_date = datetime.strptime(data.get('end_date') or data.get('start_date') or '', '%Y-%m-%d').date()
+    except ValueError:
+        return fail('Invalid date format. Use YYYY-MM-DD.')
+    try:
+        sessions = sorted({int(session) for session in data.get('sessions') or [] if str(session).strip()})
+        teacher_ids = [int(teacher_id) for teacher_id in data.get('teacher_ids') or [] if str(teacher_id).strip()]
+    except ValueError:
+        return fail('Sessions and teacher ids must be numbers.')
+    if any(session < 1 or session > 24 for session in sessions):
+        return fail('Sessions must be between 1 and 24.')
+
+    # Teachers apply for themselves; HODs may file for several teachers of their department
+    if not teacher_ids:
+        teacher_ids = [current_user.id]
+    if teacher_ids != [current_user.id]:
+        if current_user.role != "HOD":
+            return fail('Only HODs can apply for leave on behalf of other teachers.', 403)
+        in_department = User.query.filter(User.id.in_(teacher_ids), User.department == current_user.department).count()
+        if in_department != len(set(teacher_ids)):
+            return fail('You can only apply for leave for teachers in your department.', 403)
+
+    try:
+        result = timetable_logic.assign_substitutes_bulk(teacher_ids, start_date, end_date, sessions or None, commit=False)
+    except ValueError as e:
+        db.session.rollback()
+        return fail(str(e))
+
+    # One summary email per substitute and one for the HOD, committed with the leaves
+    users = {user.id: user for user in User.query.filter(
+        User.id.in_(set(teacher_ids) | {item[3] for item in result['covered']})
+    )}
+    by_substitute = {}
+    for teacher_id, date, session, substitute_id in result['covered']:
+        by_substitute.setdefault(substitute_id, []).append(f"{users[teacher_id].username} on {date}, session {session}")
+    for substitute_id, lines in by_substitute.items():
+        queue_email(db, "Substitute Assignment", [users[substitute_id].email],
+                    "You are substituting for:\n" + "\n".join(lines), sender=current_app.config['MAIL_USERNAME'])
+    if result['covered'] or result['uncovered']:
+        hod = User.query.filter_by(role="HOD", department=current_user.department).filter(User.id != current_user.id).first()
+        if hod:
+            queue_email(db, "New Leave Request", [hod.email],
+                        f"{current_user.username} filed leave from {start_date} to {end_date}: "
+                        f"{len(result['covered'])} sessions covered, {len(result['uncovered'])} without a substitute.",
+                        sender=current_app.config['MAIL_USERNAME'])
+    db.session.commit()
+    outbox.wake()
+
+    if wants_json:
+        return jsonify({
+            'covered': [
+                {'teacher_id': teacher_id, 'date': date.isoformat(), 'session': session, 'substitute_id': substitute_id}
+                for teacher_id, date, session, substitute_id in result['covered']
+            ],
+            'uncovered': [
+                {'teacher_id': teacher_id, 'date': date.isoformat(), 'session': session}
+                for teacher_id, date, session in result['uncovered']
+            ],
+        })
+
+    if not result['covered'] and not result['uncovered']:
+        flash('No scheduled sessions need leave in that range.', 'warning')
+        return redirect(url_for('dashboard'))
+    if result['uncovered']:
+        flash(f"{len(result['uncovered'])} session(s) could not be covered by a substitute.", 'warning')
+    flash(f"Leave submitted for {len(result['covered']) + len(result['uncovered'])} session(s).", 'success')
+    return redirect(url_for('dashboard'))
+
 # Report route (HOD only, show leave requests from their department)
-@app.route('/report')
+@route('/report')
 @login_required
 def report():
-    from models import User, LeaveRequest
     if current_user.role != "HOD":
         flash('Only HODs can view reports.', 'danger')
         return redirect(url_for('dashboard'))
 
-    leaves = LeaveRequest.query.join(User, LeaveRequest.teacher_id == User.id).filter(User.department == current_user.department).all()
-    return render_template('report.html', leaves=leaves)
+    try:
+        filters = parse_filters(request.args)
+        leaves, next_cursor = report_page(
+            db, current_user.department, current_app.config.get('REPORT_PAGE_SIZE', 100),
+            after=request.args.get('after'), **filters
+        )
+    except ValueError as e:
+        flash(f'Invalid report filter: {e}', 'danger')
+        return redirect(url_for('report'))
+
+    teachers = User.query.filter_by(department=current_user.department).order_by(User.username).all()
+    # Filter values carried over to the pagination and export links
+    filter_args = {key: request.args[key] for key in ('start', 'end', 'teacher') if request.args.get(key)}
+    return render_template('report.html', leaves=leaves, next_cursor=next_cursor, teachers=teachers,
+                           filter_args=filter_args, paged=bool(request.args.get('after')))
+
+# Streaming export of the filtered report: /report/export?format=csv|json&start=&end=&teacher=
+@route('/report/export')
+@login_required
+def export_report():
+    if current_user.role != "HOD":
+        flash('Only HODs can view reports.', 'danger')
+        return redirect(url_for('dashboard'))
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'json'):
+        return jsonify({'error': 'Format must be csv or json.'}), 400
+    try:
+        filters = parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    rows = export_rows(db, current_user.department, **filters)
+    if export_format == 'csv':
+        body, mimetype = csv_stream(rows), 'text/csv'
+    else:
+        body, mimetype = json_stream(rows), 'application/json'
+    # The generator runs after the view returns; stream_with_context keeps the app context and session alive
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=leave_report.{export_format}'
+    })
+
+def analytics_since():
+    # Leaves older than ANALYTICS_LEAVE_DAYS (0 = all) are left out of the leave and cover counts
+    return leave_window_start(current_app.config.get('ANALYTICS_LEAVE_DAYS', 365))
+
+def load_analytics(department):
+    return DepartmentData.load(db, timetable_logic.store, department, since=analytics_since())
+
+# Department analytics (HOD only): utilisation, free capacity, leave frequency and substitute load
+@route('/analytics')
+@login_required
+def analytics():
+    if current_user.role != "HOD":
+        flash('Only HODs can view analytics.', 'danger')
+        return redirect(url_for('dashboard'))
+    data = load_analytics(current_user.department)
+    if request.args.get('format') == 'json':
+        return jsonify(data.summary())
+    return render_template('analytics.html', summary=data.summary(), charts=CHARTS,
+                           version=data_version(db, current_user.department, analytics_since()))
+
+# Chart PNGs, served from chart_cache. The data version doubles as the ETag, so a revalidation is
+# answered 304 from the DataVersion rows without loading or rendering anything.
+@route('/analytics/<chart>.png')
+@login_required
+def analytics_chart(chart):
+    if current_user.role != "HOD":
+        return jsonify({'error': 'Only HODs can view analytics.'}), 403
+    if chart not in CHARTS:
+        return jsonify({'error': f'Unknown chart: {chart}'}), 404
+    department = current_user.department
+    version = data_version(db, department, analytics_since())
+    etag = f"{department}-{chart}-{version}"
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+    else:
+        response = Response(chart_cache.get(department, chart, version,
+                                            lambda: render_chart(load_analytics(department), chart)),
+                            mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # Revalidate each time: cheap 304 until the data changes
+    return response.make_conditional(request)
 
 # Password reset request route
-@app.route('/reset_password_request', methods=['GET', 'POST'])
+@route('/reset_password_request', methods=['GET', 'POST'])
 def reset_password_request():
-    from models import User
     if request.method == 'POST':
         email = request.form['email']
         user = User.query.filter_by(email=email).first()
@@ -456,22 +1256,20 @@ def reset_password_request():
                 return redirect(url_for('login'))
             token = serializer.dumps(user.id, salt='password-reset-salt')
             reset_url = url_for('reset_password', token=token, _external=True)
-            msg = Message("Password Reset Request", sender=app.config['MAIL_USERNAME'], recipients=[email])
-            msg.body = f"To reset your password, visit this link: {reset_url}\nThis link will expire in 1 hour."
-            try:
-                mail.send(msg)
-                flash('An email has been sent with instructions to reset your password.', 'success')
-            except Exception as e:
-                flash('Failed to send reset email. Please try again later.', 'danger')
+            queue_email(db, "Password Reset Request", [email],
+                        f"To reset your password, visit this link: {reset_url}\nThis link will expire in 1 hour.",
+                        sender=current_app.config['MAIL_USERNAME'])
+            db.session.commit()
+            outbox.wake()
+            flash('An email has been sent with instructions to reset your password.', 'success')
         else:
             flash('No account found with that email address.', 'danger')
         return redirect(url_for('login'))
     return render_template('reset_password_request.html')
 
 # Password reset route
-@app.route('/reset_password/<token>', methods=['GET', 'POST'])
+@route('/reset_password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
-    from models import User
     try:
         user_id = serializer.loads(token, salt='password-reset-salt', max_age=3600)
         user = User.query.get(user_id)
@@ -486,10 +1284,15 @@ def reset_password(token):
     if request.method == 'POST':
         password = request.form['password']
         user.set_password(password)
+        user_touched(db.session, [user.id])
         db.session.commit()
         flash('Your password has been updated! Please log in.', 'success')
         return redirect(url_for('login'))
     return render_template('reset_password.html')
 
 if __name__ == '__main__':
+    # Development server: create or upgrade the schema, then serve
+    app = create_app()
+    with app.app_context():
+        upgrade_database(db)
     app.run(debug=True)
@@ -0,0 +1,154 @@
+# generation.py
+import multiprocessing
+import os
+import queue
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from models import GenerationJob
+from solver import department_seed, solve_department
+
+# Batch timetable generation, e.g. every department at the start of a term.
+# Each department is one solve. Its inputs are read up front, the solves run on a process pool,
+# and each result is written as soon as it arrives: one bulk save (with booking repair) and one
+# commit per department. Department seeds derive from the job seed, so re-running a job with the
+# same seed gives the same timetables whatever the number of workers (as long as no solve runs
+# into SOLVER_TIME_BUDGET).
+
+
+def job_status(job):
+    return {
+        'id': job.id,
+        'status': job.status,
+        'departments': job.departments.split(","),
+        'done': job.done,
+        'total': job.total,
+        'teachers': job.teachers,
+        'shortfall': job.shortfall,
+        'seed': job.seed,
+        'error': job.error,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+class BatchGenerator:
+    # Creates and runs GenerationJob rows. run() works through a job in the calling process (the CLI);
+    # submit() hands it to this process's background thread (the async endpoint).
+    def __init__(self, app, db, logic, repair, notify=None):
+        self.app = app
+        self.db = db
+        self.logic = logic
+        self.repair = repair
+        self.notify = notify  # notify(RepairReport) before each department commits, e.g. to queue emails
+        self.workers = app.config.get('GENERATION_WORKERS') or os.cpu_count() or 1
+        # A solve takes roughly 0.1ms per teacher, so small jobs are solved in this process: starting
+        # the pool would cost more than it saves. Writing the results is the same either way.
+        self.pool_min_teachers = app.config.get('GENERATION_POOL_MIN_TEACHERS', 2000)
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def create_job(self, departments, num_days, num_sessions, seed=None, keep_existing=False, created_by=None):
+        if num_days < 1 or num_days > len(self.logic.days):
+            raise ValueError("Number of days must be between 1 and 7.")
+        if num_sessions < 1 or num_sessions > 24:
+            raise ValueError("Number of sessions must be between 1 and 24.")
+        departments = list(dict.fromkeys(department for department in departments if department))
+        if not departments:
+            raise ValueError("No departments to generate.")
+        if seed is None:
+            seed = random.SystemRandom().randrange(2 ** 62)  # Recorded on the job, so the run can be repeated
+        job = GenerationJob(
+            status="queued",
+            departments=",".join(departments),
+            num_days=num_days,
+            num_sessions=num_sessions,
+            seed=seed,
+            keep_existing=keep_existing,
+            total=len(departments),
+            done=0,
+            teachers=0,
+            shortfall=0,
+            created_by=created_by,
+            created_at=datetime.utcnow()
+        )
+        self.db.session.add(job)
+        self.db.session.commit()
+        return job
+
+    def submit(self, job_id):
+        self._jobs.put(job_id)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="timetable-generator", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        # Jobs run one after another; each already spreads its departments over the pool
+        while True:
+            job_id = self._jobs.get()
+            with self.app.app_context():
+                try:
+                    self.run(job_id)
+                except Exception as e:
+                    self.app.logger.exception("Timetable generation job %s failed: %s", job_id, e)
+
+    def run(self, job_id, workers=None, progress=None):
+        # Work through the job in this process; progress(job) is called after every department.
+        # workers overrides the pool size (1 solves in this process). Returns the job.
+        # A failure is recorded on the job and re-raised.
+        job = self.db.session.get(GenerationJob, job_id)
+        job.status = "running"
+        self.db.session.commit()
+        try:
+            tasks = [
+                self.logic.department_task(department, job.num_days, job.num_sessions,
+                                           seed=department_seed(job.seed, department),
+                                           keep_existing=job.keep_existing)
+                for department in job.departments.split(",")
+            ]
+            self.db.session.commit()  # End the read transaction while the solves run
+            # Largest departments first, so the pool does not end up waiting on one big straggler
+            tasks.sort(key=lambda task: len(task.teacher_ids), reverse=True)
+            if workers is None and sum(len(task.teacher_ids) for task in tasks) < self.pool_min_teachers:
+                workers = 1
+            workers = max(1, min(workers or self.workers, len(tasks)))
+            if workers == 1:
+                for task in tasks:
+                    self._save(job, task, solve_department(task))
+                    if progress:
+                        progress(job)
+            else:
+                # spawn, not fork: this process may have other threads (outbox, planner) running
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    futures = {executor.submit(solve_department, task): task for task in tasks}
+                    for future in as_completed(futures):
+                        self._save(job, futures[future], future.result())
+                        if progress:
+                            progress(job)
+            job.status = "done"
+            job.finished_at = datetime.utcnow()
+            self.db.session.commit()
+        except Exception as e:
+            self.db.session.rollback()
+            job = self.db.session.get(GenerationJob, job_id)
+            job.status = "failed"
+            job.error = str(e)
+            job.finished_at = datetime.utcnow()
+            self.db.session.commit()
+            raise
+        return job
+
+    def _save(self, job, task, result):
+        # One department's timetables, the bookings they break and the job's progress, in one commit
+        grids = {teacher_id: result.statuses(teacher_id) for teacher_id in task.teacher_ids}
+        if grids:
+            _, report = self.repair.save_grids(grids)
+            if self.notify:
+                self.notify(report)
+        job.done += 1
+        job.teachers += len(grids)
+        job.shortfall += sum(result.shortfall.values()) + sum(result.slot_shortfall.values())
+        self.db.session.commit()
@@ -0,0 +1,121 @@
+# ical.py
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from models import User, LeaveRequest
+from schedule import resolve_schedule
+
+# Per-teacher iCalendar subscription feed of the effective schedule (the same precedence as
+# get_timetable: date-specific > leave > day-based), plus the covers the teacher was booked for.
+# The feed is written as it is read, a window of days at a time, so a long horizon never sits in
+# memory as a whole. Sessions have no clock times in this app; session n is placed at
+# ICAL_DAY_START + (n - 1) * ICAL_SESSION_MINUTES.
+
+TOKEN_SALT = 'ical-feed'
+
+
+def feed_token(serializer, user):
+    # The link signs the user's feed version with their id: bumping User.feed_version revokes every earlier link
+    return serializer.dumps([user.id, user.feed_version], salt=TOKEN_SALT)
+
+
+def feed_identity(serializer, token, max_age=None):
+    # (user id, feed version) signed into the token; raises itsdangerous.BadSignature (or SignatureExpired).
+    # Links made before feed versions existed carry the bare id and count as version 0.
+    payload = serializer.loads(token, salt=TOKEN_SALT, max_age=max_age)
+    if isinstance(payload, int):
+        return payload, 0
+    user_id, version = payload
+    return user_id, version
+
+
+def escape(text):
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def fold(line):
+    # Content lines are limited to 75 octets; longer ones continue on lines starting with a space
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts, start, limit = [], 0, 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1  # Never split a UTF-8 sequence
+        parts.append(encoded[start:end].decode())
+        start, limit = end, 74
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def _event(uid, stamp, begins, minutes, summary, description=None):
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{uid}",
+        f"DTSTAMP:{stamp:%Y%m%dT%H%M%SZ}",
+        f"DTSTART:{begins:%Y%m%dT%H%M%S}",
+        f"DTEND:{begins + timedelta(minutes=minutes):%Y%m%dT%H%M%S}",
+        f"SUMMARY:{escape(summary)}",
+    ]
+    if description:
+        lines.append(f"DESCRIPTION:{escape(description)}")
+    lines.append("END:VEVENT")
+    return "".join(fold(line) for line in lines)
+
+
+def covers(db, teacher_id, start_date, end_date):
+    # {(date, session): absent teacher's username} for the covers booked for the teacher
+    return {
+        (date, session): username
+        for date, session, username in db.session.execute(
+            select(LeaveRequest.date, LeaveRequest.session, User.username)
+            .join(User, LeaveRequest.teacher_id == User.id)
+            .where(LeaveRequest.substitute_id == teacher_id,
+                   LeaveRequest.date >= start_date, LeaveRequest.date <= end_date)
+        )
+    }
+
+
+def calendar_stream(db, store, teacher, start_date, end_date, stamp, day_start="08:00", session_minutes=60,
+                    chunk_days=31):
+    # Yields the VCALENDAR text for the teacher's Busy, On Leave and cover sessions in [start_date, end_date].
+    # stamp (UTC datetime) is the DTSTAMP of every event, so an unchanged schedule gives identical output.
+    hours, minutes = (int(part) for part in day_start.split(":"))
+    yield "".join(fold(line) for line in [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Teachers Timetable Generator//Schedule feed//EN",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{escape(teacher.username)} timetable",
+    ])
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+        covering = covers(db, teacher.id, chunk_start, chunk_end)
+        events = []
+        for date, entries in resolve_schedule(teacher.id, chunk_start, chunk_end, store).items():
+            first_session = datetime(date.year, date.month, date.day, hours, minutes)
+            for entry in entries:
+                session = entry['session']
+                if entry['status'] == "On Leave":
+                    summary = f"Session {session}: on leave"
+                    description = (f"Covered by {entry['substitute']}" if entry['substitute']
+                                   else "No substitute assigned")
+                elif (date, session) in covering:
+                    summary = f"Session {session}: covering for {covering[(date, session)]}"
+                    description = None
+                elif entry['status'] == "Busy":
+                    summary = f"Session {session}: class"
+                    description = None
+                else:
+                    continue
+                events.append(_event(
+                    f"{teacher.id}-{date:%Y%m%d}-{session}@timetable", stamp,
+                    first_session + timedelta(minutes=(session - 1) * session_minutes), session_minutes,
+                    summary, description
+                ))
+        db.session.close()  # Hand the connection back while the client reads this window
+        if events:
+            yield "".join(events)
+        chunk_start = chunk_end + timedelta(days=1)
+    yield fold("END:VCALENDAR")
@@ -0,0 +1,229 @@
+# instrumentation.py
+import functools
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context, has_request_context, request, Response
+from sqlalchemy import event
+
+# Latency buckets in seconds (Prometheus convention)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    # Minimal thread-safe counter/histogram store rendered in the Prometheus text format
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, labels=(), amount=1):
+        with self._lock:
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            key = (name, labels)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted({key[0] for key in self._counters}):
+                lines += self._header(name, "counter")
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+            for name in sorted({key[0] for key in self._histograms}):
+                lines += self._header(name, "histogram")
+                for (metric, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.total}")
+                    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram.total}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name, kind):
+        header = []
+        if name in self._help:
+            header.append(f"# HELP {name} {self._help[name]}")
+        header.append(f"# TYPE {name} {kind}")
+        return header
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def new_registry():
+    metrics = MetricsRegistry()
+    metrics.describe("http_request_duration_seconds", "Request latency by endpoint.")
+    metrics.describe("http_request_sql_queries_total", "SQL statements issued while serving requests.")
+    metrics.describe("http_request_sql_seconds_total", "Time spent in SQL while serving requests.")
+    metrics.describe("http_slow_requests_total", "Requests slower than SLOW_REQUEST_MS.")
+    metrics.describe("sql_queries_total", "SQL statements issued outside requests (workers, CLI).")
+    metrics.describe("span_duration_seconds", "Duration of instrumented operations.")
+    return metrics
+
+
+class Instrumentation:
+    # Metrics of one app, kept in app.extensions['instrumentation'] (only when METRICS_ENABLED), so two
+    # apps in one process (e.g. the query_plans walk next to the served app) never share settings or counters
+    def __init__(self, app):
+        self.metrics = new_registry()
+        self.slow_ms = app.config.get('SLOW_REQUEST_MS', 500)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        elapsed = time.perf_counter() - started
+        if has_request_context() and hasattr(g, "instrumentation"):
+            data = g.instrumentation
+            data["sql_count"] += 1
+            data["sql_time"] += elapsed
+            # Aggregate by statement text so a N+1 loop shows up as one line with a large count
+            key = " ".join(statement.split())[:200]
+            total, count = data["statements"].get(key, (0.0, 0))
+            data["statements"][key] = (total + elapsed, count + 1)
+        else:
+            self.metrics.inc("sql_queries_total")
+
+    def handle_error(self, context):
+        # A statement that raised never reaches after_cursor_execute; drop its start time here
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+def _current():
+    # The current app's Instrumentation, or None outside an app or with METRICS_ENABLED off
+    return current_app.extensions.get('instrumentation') if has_app_context() else None
+
+
+@contextmanager
+def span(name):
+    # Time a block of work; nested inside a request the span also shows in the slow-request log
+    instrumentation = _current()
+    if instrumentation is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        instrumentation.metrics.observe("span_duration_seconds", elapsed, (("span", name),))
+        if has_request_context() and hasattr(g, "instrumentation"):
+            spans = g.instrumentation["spans"]
+            total, count = spans.get(name, (0.0, 0))
+            spans[name] = (total + elapsed, count + 1)
+
+
+def timed(name):
+    # Decorator form of span(); costs one extension lookup when instrumentation is disabled
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _current() is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def metrics_allowed():
+    # With METRICS_TOKEN set, /metrics needs "Authorization: Bearer <token>". Without it, only direct
+    # requests from this host are served; anything forwarded by a proxy is refused.
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '')
+        return hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode())
+    return request.remote_addr in ("127.0.0.1", "::1") and 'X-Forwarded-For' not in request.headers
+
+
+def init_instrumentation(app, db):
+    # Register request hooks, SQL event listeners and the /metrics endpoint
+    if not app.config.get('METRICS_ENABLED', False):
+        return
+    instrumentation = app.extensions['instrumentation'] = Instrumentation(app)
+    metrics = instrumentation.metrics
+    slow_ms = instrumentation.slow_ms
+
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", instrumentation.before_cursor_execute)
+        event.listen(db.engine, "after_cursor_execute", instrumentation.after_cursor_execute)
+        event.listen(db.engine, "handle_error", instrumentation.handle_error)
+
+    @app.before_request
+    def start_request_timer():
+        g.instrumentation = {
+            "started": time.perf_counter(),
+            "sql_count": 0,
+            "sql_time": 0.0,
+            "statements": {},
+            "spans": {},
+        }
+
+    @app.after_request
+    def record_request(response):
+        data = getattr(g, "instrumentation", None)
+        if data is None:
+            return response
+        elapsed = time.perf_counter() - data["started"]
+        endpoint = request.endpoint or "unknown"
+        labels = (("endpoint", endpoint), ("method", request.method), ("status", response.status_code))
+        metrics.observe("http_request_duration_seconds", elapsed, labels)
+        metrics.inc("http_request_sql_queries_total", (("endpoint", endpoint),), data["sql_count"])
+        metrics.inc("http_request_sql_seconds_total", (("endpoint", endpoint),), data["sql_time"])
+        if elapsed * 1000 >= slow_ms:
+            metrics.inc("http_slow_requests_total", (("endpoint", endpoint),))
+            top = sorted(data["statements"].items(), key=lambda item: -item[1][0])[:5]
+            breakdown = "; ".join(f"{count}x {total * 1000:.1f}ms {sql}" for sql, (total, count) in top)
+            spans = ", ".join(f"{name} {total * 1000:.1f}ms/{count}" for name, (total, count) in data["spans"].items())
+            app.logger.warning(
+                "Slow request %s %s: %.1fms, %d queries in %.1fms. Spans: %s. Top queries: %s",
+                request.method, request.path, elapsed * 1000, data["sql_count"], data["sql_time"] * 1000,
+                spans or "none", breakdown or "none"
+            )
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        if not metrics_allowed():
+            return Response("Forbidden\n", status=403, mimetype="text/plain")
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
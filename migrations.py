@@ -0,0 +1,144 @@
+# migrations.py
+from datetime import datetime
+from sqlalchemy import inspect, text
+from models import User, Timetable, LeaveRequest, SchemaVersion, Notification, WeeklyPattern, CoverPlan, CoverPlanRun, CoverCount, DataVersion, ChangeLog, GenerationJob, LeaveSummary, ArchivedLeaves, ArchivedOverrides
+
+
+def _create_indexes(db, model):
+    # Create any index declared on the model that the database does not have yet
+    for index in model.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
+
+
+def _deduplicate_rows(db):
+    # Unique indexes cannot be built while duplicates exist; keep the newest row per slot
+    db.session.execute(text(
+        "DELETE FROM timetable WHERE date IS NULL AND id NOT IN "
+        "(SELECT MAX(id) FROM timetable WHERE date IS NULL GROUP BY teacher_id, day, session)"
+    ))
+    db.session.execute(text(
+        "DELETE FROM timetable WHERE date IS NOT NULL AND id NOT IN "
+        "(SELECT MAX(id) FROM timetable WHERE date IS NOT NULL GROUP BY teacher_id, date, session)"
+    ))
+    # Keep the first leave per (teacher, date, session), as apply_leave would have refused the rest
+    db.session.execute(text(
+        "DELETE FROM leave_request WHERE id NOT IN "
+        "(SELECT MIN(id) FROM leave_request GROUP BY teacher_id, date, session)"
+    ))
+    db.session.commit()
+
+
+def _add_access_path_indexes(db):
+    _deduplicate_rows(db)
+    for model in (User, Timetable, LeaveRequest):
+        _create_indexes(db, model)
+
+
+def _create_notification_outbox(db):
+    Notification.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def _create_weekly_pattern(db):
+    WeeklyPattern.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def _create_cover_plan(db):
+    CoverPlan.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def _create_cover_counts(db):
+    # Counters start from the existing leave history
+    from ranking import CoverRanking
+    CoverCount.__table__.create(bind=db.engine, checkfirst=True)
+    CoverRanking(db).backfill()
+
+
+def _create_data_versions(db):
+    from data_versions import seed_versions
+    DataVersion.__table__.create(bind=db.engine, checkfirst=True)
+    seed_versions(db)
+
+
+def _create_change_log(db):
+    ChangeLog.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def _create_generation_jobs(db):
+    GenerationJob.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def _create_archive(db):
+    # The archive tables live in the archive bind (a separate SQLite file by default)
+    LeaveSummary.__table__.create(bind=db.engine, checkfirst=True)
+    for model in (ArchivedLeaves, ArchivedOverrides):
+        model.__table__.create(bind=db.engines['archive'], checkfirst=True)
+
+
+def _create_cover_plan_runs(db):
+    CoverPlanRun.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def _add_feed_versions(db):
+    # Existing users start at version 0, which also accepts the links handed out before this column
+    if 'feed_version' in {column['name'] for column in inspect(db.engine).get_columns('user')}:
+        return
+    table = db.engine.dialect.identifier_preparer.quote('user')
+    db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN feed_version INTEGER NOT NULL DEFAULT 0"))
+    db.session.commit()
+
+
+# Ordered list of (version, description, upgrade function). Append new steps; never edit applied ones.
+MIGRATIONS = [
+    (1, "Composite and unique indexes for Timetable, LeaveRequest and User", _add_access_path_indexes),
+    (2, "Notification outbox", _create_notification_outbox),
+    (3, "Packed weekly timetable storage", _create_weekly_pattern),
+    (4, "Precomputed coverage plan", _create_cover_plan),
+    (5, "Weekly cover counters for substitute ranking", _create_cover_counts),
+    (6, "Per-teacher data versions for conditional GET", _create_data_versions),
+    (7, "Calendar change log for live updates", _create_change_log),
+    (8, "Batch timetable generation jobs", _create_generation_jobs),
+    (9, "Leave archive and monthly leave summaries", _create_archive),
+    (10, "Elected daily coverage re-plan", _create_cover_plan_runs),
+    (11, "Revocable calendar feed links", _add_feed_versions),
+]
+
+
+def current_version(db):
+    if not inspect(db.engine).has_table(SchemaVersion.__tablename__):
+        return 0
+    return db.session.query(db.func.max(SchemaVersion.version)).scalar() or 0
+
+
+def upgrade_database(db, log=print):
+    # Bring the database up to the latest schema version in place.
+    # create_all adds missing tables (with their indexes) but never touches existing tables,
+    # so every change to an existing table goes through a numbered migration.
+    db.create_all()
+    version = current_version(db)
+    for number, description, upgrade in MIGRATIONS:
+        if number <= version:
+            continue
+        log(f"Applying migration {number}: {description}")
+        try:
+            upgrade(db)
+            db.session.add(SchemaVersion(version=number, applied_at=datetime.utcnow()))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        version = number
+    return version
+
+
+def init_database(db, log=print):
+    # Create the latest schema in a new database and record every migration as applied (there is
+    # nothing to migrate yet). A database that already has tables is upgraded instead.
+    if inspect(db.engine).has_table(User.__tablename__):
+        return upgrade_database(db, log)
+    db.create_all()
+    now = datetime.utcnow()
+    for number, description, upgrade in MIGRATIONS:
+        db.session.add(SchemaVersion(version=number, applied_at=now))
+    db.session.commit()
+    log(f"Created the schema at version {MIGRATIONS[-1][0]}")
+    return MIGRATIONS[-1][0]
@@ -1,9 +1,11 @@
 # models.py
+from flask import current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from datetime import date
 from database import db
+from instrumentation import timed
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -12,10 +14,19 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128), nullable=False)
     role = db.Column(db.String(20), nullable=False)  # "HOD" or "Teacher"
     department = db.Column(db.String(50), nullable=False)
+    feed_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Signed into calendar feed links (ical.py)
 
+    __table_args__ = (
+        db.Index('ix_user_department_role', 'department', 'role'),
+    )
+
+    @timed('password.hash')
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        # PASSWORD_HASH_METHOD selects the Werkzeug method and parameters; older hashes are upgraded at login
+        method = current_app.config.get('PASSWORD_HASH_METHOD') if has_app_context() else None
+        self.password_hash = generate_password_hash(password, method) if method else generate_password_hash(password)
 
+    @timed('password.check')
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
@@ -26,10 +37,34 @@ class Timetable(db.Model):
     date = db.Column(db.Date, nullable=True)  # Specific date, e.g., 2025-04-10
     session = db.Column(db.Integer, nullable=False)
     status = db.Column(db.String(10), nullable=False)  # e.g., "Busy", "Free"
-    substitute_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    substitute_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Set on rows a substitute booking inserted
     teacher = db.relationship('User', foreign_keys=[teacher_id])
     substitute = db.relationship('User', foreign_keys=[substitute_id])
 
+    __table_args__ = (
+        # filter_by(teacher_id), filter_by(teacher_id, date=...) and date ranges per teacher
+        db.Index('ix_timetable_teacher_date_session', 'teacher_id', 'date', 'session'),
+        # One day-based row and one override per (teacher, slot); these also serve
+        # filter_by(teacher_id, day, session, date=None) and filter_by(teacher_id, date, session)
+        db.Index('uq_timetable_day_slot', 'teacher_id', 'day', 'session', unique=True,
+                 sqlite_where=db.text('date IS NULL'), postgresql_where=db.text('date IS NULL')),
+        db.Index('uq_timetable_date_slot', 'teacher_id', 'date', 'session', unique=True,
+                 sqlite_where=db.text('date IS NOT NULL'), postgresql_where=db.text('date IS NOT NULL')),
+    )
+
+class WeeklyPattern(db.Model):
+    # Packed alternative to day-based Timetable rows: one row per (teacher, day).
+    # Bit (session - 1) of busy_mask is set when the session is Busy; sessions up to num_sessions exist.
+    id = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.String(10), nullable=False)  # e.g., "Monday"
+    num_sessions = db.Column(db.Integer, nullable=False)
+    busy_mask = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('uq_weekly_pattern_teacher_day', 'teacher_id', 'day', unique=True),
+    )
+
 class LeaveRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -37,4 +72,157 @@ class LeaveRequest(db.Model):
     date = db.Column(db.Date, nullable=False)  # Specific date, e.g., 2025-04-10
     session = db.Column(db.Integer, nullable=False)
     teacher = db.relationship('User', foreign_keys=[teacher_id])
-    substitute = db.relationship('User', foreign_keys=[substitute_id])
\ No newline at end of file
+    substitute = db.relationship('User', foreign_keys=[substitute_id])
+
+    __table_args__ = (
+        # One leave per (teacher, date, session); also serves filter_by(teacher_id, date, session)
+        db.Index('uq_leave_teacher_date_session', 'teacher_id', 'date', 'session', unique=True),
+        # remove_teacher and cover counts filter on the substitute
+        db.Index('ix_leave_substitute_date', 'substitute_id', 'date'),
+    )
+
+class CoverPlan(db.Model):
+    # Precomputed substitutes for one (department, date, session) over the planning horizon (cover_plan.py).
+    # candidates holds the free members ranked for the slot as comma-separated ids, best first;
+    # an absent teacher's list is this one without themselves.
+    id = db.Column(db.Integer, primary_key=True)
+    department = db.Column(db.String(50), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    session = db.Column(db.Integer, nullable=False)
+    candidates = db.Column(db.Text, nullable=False, default="")
+
+    __table_args__ = (
+        db.Index('uq_cover_plan_slot', 'department', 'date', 'session', unique=True),
+    )
+
+class CoverPlanRun(db.Model):
+    # One row per day of the full coverage re-plan. The process whose insert succeeds runs it, so only one
+    # of the web workers re-plans every department each day (cover_plan.py).
+    id = db.Column(db.Integer, primary_key=True)
+    planned_on = db.Column(db.Date, nullable=False, unique=True)
+    started_at = db.Column(db.DateTime, nullable=False)  # Refreshed when a stale claim is taken over
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class CoverCount(db.Model):
+    # Covers a teacher held as substitute in one week (week = that Monday); kept in step with
+    # LeaveRequest by ranking.py and rebuilt with flask backfill-cover-counts
+    id = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    week = db.Column(db.Date, nullable=False)
+    covers = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('uq_cover_count_teacher_week', 'teacher_id', 'week', unique=True),
+    )
+
+class DataVersion(db.Model):
+    # Bumped by every commit that changes what the calendar endpoints return for the teacher
+    # (data_versions.py); the ETag and Last-Modified of those endpoints come from this row
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class ChangeLog(db.Model):
+    # Append-only calendar change feed (changes.py); the id is the server-sent event id
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kinds = db.Column(db.String(50), nullable=False)  # Comma-separated: leave, cover, timetable
+    dates = db.Column(db.Text, nullable=False, default="")  # Comma-separated ISO dates; empty for whole-timetable changes
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        # Replay after Last-Event-ID
+        db.Index('ix_change_log_user_id', 'user_id', 'id'),
+        db.Index('ix_change_log_created_at', 'created_at'),
+    )
+
+class LeaveSummary(db.Model):
+    # Leave counts of one teacher in one archived month (archive.py), rebuilt from the archive
+    # whenever the month is archived; analytics adds them to the counts it reads from LeaveRequest
+    id = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    month = db.Column(db.Date, nullable=False)  # First day of the month
+    leaves = db.Column(db.Integer, nullable=False, default=0)
+    covered = db.Column(db.Integer, nullable=False, default=0)  # Of those leaves, the ones with a substitute
+    covers = db.Column(db.Integer, nullable=False, default=0)  # Covers the teacher held as substitute
+
+    __table_args__ = (
+        db.Index('uq_leave_summary_teacher_month', 'teacher_id', 'month', unique=True),
+        db.Index('ix_leave_summary_month', 'month'),
+    )
+
+class ArchivedLeaves(db.Model):
+    # One teacher's leaves in one archived month, in the archive database. rows is a zlib-compressed
+    # JSON list of [id, day of month, session, substitute_id, substitute username]; the usernames and
+    # the department are copied so the history still reads the same after teachers are removed.
+    __bind_key__ = 'archive'
+    id = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, nullable=False)
+    teacher = db.Column(db.String(80), nullable=False)
+    department = db.Column(db.String(50), nullable=False)
+    month = db.Column(db.Date, nullable=False)  # First day of the month
+    leaves = db.Column(db.Integer, nullable=False, default=0)
+    rows = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.Index('uq_archived_leaves_teacher_month', 'teacher_id', 'month', unique=True),
+        # The report reads a department newest month first
+        db.Index('ix_archived_leaves_department_month', 'department', 'month'),
+    )
+
+class ArchivedOverrides(db.Model):
+    # One teacher's date-specific Timetable rows in one archived month, in the archive database.
+    # rows is a zlib-compressed JSON list of [day of month, session, status, substitute_id].
+    __bind_key__ = 'archive'
+    id = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Date, nullable=False)  # First day of the month
+    overrides = db.Column(db.Integer, nullable=False, default=0)
+    rows = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.Index('uq_archived_overrides_teacher_month', 'teacher_id', 'month', unique=True),
+    )
+
+class GenerationJob(db.Model):
+    # Batch timetable generation over one or more departments (generation.py); polled for progress
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(10), nullable=False, default="queued")  # queued, running, done, failed
+    departments = db.Column(db.Text, nullable=False)  # Comma-separated, in the order given
+    num_days = db.Column(db.Integer, nullable=False)
+    num_sessions = db.Column(db.Integer, nullable=False)
+    seed = db.Column(db.BigInteger, nullable=False)  # Department seeds derive from it (solver.department_seed)
+    keep_existing = db.Column(db.Boolean, nullable=False, default=False)
+    total = db.Column(db.Integer, nullable=False, default=0)  # Departments
+    done = db.Column(db.Integer, nullable=False, default=0)
+    teachers = db.Column(db.Integer, nullable=False, default=0)  # Timetables written so far
+    shortfall = db.Column(db.Integer, nullable=False, default=0)  # Busy sessions or free slots the solver could not meet
+    error = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # HOD who started it; None from the CLI
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class SchemaVersion(db.Model):
+    # Highest migration applied to this database (see migrations.py)
+    version = db.Column(db.Integer, primary_key=True)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+class Notification(db.Model):
+    # Outbox row for an email; written in the same transaction as the change it reports
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200), nullable=False)
+    sender = db.Column(db.String(120), nullable=True)
+    recipients = db.Column(db.Text, nullable=False)  # Comma-separated addresses
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default="pending")  # pending, sending, sent, dead
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # The worker polls for due pending rows
+        db.Index('ix_notification_status_next_attempt', 'status', 'next_attempt_at'),
+    )
\ No newline at end of file
@@ -0,0 +1,154 @@
+# notifications.py
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask_mail import Message
+from models import Notification
+from instrumentation import span
+
+
+def queue_email(db, subject, recipients, body, sender=None):
+    # Add an email to the outbox without committing; the caller commits it with its own changes
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    now = datetime.utcnow()
+    notification = Notification(
+        subject=subject,
+        sender=sender,
+        recipients=",".join(recipients),
+        body=body,
+        status="pending",
+        attempts=0,
+        next_attempt_at=now,
+        created_at=now
+    )
+    db.session.add(notification)
+    return notification
+
+
+class NotificationOutbox:
+    # Drains the Notification table in the background.
+    # A dispatcher thread claims due rows in batches and hands each batch to a worker pool;
+    # every batch is sent over a single SMTP connection. Failures are retried with exponential
+    # backoff and rows that exhaust their attempts are kept with status "dead".
+    def __init__(self, app, db, mail):
+        self.app = app
+        self.db = db
+        self.mail = mail
+        self.workers = app.config.get('MAIL_OUTBOX_WORKERS', 2)
+        self.batch_size = app.config.get('MAIL_OUTBOX_BATCH_SIZE', 20)
+        self.max_attempts = app.config.get('MAIL_OUTBOX_MAX_ATTEMPTS', 5)
+        self.backoff = app.config.get('MAIL_OUTBOX_BACKOFF', 30)  # Seconds before the first retry
+        self.poll_interval = app.config.get('MAIL_OUTBOX_POLL_INTERVAL', 5)
+        self.claim_timeout = app.config.get('MAIL_OUTBOX_CLAIM_TIMEOUT', 300)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pool = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbox")
+            self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._pool.shutdown(wait=True)
+
+    def wake(self):
+        # Called after a commit that queued mail so it goes out without waiting for the next poll
+        if not self.app.config.get('MAIL_OUTBOX_ENABLED', True):
+            return
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    batches = self._claim_batches()
+                for batch in batches:
+                    self._pool.submit(self._send_batch, batch)
+            except Exception as e:
+                self.app.logger.exception("Notification outbox dispatcher failed: %s", e)
+                batches = []
+            if not batches:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _claim_batches(self):
+        # Claim due rows with a conditional update so concurrent dispatchers never send a row twice
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=self.claim_timeout)
+        candidates = [row[0] for row in self.db.session.query(Notification.id).filter(
+            ((Notification.status == "pending") & (Notification.next_attempt_at <= now))
+            | ((Notification.status == "sending") & (Notification.claimed_at < stale))
+        ).order_by(Notification.next_attempt_at).limit(self.batch_size * self.workers)]
+        claimed = []
+        for notification_id in candidates:
+            updated = Notification.query.filter(
+                Notification.id == notification_id,
+                ((Notification.status == "pending") | (Notification.claimed_at < stale))
+            ).update({'status': "sending", 'claimed_at': now}, synchronize_session=False)
+            if updated:
+                claimed.append(notification_id)
+        self.db.session.commit()
+        return [claimed[i:i + self.batch_size] for i in range(0, len(claimed), self.batch_size)]
+
+    def _send_batch(self, notification_ids):
+        with self.app.app_context():
+            notifications = Notification.query.filter(Notification.id.in_(notification_ids)).all()
+            try:
+                with self.mail.connect() as connection:
+                    for notification in notifications:
+                        try:
+                            with span('mail.send'):
+                                connection.send(self._message(notification))
+                            notification.status = "sent"
+                            notification.sent_at = datetime.utcnow()
+                        except Exception as e:
+                            self._record_failure(notification, e)
+            except Exception as e:
+                # Could not open the SMTP connection: every message in the batch failed
+                for notification in notifications:
+                    if notification.status == "sending":
+                        self._record_failure(notification, e)
+            self.db.session.commit()
+
+    def _message(self, notification):
+        return Message(
+            notification.subject,
+            sender=notification.sender or self.app.config.get('MAIL_USERNAME'),
+            recipients=notification.recipients.split(","),
+            body=notification.body
+        )
+
+    def _record_failure(self, notification, error):
+        notification.attempts += 1
+        notification.last_error = str(error)[:1000]
+        notification.claimed_at = None
+        if notification.attempts >= self.max_attempts:
+            notification.status = "dead"
+            return
+        delay = self.backoff * (2 ** (notification.attempts - 1))
+        notification.status = "pending"
+        notification.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+    def drain(self):
+        # Send everything that is due on the calling thread (flask drain-outbox and tests/test_notifications.py)
+        sent = 0
+        while True:
+            batches = self._claim_batches()
+            if not batches:
+                return sent
+            for batch in batches:
+                self._send_batch(batch)
+                sent += len(batch)
@@ -0,0 +1,194 @@
+# query_plans.py
+import io
+import re
+import threading
+from datetime import date, timedelta
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from werkzeug.wrappers import Response
+
+# Access-path check for SQLite. The statements are not written out here, so they cannot drift from
+# the code: walk() drives the real routes and jobs against a scratch in-memory database with the
+# current schema and records every statement they send. Each statement is then explained against
+# the configured database, with the parameters it was sent with.
+
+HOT_TABLES = {"user", "timetable", "leave_request", "weekly_pattern", "cover_plan", "cover_count", "data_version",
+              "change_log", "leave_summary", "archived_leaves", "archived_overrides"}
+FULL_SCAN = re.compile(r"^SCAN (\w+)")
+EXPLAINED = re.compile(r"^\s*(SELECT|UPDATE|DELETE|INSERT|WITH)\b", re.IGNORECASE)
+# Tables the batch jobs sweep on purpose; any other scan in them, and every scan in a route, is a problem
+JOB_SWEEPS = {
+    "flask plan-cover": {"user", "cover_plan"},  # Lists the departments; prunes past plans
+    "flask archive": {"user", "archived_leaves"},  # Walks every teacher; recounts whole archived months
+}
+HASH_METHOD = "pbkdf2:sha256:1"  # The walk signs in for real; its passwords need no strength
+
+
+class Recorder:
+    # Statements sent from this thread while a step is set: {step: {(bind key, sql): parameters}}.
+    # Background threads (the change hub, the generator) are not recorded.
+    def __init__(self, engines):
+        self.step = None
+        self.statements = {}
+        self._thread = threading.get_ident()
+        for key, engine in engines.items():
+            event.listen(engine, "before_cursor_execute", self._listener(key))
+
+    def _listener(self, key):
+        def record(connection, cursor, statement, parameters, context, executemany):
+            if self.step is None or threading.get_ident() != self._thread or not EXPLAINED.match(statement):
+                return
+            if executemany and parameters and isinstance(parameters[0], (tuple, list, dict)):
+                parameters = parameters[0]
+            self.statements.setdefault(self.step, {}).setdefault((key, statement), parameters)
+        return record
+
+
+def _seed(db, store):
+    # One department: an HOD and three teachers; t1 teaches session 1 every day, the others are free then
+    from models import User
+    users = {}
+    for username, role in (("hod", "HOD"), ("t1", "Teacher"), ("t2", "Teacher"), ("t3", "Teacher")):
+        users[username] = User(username=username, email=f"{username}@example.com", role=role, department="CS",
+                               password_hash=generate_password_hash("pw", HASH_METHOD))
+        db.session.add(users[username])
+    db.session.commit()
+    days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+    store.save_many({
+        user.id: {day: {session: "Busy" if username == "t1" and session == 1 else "Free" for session in range(1, 5)}
+                  for day in days}
+        for username, user in users.items()
+    })
+    db.session.commit()
+    return {username: user.id for username, user in users.items()}
+
+
+def walk(layout):
+    # Run every route and job once on a scratch app with the given timetable layout.
+    # Returns {step: {(bind key, sql): parameters}}.
+    from flask_app import create_app, services, db
+    from migrations import init_database
+    from archive import archive
+    from ical import feed_token
+    from models import User
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'SQLALCHEMY_BINDS': {'archive': 'sqlite://'},
+        'SQLALCHEMY_ENGINE_OPTIONS': {},
+        'TIMETABLE_STORAGE': layout,
+        'SCHEDULE_CACHE': 'none',  # Every read reaches the database
+        'USER_CACHE_TTL': 0,
+        'MAIL_OUTBOX_ENABLED': False,
+        'COVER_PLAN_ENABLED': False,
+        'METRICS_ENABLED': False,
+        'PASSWORD_HASH_METHOD': HASH_METHOD,
+        'IMPORT_HASH_WORKERS': 1,
+    })
+    today = date.today()
+    day = today + timedelta(days=7)
+    with app.app_context():
+        init_database(db, log=lambda message: None)
+        ids = _seed(db, services(app).timetable_logic.store)
+        recorder = Recorder(db.engines)
+        token = feed_token(services(app).serializer, db.session.get(User, ids["t1"]))
+    client = app.test_client()
+
+    def step(name, call):
+        recorder.step = name
+        try:
+            response = call()
+            if isinstance(response, Response):
+                response.get_data()  # Streamed bodies run here
+                response.close()
+        finally:
+            recorder.step = None
+
+    def sign_in(username):
+        client.get('/logout')
+        step("POST /login", lambda: client.post('/login', data={'username': username, 'password': 'pw'}))
+
+    grid_form = {'num_days': 5, 'num_sessions': 4, 'save': '1', 'busy-Monday-2': 'on'}
+    window = {'start': day.isoformat(), 'end': (day + timedelta(days=30)).isoformat()}
+
+    sign_in("t1")
+    step("GET /dashboard", lambda: client.get('/dashboard'))
+    step("GET /api/v1/timetable", lambda: client.get('/api/v1/timetable', query_string={'date': day.isoformat()}))
+    step("GET /api/v1/timetable_range", lambda: client.get('/api/v1/timetable_range', query_string=window))
+    step("POST /apply_leave", lambda: client.post('/apply_leave', data={'date': day.isoformat(), 'session': 1}))
+    step("POST /apply_leave_bulk", lambda: client.post('/apply_leave_bulk', json={
+        'start_date': (day + timedelta(days=1)).isoformat(), 'end_date': (day + timedelta(days=3)).isoformat(),
+        'sessions': [1]}))
+    step("GET /api/v1/leave_events", lambda: client.get('/api/v1/leave_events'))
+    step("GET /api/v1/calendar", lambda: client.get('/api/v1/calendar', query_string=window))
+    step("GET /api/v1/changes", lambda: client.get('/api/v1/changes', headers={'Last-Event-ID': '0'},
+                                                   buffered=False).close())
+    step("GET /calendar/<token>.ics", lambda: client.get(f'/calendar/{token}.ics'))
+    step("POST /rotate_calendar_link", lambda: client.post('/rotate_calendar_link'))
+
+    sign_in("hod")
+    step("GET /dashboard", lambda: client.get('/dashboard'))
+    step("GET /api/v1/calendar", lambda: client.get('/api/v1/calendar', query_string=window))
+    step("GET /report", lambda: client.get('/report'))
+    step("GET /report", lambda: client.get('/report', query_string={**window, 'teacher': ids["t1"]}))
+    step("GET /report/export", lambda: client.get('/report/export', query_string={'format': 'csv'}))
+    step("GET /analytics", lambda: client.get('/analytics', query_string={'format': 'json'}))
+    step("GET /analytics/<chart>.png", lambda: client.get('/analytics/leaves.png'))
+    step("POST /create_timetable", lambda: client.post(f'/create_timetable/{ids["t3"]}', data=grid_form))
+    step("POST /create_timetables", lambda: client.post('/create_timetables', json={
+        'timetables': {str(ids["t2"]): {"Monday": {"1": "Busy", "2": "Free"}}}}))
+    step("POST /bulk_import", lambda: client.post('/bulk_import', data={
+        'roster': (io.BytesIO(b"username,email,password\nt4,t4@example.com,pw\n"), 'roster.csv'),
+        'timetable': (io.BytesIO(f"teacher_id,day,session,status\n{ids['t3']},Tuesday,1,Busy\n"
+                                   f"{ids['t3']},Tuesday,2,Free\n".encode()),
+                      'schedule.csv')}))
+    step("POST /reset_teacher_password", lambda: client.post(f'/reset_teacher_password/{ids["t3"]}',
+                                                             data={'new_password': 'pw2'}))
+    step("POST /add_teacher", lambda: client.post('/add_teacher', data={
+        'username': 't5', 'email': 't5@example.com', 'password': 'pw'}))
+    step("POST /remove_teacher", lambda: client.post(f'/remove_teacher/{ids["t2"]}'))
+    step("POST /reset_password_request", lambda: client.post('/reset_password_request',
+                                                             data={'email': 'hod@example.com'}))
+    client.get('/logout')
+    step("POST /register", lambda: client.post('/register', data={
+        'username': 'hod2', 'email': 'hod2@example.com', 'password': 'pw', 'department': 'Maths'}))
+
+    with app.app_context():
+        logic = services(app).timetable_logic
+        step("flask plan-cover", lambda: logic.planner.plan_all())
+        generator = services(app).generator
+        job = generator.create_job(["CS"], 5, 4, seed=1)
+        step("flask generate-timetables", lambda: generator.run(job.id, workers=1))
+        step("flask archive", lambda: archive(db, (day + timedelta(days=40)).replace(day=1)))
+        services(app).change_hub.stop()
+    sign_in("hod")
+    step("GET /report", lambda: client.get('/report'))
+    step("GET /analytics", lambda: client.get('/analytics', query_string={'format': 'json'}))
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+    return recorder.statements
+
+
+def explain(engine, statement, parameters):
+    # EXPLAIN QUERY PLAN rows (detail strings) for a recorded statement
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, tuple(parameters)).fetchall()
+    return [row[-1] for row in rows]
+
+
+def full_table_scans(db):
+    # Map of "step: statement" -> plan lines that scan a hot table end to end, for both layouts
+    if db.engine.dialect.name != "sqlite":
+        raise RuntimeError("Query plan checks are only implemented for SQLite.")
+    problems = {}
+    for layout in ("rows", "packed"):
+        for name, statements in walk(layout).items():
+            for (key, statement), parameters in statements.items():
+                scans = [
+                    line for line in explain(db.engines[key], statement, parameters)
+                    if FULL_SCAN.match(line) and FULL_SCAN.match(line).group(1) in HOT_TABLES - JOB_SWEEPS.get(name, set())
+                ]
+                if scans:
+                    problems[f"{name} ({layout}): {' '.join(statement.split())[:300]}"] = scans
+    return problems
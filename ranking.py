@@ -0,0 +1,153 @@
+# ranking.py
+from collections import Counter
+from datetime import timedelta
+from sqlalchemy import event, inspect, select, insert, update, delete, func
+from sqlalchemy.dialects import sqlite, postgresql, mysql
+from sqlalchemy.exc import IntegrityError
+from models import LeaveRequest, CoverCount
+
+# Fair substitute choice from per-teacher cover counters.
+# CoverCount keeps one row per (substitute, week) with the number of covers held that week. Leaves
+# written or deleted through the ORM adjust the counters in the same transaction (at commit, from the
+# flushed changes); bulk statements report theirs with covers_changed. A candidate's load is the sum
+# of its last COVER_WINDOW_WEEKS weekly counters, read for all candidates in one query. Picking a
+# substitute is that one aggregate query plus a linear minimum over the candidates; the planner sorts.
+#
+# Two transactions may create the same (substitute, week) counter at once, so the changes are written
+# as one upsert: ON CONFLICT DO UPDATE on SQLite and PostgreSQL, ON DUPLICATE KEY UPDATE on MySQL.
+# Other databases update, then insert inside a savepoint and retry the update if the insert lost a race.
+
+_PENDING = 'cover_counts'
+_REMOVED = 'cover_counts_removed'
+
+
+def week_of(date):
+    # Monday of the date's week; the counter bucket
+    return date - timedelta(days=date.weekday())
+
+
+def covers_changed(session, changes):
+    # Record (substitute_id, date, delta) changes made by bulk statements the ORM does not see
+    pending = session.info.setdefault(_PENDING, Counter())
+    for substitute_id, date, delta in changes:
+        if substitute_id is not None:
+            pending[(substitute_id, week_of(date))] += delta
+
+
+def teacher_removed(session, teacher_id):
+    # Drop a removed teacher's counters at commit, ignoring any change still pending for them
+    session.info.setdefault(_REMOVED, set()).add(teacher_id)
+
+
+def _add_covers(session, table, rows):
+    # Add each row's covers to its (teacher_id, week) counter, creating missing counters
+    dialect = session.get_bind(CoverCount).dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        statement = (sqlite if dialect == "sqlite" else postgresql).insert(table).values(rows)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.teacher_id, table.c.week],
+            set_={'covers': table.c.covers + statement.excluded.covers}
+        ))
+        return
+    if dialect in ("mysql", "mariadb"):
+        statement = mysql.insert(table).values(rows)
+        session.execute(statement.on_duplicate_key_update(covers=table.c.covers + statement.inserted.covers))
+        return
+    for row in rows:
+        counter = update(table).where(table.c.teacher_id == row['teacher_id'], table.c.week == row['week'])
+        if session.execute(counter.values(covers=table.c.covers + row['covers'])).rowcount:
+            continue
+        try:
+            with session.begin_nested():
+                session.execute(insert(table).values(**row))
+        except IntegrityError:
+            # Created by a concurrent transaction since the update
+            session.execute(counter.values(covers=table.c.covers + row['covers']))
+
+
+def init_cover_counts(db):
+    def collect(session, flush_context, instances):
+        # Cover changes about to be flushed: new, deleted and re-assigned leaves
+        changes = []
+        for leave in session.new:
+            if isinstance(leave, LeaveRequest):
+                changes.append((leave.substitute_id, leave.date, 1))
+        for leave in session.deleted:
+            if isinstance(leave, LeaveRequest):
+                changes.append((leave.substitute_id, leave.date, -1))
+        for leave in session.dirty:
+            if isinstance(leave, LeaveRequest) and session.is_modified(leave):
+                history = inspect(leave).attrs.substitute_id.history
+                changes.extend((substitute_id, leave.date, -1) for substitute_id in history.deleted)
+                changes.extend((substitute_id, leave.date, 1) for substitute_id in history.added)
+        covers_changed(session, changes)
+
+    def apply(session):
+        # Write the transaction's counter changes just before it commits
+        session.flush()
+        removed = session.info.pop(_REMOVED, set())
+        pending = session.info.pop(_PENDING, None)
+        table = CoverCount.__table__
+        if removed:
+            session.execute(delete(table).where(table.c.teacher_id.in_(removed)))
+        rows = [
+            {'teacher_id': teacher_id, 'week': week, 'covers': delta}
+            for (teacher_id, week), delta in sorted((pending or {}).items()) if delta and teacher_id not in removed
+        ]
+        if rows:
+            _add_covers(session, table, rows)
+
+    def discard(session):
+        session.info.pop(_PENDING, None)
+        session.info.pop(_REMOVED, None)
+
+    event.listen(db.session, "before_flush", collect)
+    event.listen(db.session, "before_commit", apply)
+    event.listen(db.session, "after_rollback", discard)
+
+
+class CoverRanking:
+    def __init__(self, db, window_weeks=8):
+        self.db = db
+        self.window_weeks = window_weeks
+
+    def loads(self, teacher_ids, date):
+        # {teacher_id: covers in the window of weeks ending with the date's week}; missing means 0
+        teacher_ids = list(teacher_ids)
+        if not teacher_ids:
+            return {}
+        last = week_of(date)
+        first = last - timedelta(weeks=self.window_weeks - 1)
+        return dict(self.db.session.execute(
+            select(CoverCount.teacher_id, func.sum(CoverCount.covers))
+            .where(CoverCount.teacher_id.in_(teacher_ids), CoverCount.week >= first, CoverCount.week <= last)
+            .group_by(CoverCount.teacher_id)
+        ).all())
+
+    def least_loaded(self, teacher_ids, date):
+        # The candidate with the fewest covers, lowest id on ties, or None
+        loads = self.loads(teacher_ids, date)
+        return min(teacher_ids, key=lambda teacher_id: (loads.get(teacher_id, 0), teacher_id), default=None)
+
+    def ranked(self, teacher_ids, date):
+        # Candidates by fewest covers, lowest id first on ties
+        loads = self.loads(teacher_ids, date)
+        return sorted(teacher_ids, key=lambda teacher_id: (loads.get(teacher_id, 0), teacher_id))
+
+    def backfill(self, batch_size=1000):
+        # Rebuild every counter from the LeaveRequest history. Returns the number of counter rows.
+        counts = Counter()
+        for substitute_id, date in self.db.session.execute(
+            select(LeaveRequest.substitute_id, LeaveRequest.date)
+            .where(LeaveRequest.substitute_id.isnot(None))
+            .execution_options(yield_per=batch_size)
+        ):
+            counts[(substitute_id, week_of(date))] += 1
+        self.db.session.info.pop(_PENDING, None)
+        self.db.session.execute(delete(CoverCount))
+        rows = [{'teacher_id': teacher_id, 'week': week, 'covers': covers}
+                for (teacher_id, week), covers in counts.items()]
+        for i in range(0, len(rows), batch_size):
+            self.db.session.execute(insert(CoverCount), rows[i:i + batch_size])
+        self.db.session.commit()
+        return len(rows)
@@ -0,0 +1,193 @@
+# repair.py
+from datetime import date as date_type
+from models import Timetable, User, LeaveRequest, DataVersion, ChangeLog, LeaveSummary
+from availability import AvailabilityIndex, session_bit
+from coverage import assign_cover
+from signals import schedule_touched
+from ranking import covers_changed, teacher_removed
+from timetable_logic import SubstituteUnavailable
+
+# Keeps substitute bookings valid when the people or timetables behind them change.
+# Only bookings from today on are touched; each repair looks up just the leaves that involve
+# the changed teachers (by teacher or substitute index) and reassigns them in one batch.
+
+
+class RepairReport:
+    def __init__(self):
+        self.reassigned = []  # (teacher_id, date, session, new substitute_id)
+        self.uncovered = []  # (teacher_id, date, session): no free colleague left
+        self.released = []  # (teacher_id, date, session): cover no longer needed, substitute released
+
+    def __bool__(self):
+        return bool(self.reassigned or self.uncovered or self.released)
+
+
+class CoverageRepair:
+    def __init__(self, logic):
+        self.logic = logic
+        self.db = logic.db
+
+    def _release_booking(self, leave):
+        # Undo the substitute's booking: delete the date-specific Busy row the booking inserted (marked
+        # with the substitute's id), or turn a Free row it claimed back to Free
+        if leave.substitute_id is None:
+            return
+        booking = Timetable.query.filter_by(
+            teacher_id=leave.substitute_id, date=leave.date, session=leave.session, status="Busy"
+        )
+        if not booking.filter(Timetable.substitute_id == leave.substitute_id).delete(synchronize_session=False):
+            booking.update({'status': "Free"}, synchronize_session=False)
+
+    def remove_teacher(self, teacher, today=None):
+        # Delete a teacher with everything that references them, re-covering the leaves they covered.
+        # The caller commits.
+        today = today or date_type.today()
+        report = RepairReport()
+        covered = LeaveRequest.query.filter(LeaveRequest.substitute_id == teacher.id).all()
+        own_future = LeaveRequest.query.filter(
+            LeaveRequest.teacher_id == teacher.id, LeaveRequest.date >= today
+        ).all()
+
+        # Colleagues booked to cover the removed teacher are free again
+        for leave in own_future:
+            self._release_booking(leave)
+        schedule_touched(self.db.session, [leave.substitute_id for leave in own_future if leave.substitute_id],
+                         [teacher.department])
+
+        # Past covers keep the absence on record without a substitute; upcoming ones get a new one
+        upcoming = []
+        for leave in covered:
+            leave.substitute_id = None
+            if leave.date >= today:
+                upcoming.append(leave)
+
+        # The bulk delete below bypasses the ORM, so the substitutes' counters are adjusted here
+        covers_changed(self.db.session, [
+            (substitute_id, date, -1) for substitute_id, date in self.db.session.query(
+                LeaveRequest.substitute_id, LeaveRequest.date
+            ).filter(LeaveRequest.teacher_id == teacher.id, LeaveRequest.substitute_id.isnot(None))
+        ])
+        teacher_removed(self.db.session, teacher.id)
+        self.logic.store.delete(teacher.id)
+        Timetable.query.filter_by(teacher_id=teacher.id).delete(synchronize_session=False)
+        LeaveRequest.query.filter_by(teacher_id=teacher.id).delete(synchronize_session=False)
+        DataVersion.query.filter_by(teacher_id=teacher.id).delete(synchronize_session=False)
+        ChangeLog.query.filter_by(user_id=teacher.id).delete(synchronize_session=False)
+        LeaveSummary.query.filter_by(teacher_id=teacher.id).delete(synchronize_session=False)
+        self.db.session.delete(teacher)
+        self.db.session.flush()
+
+        schedule_touched(self.db.session, [leave.teacher_id for leave in covered], [teacher.department])
+        self.reassign(upcoming, {teacher.id}, report)
+        return report
+
+    def save_grids(self, grids, today=None):
+        # Save day-based grids {teacher_id: {day: {session: status}}} and repair the bookings they break:
+        #   - a cell turning Busy makes the teacher's upcoming covers in that weekday/session clash -> reassign
+        #   - a cell turning Free leaves nothing to cover in the teacher's own leaves there -> release the
+        #     substitute; the leave stays on record without one
+        # Returns (cells written, RepairReport). The caller commits.
+        today = today or date_type.today()
+        report = RepairReport()
+        teacher_ids = list(grids)
+        self.logic.lock_teachers(teacher_ids)  # Serialised with bookings of these teachers (book_substitute)
+        old = self.logic.store.load(teacher_ids)
+        changed = self.logic.store.save_many(grids)
+
+        became_busy, became_free = set(), set()
+        for teacher_id, grid in grids.items():
+            previous = old.get(teacher_id, {})
+            for day in set(grid) | set(previous):
+                sessions = grid.get(day, {})
+                before = previous.get(day, {})
+                for session in set(sessions) | set(before):
+                    now_busy = sessions.get(session) == "Busy"
+                    was_busy = before.get(session) == "Busy"
+                    if now_busy and not was_busy:
+                        became_busy.add((teacher_id, day, session))
+                    elif was_busy and not now_busy:
+                        became_free.add((teacher_id, day, session))
+        if not became_busy and not became_free:
+            return changed, report
+
+        clashing = []
+        if became_busy:
+            for leave in LeaveRequest.query.filter(
+                LeaveRequest.substitute_id.in_({teacher_id for teacher_id, _, _ in became_busy}),
+                LeaveRequest.date >= today
+            ):
+                if (leave.substitute_id, leave.date.strftime('%A'), leave.session) in became_busy:
+                    clashing.append(leave)
+        released = set()
+        if became_free:
+            for leave in LeaveRequest.query.filter(
+                LeaveRequest.teacher_id.in_({teacher_id for teacher_id, _, _ in became_free}),
+                LeaveRequest.date >= today,
+                LeaveRequest.substitute_id.isnot(None)
+            ):
+                if (leave.teacher_id, leave.date.strftime('%A'), leave.session) in became_free:
+                    self._release_booking(leave)
+                    schedule_touched(self.db.session, [leave.teacher_id, leave.substitute_id])
+                    report.released.append((leave.teacher_id, leave.date, leave.session))
+                    released.add(leave.id)
+                    leave.substitute_id = None
+
+        # Released leaves need no cover, so they are neither reassigned nor reported uncovered
+        clashing = [leave for leave in clashing if leave.id not in released]
+        exclude = set()
+        for leave in clashing:
+            exclude.add(leave.substitute_id)
+            self._release_booking(leave)
+            schedule_touched(self.db.session, [leave.teacher_id, leave.substitute_id])
+            leave.substitute_id = None
+        self.db.session.flush()
+        self.reassign(clashing, exclude, report)
+        return changed, report
+
+    def reassign(self, leaves, exclude, report):
+        # Find new substitutes for leaves whose substitute was taken away, as one balanced assignment
+        if not leaves:
+            return
+        departments = dict(self.db.session.query(User.id, User.department).filter(
+            User.id.in_({leave.teacher_id for leave in leaves})
+        ))
+        needs, by_slot = {}, {}
+        for leave in leaves:
+            slot = (departments[leave.teacher_id], leave.date, leave.session)
+            needs.setdefault(slot, []).append(leave.teacher_id)
+            by_slot[(slot, leave.teacher_id)] = leave
+
+        # Fresh indexes: the cached ones do not see this transaction's changes yet
+        free, indexes = {}, {}
+        for department, date, session in needs:
+            index = indexes.get((department, date))
+            if index is None:
+                index = indexes[(department, date)] = AvailabilityIndex.build(
+                    self.db, department, date, self.logic.store
+                )
+            bit = session_bit(session)
+            absent = set(needs[(department, date, session)])
+            free[(department, date, session)] = [
+                teacher_id for teacher_id in index.teacher_ids
+                if index.free_masks[teacher_id] & bit and teacher_id not in exclude and teacher_id not in absent
+            ]
+
+        load = self.logic.ranking.loads(
+            {teacher_id for ids in free.values() for teacher_id in ids}, max(date for _, date, _ in needs)
+        )
+
+        assignment, uncovered = assign_cover(needs, free, load)
+        for (slot, teacher_id), substitute_id in assignment.items():
+            leave = by_slot[(slot, teacher_id)]
+            try:
+                self.logic.book_substitute(substitute_id, leave.date.strftime('%A'), leave.session, leave.date)
+            except SubstituteUnavailable:
+                # Taken by a concurrent booking since the index was built
+                report.uncovered.append((teacher_id, leave.date, leave.session))
+                continue
+            leave.substitute_id = substitute_id
+            schedule_touched(self.db.session, [teacher_id, substitute_id], [slot[0]])
+            report.reassigned.append((teacher_id, leave.date, leave.session, substitute_id))
+        for slot, teacher_id in uncovered:
+            report.uncovered.append((teacher_id, slot[1], slot[2]))
+        self.db.session.flush()
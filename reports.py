@@ -0,0 +1,127 @@
+# reports.py
+import csv
+import heapq
+import io
+import itertools
+import json
+from contextlib import closing
+from datetime import datetime
+from sqlalchemy import select, or_, and_
+from sqlalchemy.orm import aliased
+from models import User, LeaveRequest
+from archive import LeaveRow, archived_leaves
+
+# Leave report for a department, newest first. Pages are addressed by a keyset cursor on
+# (date, id) instead of OFFSET, so page N costs the same as page 1. Leaves still in LeaveRequest
+# and archived ones (archive.py) are merged on the same (date, id) order.
+
+EXPORT_FIELDS = ("teacher", "substitute", "date", "session")
+
+
+def parse_filters(args):
+    # start/end (YYYY-MM-DD) and teacher (id) from the query string; raises ValueError on bad input
+    filters = {'start_date': None, 'end_date': None, 'teacher_id': None}
+    if args.get('start'):
+        filters['start_date'] = datetime.strptime(args['start'], '%Y-%m-%d').date()
+    if args.get('end'):
+        filters['end_date'] = datetime.strptime(args['end'], '%Y-%m-%d').date()
+    if args.get('teacher'):
+        filters['teacher_id'] = int(args['teacher'])
+    if filters['start_date'] and filters['end_date'] and filters['end_date'] < filters['start_date']:
+        raise ValueError("End date must not be before start date.")
+    return filters
+
+
+def encode_cursor(leave):
+    return f"{leave.date.isoformat()}_{leave.id}"
+
+
+def decode_cursor(cursor):
+    leave_date, leave_id = cursor.split('_')
+    return datetime.strptime(leave_date, '%Y-%m-%d').date(), int(leave_id)
+
+
+def _filter(statement, department, start_date=None, end_date=None, teacher_id=None):
+    statement = statement.where(User.department == department)
+    if start_date:
+        statement = statement.where(LeaveRequest.date >= start_date)
+    if end_date:
+        statement = statement.where(LeaveRequest.date <= end_date)
+    if teacher_id:
+        statement = statement.where(LeaveRequest.teacher_id == teacher_id)
+    return statement
+
+
+def report_query(department, start_date=None, end_date=None, teacher_id=None):
+    # (id, date, session, teacher, substitute) of the department's leaves, usernames joined in the same query
+    substitute = aliased(User)
+    statement = (
+        select(LeaveRequest.id, LeaveRequest.date, LeaveRequest.session, User.username, substitute.username)
+        .select_from(LeaveRequest)
+        .join(User, LeaveRequest.teacher_id == User.id)
+        .outerjoin(substitute, LeaveRequest.substitute_id == substitute.id)
+    )
+    statement = _filter(statement, department, start_date, end_date, teacher_id)
+    return statement.order_by(LeaveRequest.date.desc(), LeaveRequest.id.desc())
+
+
+def _newest_first(hot, archived):
+    # A leave is on both sides only while an archive batch is between its two commits; it is listed once
+    previous = None
+    for row in heapq.merge(hot, archived, key=lambda row: (row.date, row.id), reverse=True):
+        if (row.date, row.id) != previous:
+            yield row
+        previous = (row.date, row.id)
+
+
+def report_page(db, department, page_size, after=None, **filters):
+    # One page of LeaveRows after the cursor; returns (leaves, cursor of the next page or None)
+    statement = report_query(department, **filters)
+    before = None
+    if after:
+        before = decode_cursor(after)
+        statement = statement.where(or_(
+            LeaveRequest.date < before[0],
+            and_(LeaveRequest.date == before[0], LeaveRequest.id < before[1])
+        ))
+    # One extra row tells whether there is a next page
+    hot = [LeaveRow(*row) for row in db.session.execute(statement.limit(page_size + 1))]
+    with closing(archived_leaves(db, department, before=before, **filters)) as archived:
+        leaves = list(itertools.islice(_newest_first(hot, archived), page_size + 1))
+    next_cursor = encode_cursor(leaves[page_size - 1]) if len(leaves) > page_size else None
+    return leaves[:page_size], next_cursor
+
+
+def export_rows(db, department, batch_size=1000, **filters):
+    # LeaveRows fetched in batches from both sides; nothing accumulates in memory
+    statement = report_query(department, **filters)
+    hot = (LeaveRow(*row) for row in db.session.execute(statement.execution_options(yield_per=batch_size)))
+    with closing(archived_leaves(db, department, **filters)) as archived:
+        yield from _newest_first(hot, archived)
+
+
+def csv_stream(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow((row.teacher, row.substitute or "", row.date.isoformat(), row.session))
+        # Hand the buffer to the response every few hundred rows
+        if count % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def json_stream(rows):
+    # A JSON array written element by element, in chunks of a few hundred rows
+    chunk = ["["]
+    for count, row in enumerate(rows):
+        item = json.dumps(dict(zip(EXPORT_FIELDS, (row.teacher, row.substitute, row.date.isoformat(), row.session))))
+        chunk.append(item if count == 0 else "," + item)
+        if len(chunk) >= 500:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append("]")
+    yield "".join(chunk)
@@ -0,0 +1,63 @@
+# schedule.py
+from datetime import timedelta
+from sqlalchemy.orm import joinedload
+from models import Timetable, LeaveRequest
+
+
+def daterange(start_date, end_date):
+    # Inclusive range of dates
+    for offset in range((end_date - start_date).days + 1):
+        yield start_date + timedelta(days=offset)
+
+
+def resolve_schedule(teacher_id, start_date, end_date, store):
+    # Effective schedule of one teacher for every date in [start_date, end_date].
+    # One query per table; precedence matches get_timetable: date-specific > leave requests > day-based.
+    # Returns {date: [{'session', 'status', 'substitute'}, ...]} with sessions in order.
+    dates = list(daterange(start_date, end_date))
+    weekdays = {date.strftime('%A') for date in dates}
+
+    # Day-based schedule from whichever storage layout is configured
+    day_based = store.load([teacher_id], weekdays).get(teacher_id, {})
+
+    date_specific = {}
+    for entry in Timetable.query.filter(
+        Timetable.teacher_id == teacher_id,
+        Timetable.date >= start_date,
+        Timetable.date <= end_date
+    ):
+        date_specific.setdefault(entry.date, {})[entry.session] = entry.status
+
+    # Substitute names come from an eager join instead of one lookup per leave
+    leaves = {}
+    for leave in LeaveRequest.query.options(joinedload(LeaveRequest.substitute)).filter(
+        LeaveRequest.teacher_id == teacher_id,
+        LeaveRequest.date >= start_date,
+        LeaveRequest.date <= end_date
+    ):
+        leaves.setdefault(leave.date, {})[leave.session] = leave
+
+    schedule = {}
+    for date in dates:
+        day_entries = day_based.get(date.strftime('%A'), {})
+        date_entries = date_specific.get(date, {})
+        on_leave_sessions = leaves.get(date, {})
+        timetable_data = []
+        for session in sorted(set(day_entries) | set(date_entries)):
+            if session in date_entries:
+                status = date_entries[session]
+                substitute = None
+            elif session in on_leave_sessions:
+                status = 'On Leave'
+                leave = on_leave_sessions[session]
+                substitute = leave.substitute.username if leave.substitute else None
+            else:
+                status = day_entries.get(session, "Free")
+                substitute = None
+            timetable_data.append({
+                'session': session,
+                'status': status,
+                'substitute': substitute
+            })
+        schedule[date] = timetable_data
+    return schedule
@@ -0,0 +1,223 @@
+# schedule_cache.py
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+# Cache of resolved daily schedules ({teacher, date} -> get_timetable entries) and department
+# availability bitmaps ({department, date} -> free masks).
+# Entries are keyed by a per-teacher / per-department generation number and by the persisted data
+# version (data_versions.py). A commit in this process bumps the generation (see
+# signals.schedule_changed). A commit in any process bumps the teacher's DataVersion row in the same
+# transaction, which the key reads from the database, so other workers stop serving the old entry even
+# where the signal never reaches them. Older entries are never read again and age out of the LRU.
+# The key is read before the data is loaded and again afterwards, and the result is stored only if
+# the key did not change in between. A load that raced a commit is returned but not cached.
+#
+# Backends:
+#   "memory"         - per-process LRU (default)
+#   "sqlite:<path>"  - a SQLite file shared by all workers on the host; generations live in the same
+#                      file, so an invalidation in one worker is seen by the others
+#   "none"           - no caching
+
+
+class MemoryBackend:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}  # Never evicted: losing a generation could resurrect stale entries
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generation(self, name):
+        return self._generations.get(name, 0)
+
+    def bump(self, names):
+        with self._lock:
+            for name in names:
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            # Bumping instead of resetting keeps entries cached by concurrent readers unreachable
+            self._generations['all'] = self._generations.get('all', 0) + 1
+
+
+class SQLiteBackend:
+    # Approximate LRU: last-use time is refreshed at most every TOUCH_INTERVAL seconds per entry
+    TOUCH_INTERVAL = 30
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entry (key TEXT PRIMARY KEY, value BLOB NOT NULL, used REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_cache_entry_used ON cache_entry (used)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_generation (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")  # A lost write only costs a cache miss
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute("SELECT value, used FROM cache_entry WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > self.TOUCH_INTERVAL:
+            self._connection().execute("UPDATE cache_entry SET used = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache_entry (key, value, used) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), time.time())
+        )
+        self._writes += 1
+        if self._writes % 500 == 0:
+            # Evict the least recently used entries beyond the limit
+            connection.execute(
+                "DELETE FROM cache_entry WHERE key IN (SELECT key FROM cache_entry ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def generation(self, name):
+        row = self._connection().execute("SELECT value FROM cache_generation WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, names):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for name in names:
+                connection.execute(
+                    "INSERT INTO cache_generation (name, value) VALUES (?, 1) "
+                    "ON CONFLICT (name) DO UPDATE SET value = value + 1",
+                    (name,)
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache_entry")
+        self.bump(['all'])
+
+
+class ScheduleCache:
+    def __init__(self, backend, teacher_version=None, department_version=None):
+        self.backend = backend
+        # Persisted versions of a teacher's / a department's data, read from the database on every lookup
+        self.teacher_version = teacher_version or (lambda teacher_id: 0)
+        self.department_version = department_version or (lambda department: 0)
+        self.hits = 0
+        self.misses = 0
+
+    def _version(self, name, persisted):
+        # The global generation is part of every key so clear() also invalidates other workers
+        return f"{self.backend.generation('all')}.{self.backend.generation(name)}.{persisted}"
+
+    def _teacher_key(self, teacher_id):
+        return self._version(f"teacher:{teacher_id}", self.teacher_version(teacher_id))
+
+    def _department_key(self, department):
+        return self._version(f"department:{department}", self.department_version(department))
+
+    def schedule(self, teacher_id, start_date, end_date, load):
+        # {date: entries} for the window. load(start, end) resolves the dates that are not cached
+        # (once, for the smallest window covering them) and returns {date: entries}.
+        if self.backend is None:
+            return load(start_date, end_date)
+        version = self._teacher_key(teacher_id)
+        schedule, missing = {}, []
+        date = start_date
+        while date <= end_date:
+            entries = self.backend.get(f"schedule:{teacher_id}:{version}:{date.isoformat()}")
+            if entries is None:
+                missing.append(date)
+            else:
+                schedule[date] = entries
+            date += timedelta(days=1)
+        self.hits += (end_date - start_date).days + 1 - len(missing)
+        self.misses += len(missing)
+        if missing:
+            loaded = load(missing[0], missing[-1])
+            unchanged = self._teacher_key(teacher_id) == version
+            for date in missing:
+                schedule[date] = loaded[date]
+                if unchanged:
+                    self.backend.set(f"schedule:{teacher_id}:{version}:{date.isoformat()}", loaded[date])
+        return dict(sorted(schedule.items()))
+
+    def availability(self, department, date, load):
+        # (teacher_ids, free_masks) of the department on the date; callers get their own copy to mutate
+        if self.backend is None:
+            return load()
+        version = self._department_key(department)
+        key = f"availability:{department}:{version}:{date.isoformat()}"
+        cached = self.backend.get(key)
+        if cached is None:
+            self.misses += 1
+            cached = load()
+            if self._department_key(department) == version:
+                self.backend.set(key, cached)
+        else:
+            self.hits += 1
+        teacher_ids, free_masks = cached
+        return list(teacher_ids), dict(free_masks)
+
+    def invalidate(self, teacher_ids=(), departments=()):
+        names = [f"teacher:{teacher_id}" for teacher_id in teacher_ids]
+        names += [f"department:{department}" for department in departments]
+        if self.backend is not None and names:
+            self.backend.bump(names)
+
+    def on_schedule_changed(self, sender, teacher_ids=(), departments=()):
+        self.invalidate(teacher_ids, departments)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+def make_schedule_cache(setting, max_entries=10000, teacher_version=None, department_version=None):
+    if setting in (None, "", "none"):
+        return ScheduleCache(None)
+    if setting == "memory":
+        return ScheduleCache(MemoryBackend(max_entries), teacher_version, department_version)
+    if setting.startswith("sqlite:"):
+        return ScheduleCache(SQLiteBackend(setting[len("sqlite:"):], max_entries), teacher_version, department_version)
+    raise ValueError(f"Unknown schedule cache backend: {setting}")
@@ -0,0 +1,65 @@
+# signals.py
+from blinker import Namespace
+from sqlalchemy import event, select
+
+_signals = Namespace()
+
+# Sent after a commit that changed what get_timetable or the substitute search would return.
+# Receivers get sender=None, teacher_ids=set of teachers, departments=set of departments.
+schedule_changed = _signals.signal('schedule-changed')
+
+# Sent after a commit that removed users or changed their credentials. Receivers get user_ids=set.
+user_changed = _signals.signal('user-changed')
+
+_PENDING = 'schedule_changed'
+_PENDING_USERS = 'user_changed'
+
+
+def schedule_touched(session, teacher_ids=(), departments=()):
+    # Record teachers/departments whose schedule the current transaction changes. The signal is
+    # sent only once the transaction commits, so a cache refilled by a concurrent reader can
+    # never be invalidated too early; a rollback discards the record.
+    teachers, department_set = session.info.setdefault(_PENDING, (set(), set()))
+    teachers.update(teacher_ids)
+    department_set.update(department for department in departments if department)
+
+
+def pending_teachers(session):
+    # Teachers recorded by schedule_touched in the current transaction so far
+    pending = session.info.get(_PENDING)
+    return set(pending[0]) if pending else set()
+
+
+def user_touched(session, user_ids):
+    # Same commit-time delivery as schedule_touched, for user_changed
+    session.info.setdefault(_PENDING_USERS, set()).update(user_ids)
+
+
+def init_signals(db):
+    from models import User
+
+    def resolve_departments(session, flush_context=None):
+        # Departments of touched teachers, looked up while the transaction can still run SQL
+        pending = session.info.get(_PENDING)
+        if not pending or not pending[0]:
+            return
+        teachers, departments = pending
+        departments.update(row[0] for row in session.execute(
+            select(User.department).where(User.id.in_(list(teachers)))
+        ))
+
+    def send(session):
+        pending = session.info.pop(_PENDING, None)
+        if pending and (pending[0] or pending[1]):
+            schedule_changed.send(None, teacher_ids=pending[0], departments=pending[1])
+        users = session.info.pop(_PENDING_USERS, None)
+        if users:
+            user_changed.send(None, user_ids=users)
+
+    def discard(session):
+        session.info.pop(_PENDING, None)
+        session.info.pop(_PENDING_USERS, None)
+
+    event.listen(db.session, "before_commit", resolve_departments)
+    event.listen(db.session, "after_commit", send)
+    event.listen(db.session, "after_rollback", discard)
@@ -0,0 +1,348 @@
+# solver.py
+import hashlib
+import random
+import time
+from collections import namedtuple
+
+DEFAULT_MAX_CONSECUTIVE = 4
+DEFAULT_TIME_BUDGET = 5.0  # Seconds
+
+
+def max_busy_per_day(num_sessions, max_consecutive=DEFAULT_MAX_CONSECUTIVE):
+    # Largest busy count one day can hold without a run longer than max_consecutive
+    # while still keeping at least one free session
+    busy = num_sessions - num_sessions // (max_consecutive + 1)
+    return max(0, min(busy, num_sessions - 1))
+
+
+def enforce_day_constraints(statuses, max_consecutive=DEFAULT_MAX_CONSECUTIVE, rng=random):
+    # Patch one day's statuses (ordered by session) in place:
+    # break busy streaks longer than max_consecutive and keep at least one free session
+    consecutive = 0
+    for i, status in enumerate(statuses):
+        if status == "Busy":
+            consecutive += 1
+            if consecutive > max_consecutive:
+                statuses[i] = "Free"
+                consecutive = 0
+        else:
+            consecutive = 0
+    if statuses and all(status == "Busy" for status in statuses):
+        statuses[rng.randrange(len(statuses))] = "Free"
+    return statuses
+
+
+def _run_length(mask, index, num_sessions):
+    # Length of the busy run through `index` if that session were marked busy
+    length = 1
+    i = index - 1
+    while i >= 0 and (mask >> i) & 1:
+        length += 1
+        i -= 1
+    i = index + 1
+    while i < num_sessions and (mask >> i) & 1:
+        length += 1
+        i += 1
+    return length
+
+
+def _popcount(mask):
+    return bin(mask).count("1")
+
+
+class SolverResult:
+    def __init__(self, days, num_sessions, masks, shortfall, slot_shortfall, elapsed):
+        self.days = days
+        self.num_sessions = num_sessions
+        self.masks = masks  # teacher_id -> list of busy bitmasks, one per day
+        self.shortfall = shortfall  # teacher_id -> busy sessions that could not be placed
+        self.slot_shortfall = slot_shortfall  # (day, session) -> missing free teachers
+        self.elapsed = elapsed
+
+    @property
+    def complete(self):
+        return not self.shortfall and not self.slot_shortfall
+
+    def statuses(self, teacher_id):
+        # {day: {session: "Busy"/"Free"}} for one teacher
+        grid = {}
+        for day, mask in zip(self.days, self.masks[teacher_id]):
+            grid[day] = {
+                session: "Busy" if (mask >> (session - 1)) & 1 else "Free"
+                for session in range(1, self.num_sessions + 1)
+            }
+        return grid
+
+
+class DepartmentSolver:
+    # Builds day-based timetables for many teachers at once.
+    # Hard rules: at most `max_consecutive` busy sessions in a row, at least one free session per day,
+    # and at least `min_free` free teachers in every (day, session) so substitutes can be found.
+    # Each teacher's weekly busy count is a target that is met whenever the rules allow it.
+    def __init__(self, days, num_sessions, max_consecutive=DEFAULT_MAX_CONSECUTIVE,
+                 min_free=0, time_budget=DEFAULT_TIME_BUDGET, rng=None):
+        if num_sessions < 1:
+            raise ValueError("Number of sessions must be at least 1.")
+        self.days = list(days)
+        self.num_sessions = num_sessions
+        self.max_consecutive = max_consecutive
+        self.min_free = min_free  # int, or dict keyed by (day, session)
+        self.time_budget = time_budget
+        self.rng = rng or random.Random()
+        self.day_limit = max_busy_per_day(num_sessions, max_consecutive)
+
+    def _min_free(self, day, session):
+        if isinstance(self.min_free, dict):
+            return self.min_free.get((day, session), 0)
+        return self.min_free
+
+    def _sanitize_pins(self, busy, free):
+        # Same repairs as enforce_day_constraints, on bitmasks; freed sessions become pinned free
+        statuses = ["Busy" if (busy >> i) & 1 else "Free" for i in range(self.num_sessions)]
+        enforce_day_constraints(statuses, self.max_consecutive, self.rng)
+        fixed_busy = 0
+        for i, status in enumerate(statuses):
+            if status == "Busy":
+                fixed_busy |= 1 << i
+        return fixed_busy, free | (busy & ~fixed_busy)
+
+    def _fill_exact(self, mask, allowed, need):
+        # Exact fallback when the greedy pass gets stuck: DP over sessions choosing `need`
+        # extra sessions from `allowed` without breaking the streak limit
+        S, limit = self.num_sessions, self.max_consecutive
+        # states[(run, chosen)] = extra mask reaching that state
+        states = {(0, 0): 0}
+        for i in range(S):
+            pinned = (mask >> i) & 1
+            next_states = {}
+            for (run, chosen), extra in states.items():
+                if pinned:
+                    if run + 1 <= limit:
+                        next_states.setdefault((run + 1, chosen), extra)
+                    continue
+                next_states.setdefault((0, chosen), extra)
+                if (allowed >> i) & 1 and chosen < need and run + 1 <= limit:
+                    next_states.setdefault((run + 1, chosen + 1), extra | (1 << i))
+            states = next_states
+            if not states:
+                return None
+        for (run, chosen), extra in states.items():
+            if chosen == need:
+                return extra
+        return None
+
+    def _place(self, mask, blocked, need, capacity):
+        # Greedy: take the sessions with the most remaining capacity that keep streaks legal
+        S = self.num_sessions
+        candidates = [i for i in range(S) if not (blocked >> i) & 1 and capacity[i] > 0]
+        candidates.sort(key=lambda i: (-capacity[i], self.rng.random()))
+        placed = mask
+        remaining = need
+        for i in candidates:
+            if remaining == 0:
+                break
+            if _run_length(placed, i, S) > self.max_consecutive:
+                continue
+            placed |= 1 << i
+            remaining -= 1
+        if remaining == 0 or not candidates:
+            return placed, remaining
+
+        allowed = 0
+        for i in candidates:
+            allowed |= 1 << i
+        # Backtrack with the exact search, falling back to fewer sessions when the full count is infeasible
+        for target in range(need, need - remaining, -1):
+            extra = self._fill_exact(mask, allowed, target)
+            if extra is not None:
+                return mask | extra, need - target
+        return placed, remaining
+
+    def solve(self, teacher_ids, required_busy=None, fixed=None, others_free=None):
+        # teacher_ids: teachers to schedule
+        # required_busy: teacher_id -> weekly busy sessions (default: half of the grid)
+        # fixed: teacher_id -> {(day, session): status} cells that must be kept
+        # others_free: (day, session) -> free teachers in the department outside this solve
+        started = time.monotonic()
+        deadline = started + self.time_budget
+        D, S = len(self.days), self.num_sessions
+        full = (1 << S) - 1
+        teacher_ids = list(teacher_ids)
+        required_busy = required_busy or {}
+        fixed = fixed or {}
+        others_free = others_free or {}
+        day_index = {day: d for d, day in enumerate(self.days)}
+        default_required = (D * S) // 2
+
+        # Pinned cells, repaired against the per-day rules
+        pin_busy, pin_free = {}, {}
+        for teacher_id in teacher_ids:
+            busy, free = [0] * D, [0] * D
+            for (day, session), status in fixed.get(teacher_id, {}).items():
+                d = day_index.get(day)
+                if d is None or session < 1 or session > S:
+                    continue
+                if status == "Busy":
+                    busy[d] |= 1 << (session - 1)
+                else:
+                    free[d] |= 1 << (session - 1)
+            for d in range(D):
+                busy[d], free[d] = self._sanitize_pins(busy[d], free[d])
+            pin_busy[teacher_id], pin_free[teacher_id] = busy, free
+
+        # Remaining busy capacity per slot so that min_free teachers stay free
+        capacity = []
+        for day in self.days:
+            capacity.append([
+                len(teacher_ids) + others_free.get((day, session), 0) - self._min_free(day, session)
+                for session in range(1, S + 1)
+            ])
+        for teacher_id in teacher_ids:
+            for d in range(D):
+                busy = pin_busy[teacher_id][d]
+                i = 0
+                while busy:
+                    if busy & 1:
+                        capacity[d][i] -= 1
+                    busy >>= 1
+                    i += 1
+
+        # Spread each teacher's outstanding busy sessions over the days with the most room
+        targets = {}
+        for teacher_id in teacher_ids:
+            pinned = sum(_popcount(mask) for mask in pin_busy[teacher_id])
+            remaining = max(0, required_busy.get(teacher_id, default_required) - pinned)
+            room = []
+            for d in range(D):
+                open_cells = _popcount(full & ~pin_busy[teacher_id][d] & ~pin_free[teacher_id][d])
+                room.append(max(0, min(self.day_limit - _popcount(pin_busy[teacher_id][d]), open_cells)))
+            day_targets = [0] * D
+            order = sorted(range(D), key=lambda d: (-room[d], self.rng.random()))
+            while remaining > 0:
+                progressed = False
+                for d in order:
+                    if remaining == 0:
+                        break
+                    if day_targets[d] < room[d]:
+                        day_targets[d] += 1
+                        remaining -= 1
+                        progressed = True
+                if not progressed:
+                    break
+            targets[teacher_id] = (day_targets, remaining)
+
+        # Constructive pass, one day at a time, most demanding teachers first
+        masks = {teacher_id: list(pin_busy[teacher_id]) for teacher_id in teacher_ids}
+        shortfall = {teacher_id: targets[teacher_id][1] for teacher_id in teacher_ids}
+        for d in range(D):
+            order = sorted(teacher_ids, key=lambda t: (-targets[t][0][d], self.rng.random()))
+            for teacher_id in order:
+                need = targets[teacher_id][0][d]
+                if need == 0:
+                    continue
+                mask = masks[teacher_id][d]
+                blocked = mask | pin_free[teacher_id][d]
+                placed, missing = self._place(mask, blocked, need, capacity[d])
+                added = placed & ~mask
+                i = 0
+                while added:
+                    if added & 1:
+                        capacity[d][i] -= 1
+                    added >>= 1
+                    i += 1
+                masks[teacher_id][d] = placed
+                shortfall[teacher_id] += missing
+
+        # Local search for whatever is still missing, bounded by the time budget
+        for teacher_id in [t for t in teacher_ids if shortfall[t] > 0]:
+            if time.monotonic() > deadline:
+                break
+            shortfall[teacher_id] = self._repair(teacher_id, shortfall[teacher_id], masks, pin_busy,
+                                                 pin_free, capacity, teacher_ids, deadline)
+
+        slot_shortfall = {}
+        for d, day in enumerate(self.days):
+            for i in range(S):
+                if capacity[d][i] < 0:
+                    slot_shortfall[(day, i + 1)] = -capacity[d][i]
+
+        return SolverResult(
+            self.days, S, masks,
+            {t: missing for t, missing in shortfall.items() if missing > 0},
+            slot_shortfall,
+            time.monotonic() - started,
+        )
+
+    def _can_add(self, mask, blocked, i):
+        return (not (blocked >> i) & 1
+                and _popcount(mask) < self.day_limit
+                and _run_length(mask, i, self.num_sessions) <= self.max_consecutive)
+
+    def _repair(self, teacher_id, missing, masks, pin_busy, pin_free, capacity, teacher_ids, deadline):
+        S = self.num_sessions
+        days = sorted(range(len(self.days)), key=lambda d: _popcount(masks[teacher_id][d]))
+        for d in days:
+            i = 0
+            while i < S and missing > 0:
+                if time.monotonic() > deadline:
+                    return missing
+                mask = masks[teacher_id][d]
+                blocked = mask | pin_free[teacher_id][d]
+                if not self._can_add(mask, blocked, i):
+                    i += 1
+                    continue
+                if capacity[d][i] > 0:
+                    masks[teacher_id][d] = mask | (1 << i)
+                    capacity[d][i] -= 1
+                    missing -= 1
+                    i += 1
+                    continue
+                # Slot is full: move a colleague's non-pinned busy session elsewhere in the day
+                if self._swap_out(d, i, teacher_id, masks, pin_busy, pin_free, capacity, teacher_ids):
+                    masks[teacher_id][d] = mask | (1 << i)
+                    missing -= 1
+                i += 1
+        return missing
+
+    def _swap_out(self, d, i, teacher_id, masks, pin_busy, pin_free, capacity, teacher_ids):
+        S = self.num_sessions
+        bit = 1 << i
+        for other in teacher_ids:
+            if other == teacher_id:
+                continue
+            mask = masks[other][d]
+            if not mask & bit or pin_busy[other][d] & bit:
+                continue
+            without = mask & ~bit
+            blocked = without | pin_free[other][d] | bit
+            for j in range(S):
+                if capacity[d][j] > 0 and self._can_add(without, blocked, j):
+                    masks[other][d] = without | (1 << j)
+                    capacity[d][j] -= 1
+                    return True
+        return False
+
+
+# One department's solve, with every input it needs, so it can be sent to a worker process
+SolveTask = namedtuple('SolveTask', [
+    'department', 'teacher_ids', 'days', 'num_sessions', 'min_free', 'time_budget', 'seed', 'fixed', 'others_free'
+])
+
+
+def department_seed(seed, department):
+    # Seed for one department of a job: the same job seed gives the same timetables however the
+    # departments are spread over workers (hash() is salted per process, so use a digest)
+    digest = hashlib.sha256(f"{seed}:{department}".encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def solve_department(task, required_busy=None):
+    # Runs in the caller's process or a worker process; touches no database. Returns a SolverResult.
+    solver = DepartmentSolver(
+        task.days,
+        task.num_sessions,
+        min_free=task.min_free,
+        time_budget=task.time_budget,
+        rng=random.Random(task.seed)
+    )
+    return solver.solve(task.teacher_ids, required_busy=required_busy, fixed=task.fixed, others_free=task.others_free)
@@ -0,0 +1,166 @@
+# synthetic_data.py
+import csv
+import math
+import os
+import random
+from datetime import date, datetime, timedelta
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from models import User, Timetable, LeaveRequest
+from solver import enforce_day_constraints
+from signals import schedule_touched
+from ranking import covers_changed
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data analysis')
+
+
+class ScheduleProfile:
+    # Distributions measured from the sample data in "data analysis/"
+    def __init__(self, days, num_sessions, busy_probability, leaves_per_year, leave_session_weights):
+        self.days = days
+        self.num_sessions = num_sessions
+        self.busy_probability = busy_probability  # (day, session) -> probability of Busy
+        self.leaves_per_year = leaves_per_year  # Mean leave sessions per teacher per year
+        self.leave_session_weights = leave_session_weights  # session -> relative frequency
+
+    @classmethod
+    def from_csv(cls, schedule_path=None, leaves_path=None):
+        schedule_path = schedule_path or os.path.join(DATA_DIR, 'schedule.csv')
+        leaves_path = leaves_path or os.path.join(DATA_DIR, 'leaves.csv')
+
+        busy, total, days, num_sessions = {}, {}, [], 0
+        with open(schedule_path, newline='') as f:
+            for row in csv.DictReader(f):
+                key = (row['day'], int(row['session']))
+                total[key] = total.get(key, 0) + 1
+                busy[key] = busy.get(key, 0) + int(row['status'])
+                if row['day'] not in days:
+                    days.append(row['day'])
+                num_sessions = max(num_sessions, int(row['session']))
+
+        teachers, weights, first, last = set(), {}, None, None
+        count = 0
+        with open(leaves_path, newline='') as f:
+            for row in csv.DictReader(f):
+                leave_date = datetime.strptime(row['date'], '%Y-%m-%d').date()
+                teachers.add(row['teacher_id'])
+                session = int(row['session'])
+                weights[session] = weights.get(session, 0) + 1
+                first = leave_date if first is None else min(first, leave_date)
+                last = leave_date if last is None else max(last, leave_date)
+                count += 1
+        # Scale the observed window up to a full year
+        span_days = max(1, (last - first).days + 1) if count else 365
+        leaves_per_year = count / max(1, len(teachers)) * 365 / span_days if count else 0
+
+        return cls(
+            days,
+            num_sessions,
+            {key: busy[key] / total[key] for key in total},
+            leaves_per_year,
+            weights
+        )
+
+    def sample_grid(self, rng, days=None, num_sessions=None):
+        # One teacher's day-based grid {day: {session: status}}, repaired with the timetable rules
+        days = days or self.days
+        num_sessions = num_sessions or self.num_sessions
+        mean = sum(self.busy_probability.values()) / max(1, len(self.busy_probability))
+        grid = {}
+        for day in days:
+            statuses = [
+                "Busy" if rng.random() < self.busy_probability.get((day, session), mean) else "Free"
+                for session in range(1, num_sessions + 1)
+            ]
+            enforce_day_constraints(statuses, rng=rng)
+            grid[day] = dict(zip(range(1, num_sessions + 1), statuses))
+        return grid
+
+
+def generate(db, store, departments, teachers_per_department, year=None, seed=0, profile=None,
+             days=None, num_sessions=None, batch_size=5000):
+    # Populate the database with departments x teachers, their weekly grids and a year of leaves.
+    # Leaves are only placed on busy sessions and get a colleague who is free (by the day-based
+    # schedule and not already booked) as substitute, with the matching date-specific Busy row.
+    rng = random.Random(seed)
+    profile = profile or ScheduleProfile.from_csv()
+    year = year or date.today().year
+    days = days or profile.days
+    num_sessions = num_sessions or profile.num_sessions
+    password_hash = generate_password_hash("password")  # Hashed once; hashing per user would dominate
+
+    summary = {'users': 0, 'leaves': 0, 'substitutes': 0}
+    for d in range(departments):
+        department = f"Dept{d + 1}"
+        users = [{'username': f"hod{d + 1}", 'email': f"hod{d + 1}@example.com", 'password_hash': password_hash,
+                  'role': "HOD", 'department': department}]
+        users += [
+            {'username': f"teacher{d + 1}_{t + 1}", 'email': f"teacher{d + 1}_{t + 1}@example.com",
+             'password_hash': password_hash, 'role': "Teacher", 'department': department}
+            for t in range(teachers_per_department)
+        ]
+        db.session.execute(insert(User), users)
+        member_ids = [row[0] for row in db.session.query(User.id).filter(User.department == department).order_by(User.id)]
+        summary['users'] += len(member_ids)
+
+        grids = {teacher_id: profile.sample_grid(rng, days, num_sessions) for teacher_id in member_ids}
+        store.save_many(grids)
+
+        # Free teachers per (day, session) from the day-based grids
+        free_by_slot = {}
+        for teacher_id, grid in grids.items():
+            for day, sessions in grid.items():
+                for session, status in sessions.items():
+                    if status == "Free":
+                        free_by_slot.setdefault((day, session), []).append(teacher_id)
+
+        sessions_weighted = [s for s in range(1, num_sessions + 1) for _ in range(profile.leave_session_weights.get(s, 1))]
+        start = date(year, 1, 1)
+        leaves, overrides, booked, taken = [], [], set(), set()
+        for teacher_id in member_ids:
+            count = _poisson(rng, profile.leaves_per_year)
+            for _ in range(count):
+                leave_date = start + timedelta(days=rng.randrange(365))
+                day = leave_date.strftime('%A')
+                if day not in grids[teacher_id]:
+                    continue
+                session = rng.choice(sessions_weighted)
+                if grids[teacher_id][day].get(session) != "Busy" or (teacher_id, leave_date, session) in taken:
+                    continue
+                taken.add((teacher_id, leave_date, session))
+                candidates = [
+                    t for t in free_by_slot.get((day, session), [])
+                    if t != teacher_id and (t, leave_date, session) not in booked
+                    and (t, leave_date, session) not in taken
+                ]
+                substitute_id = rng.choice(candidates) if candidates else None
+                leaves.append({'teacher_id': teacher_id, 'substitute_id': substitute_id,
+                               'date': leave_date, 'session': session})
+                if substitute_id is not None:
+                    booked.add((substitute_id, leave_date, session))
+                    overrides.append({'teacher_id': substitute_id, 'day': day, 'session': session,
+                                      'status': "Busy", 'date': leave_date})
+        for i in range(0, len(leaves), batch_size):
+            db.session.execute(insert(LeaveRequest), leaves[i:i + batch_size])
+        covers_changed(db.session, [(leave['substitute_id'], leave['date'], 1) for leave in leaves])
+        for i in range(0, len(overrides), batch_size):
+            db.session.execute(insert(Timetable), overrides[i:i + batch_size])
+        schedule_touched(db.session, member_ids, [department])
+        db.session.commit()
+        summary['leaves'] += len(leaves)
+        summary['substitutes'] += len(overrides)
+    return summary
+
+
+def _poisson(rng, mean):
+    # Knuth's method; means here are small (a handful of leaves per teacher per year)
+    if mean <= 0:
+        return 0
+    if mean > 50:
+        return max(0, int(rng.gauss(mean, mean ** 0.5)))
+    limit, k, p = math.exp(-mean), 0, 1.0
+    while True:
+        p *= rng.random()
+        if p <= limit:
+            return k
+        k += 1
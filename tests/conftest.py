@@ -0,0 +1,42 @@
+# tests/conftest.py
+import os
+import sys
+import pytest
+
+# The application modules sit at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import db
+from flask_app import create_app
+from migrations import init_database
+
+HASH_METHOD = "pbkdf2:sha256:1"  # Tests sign in for real; their passwords need no strength
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    # create_app() on a fresh SQLite database in tmp_path, with the schema created. Background workers
+    # (outbox, coverage planner, metrics) stay off unless a test passes config that turns them on.
+    monkeypatch.chdir(tmp_path)  # db_config keeps its default instance/ folder under the working directory
+    apps = []
+
+    def make(**config):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'timetable.db'}",
+            'SQLALCHEMY_BINDS': {'archive': f"sqlite:///{tmp_path / 'timetable-archive.db'}"},
+            'MAIL_OUTBOX_ENABLED': False,
+            'COVER_PLAN_ENABLED': False,
+            'METRICS_ENABLED': False,
+            'PASSWORD_HASH_METHOD': HASH_METHOD,
+            **config,
+        })
+        with app.app_context():
+            init_database(db, log=lambda message: None)
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
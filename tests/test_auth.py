@@ -0,0 +1,33 @@
+# tests/test_auth.py
+import threading
+import time
+import pytest
+from auth import LoginOverloaded, PasswordHasher
+
+
+def test_checks_past_the_queue_are_refused():
+    # One hash running and one waiting fill a pool of one worker with a queue of one
+    hasher = PasswordHasher(workers=1, queue_size=1)
+    release = threading.Event()
+    started = threading.Event()
+    results = []
+
+    def slow_check(password):
+        started.set()
+        release.wait(5)
+        return password == "pw"
+
+    threads = [threading.Thread(target=lambda: results.append(hasher._run(slow_check, "pw"))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    while hasher._slots._value:  # Until the second request holds its place in the queue
+        time.sleep(0.01)
+
+    with pytest.raises(LoginOverloaded):
+        hasher._run(slow_check, "pw")
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [True, True]
+    assert hasher._run(lambda password: password == "pw", "pw")  # Slots are returned once the hashes finish
@@ -0,0 +1,131 @@
+# tests/test_booking.py
+import random
+import threading
+from datetime import date, timedelta
+import pytest
+from sqlalchemy import func, text
+from database import db
+from flask_app import services
+from models import User, LeaveRequest, Timetable
+from synthetic_data import generate
+from tests.conftest import HASH_METHOD
+from werkzeug.security import generate_password_hash
+
+
+@pytest.mark.parametrize("storage", ["rows", "packed"])
+def test_concurrent_bookings_never_double_book(make_app, storage):
+    # Many threads file leaves for the same date at once, so they compete for the same free colleagues;
+    # every busy session is requested twice to also race duplicate leaves
+    app = make_app(TIMETABLE_STORAGE=storage)
+    logic = services(app).timetable_logic
+    with app.app_context():
+        generate(db, logic.store, 1, 40, year=2025, seed=0)
+        department = User.query.filter_by(role="Teacher").first().department
+        members = [user.id for user in User.query.filter_by(department=department)]
+        grids = logic.store.load(members)
+
+    leave_date = date(2026, 1, 5)
+    day = leave_date.strftime('%A')
+    requests = [
+        (teacher_id, session)
+        for teacher_id in members
+        for session, status in grids.get(teacher_id, {}).get(day, {}).items()
+        if status == "Busy"
+    ] * 2
+    random.Random(0).shuffle(requests)
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        with app.app_context():
+            while True:
+                with lock:
+                    if not requests:
+                        return
+                    teacher_id, session = requests.pop()
+                try:
+                    logic.assign_substitute(teacher_id, leave_date, session)
+                except Exception as e:
+                    db.session.rollback()
+                    with lock:
+                        errors.append(f"{type(e).__name__}: {e}")
+
+    threads = [threading.Thread(target=worker) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    with app.app_context():
+        covers = LeaveRequest.query.filter(LeaveRequest.date == leave_date, LeaveRequest.substitute_id.isnot(None)).all()
+        assert covers
+        double_booked = db.session.query(LeaveRequest.substitute_id, LeaveRequest.session).filter(
+            LeaveRequest.date == leave_date, LeaveRequest.substitute_id.isnot(None)
+        ).group_by(LeaveRequest.substitute_id, LeaveRequest.session).having(func.count(LeaveRequest.id) > 1).all()
+        assert double_booked == []
+        duplicate_leaves = db.session.query(LeaveRequest.teacher_id, LeaveRequest.session).filter(
+            LeaveRequest.date == leave_date
+        ).group_by(LeaveRequest.teacher_id, LeaveRequest.session).having(func.count(LeaveRequest.id) > 1).all()
+        assert duplicate_leaves == []
+        # Every cover holds the substitute's date-specific Busy row, and no substitute covers while away
+        overrides = {(entry.teacher_id, entry.session) for entry in Timetable.query.filter_by(date=leave_date, status="Busy")}
+        away = {(leave.teacher_id, leave.session) for leave in LeaveRequest.query.filter_by(date=leave_date)}
+        for leave in covers:
+            assert (leave.substitute_id, leave.session) in overrides
+            assert (leave.substitute_id, leave.session) not in away
+
+
+@pytest.fixture
+def department(make_app):
+    # One absent teacher and one colleague free in session 1 on Mondays; the HOD teaches then
+    app = make_app(SCHEDULE_CACHE='memory')
+    logic = services(app).timetable_logic
+    with app.app_context():
+        ids = {}
+        for username, role in (("hod", "HOD"), ("absent", "Teacher"), ("colleague", "Teacher")):
+            user = User(username=username, email=f"{username}@example.com", role=role, department="CS",
+                        password_hash=generate_password_hash("pw", HASH_METHOD))
+            db.session.add(user)
+            db.session.flush()
+            ids[username] = user.id
+        logic.store.save_many({
+            ids["hod"]: {"Monday": {1: "Busy", 2: "Free"}},
+            ids["absent"]: {"Monday": {1: "Busy", 2: "Free"}},
+            ids["colleague"]: {"Monday": {1: "Free", 2: "Busy"}},
+        })
+        db.session.commit()
+    monday = date.today() + timedelta(days=7 - date.today().weekday())
+    with app.app_context():
+        # Cache the department's availability: the colleague is the only free member
+        assert logic.build_availability_index("CS", monday).free_teachers(1) == {ids["colleague"]}
+    return app, logic, ids, monday
+
+
+def test_booking_rechecks_day_based_timetable(department):
+    app, logic, ids, monday = department
+    with app.app_context():
+        # Another worker makes the colleague Busy; this process's cached availability does not see it
+        db.session.execute(text(
+            "UPDATE timetable SET status = 'Busy' WHERE teacher_id = :id AND day = 'Monday' AND session = 1"
+        ), {'id': ids["colleague"]})
+        db.session.commit()
+        assert logic.build_availability_index("CS", monday).free_teachers(1) == {ids["colleague"]}
+
+        assert logic.assign_substitute(ids["absent"], monday, 1) is None
+        assert Timetable.query.filter_by(teacher_id=ids["colleague"], date=monday).count() == 0
+
+
+def test_booking_rechecks_substitute_leave(department):
+    app, logic, ids, monday = department
+    with app.app_context():
+        # The colleague is away in that slot, filed by another worker after the availability was cached
+        db.session.execute(text(
+            "INSERT INTO leave_request (teacher_id, date, session) VALUES (:id, :date, 1)"
+        ), {'id': ids["colleague"], 'date': monday})
+        db.session.commit()
+
+        assert logic.assign_substitute(ids["absent"], monday, 1) is None
+        result = logic.assign_substitutes_bulk([ids["absent"]], monday, monday, [1])
+        assert result['covered'] == []
+        assert Timetable.query.filter_by(teacher_id=ids["colleague"], date=monday).count() == 0
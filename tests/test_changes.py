@@ -0,0 +1,87 @@
+# tests/test_changes.py
+import threading
+from datetime import date
+import pytest
+from werkzeug.security import generate_password_hash
+from database import db
+from flask_app import services
+from models import User, LeaveRequest
+from tests.conftest import HASH_METHOD
+
+
+@pytest.fixture
+def setup(make_app):
+    def make(**config):
+        app = make_app(**config)
+        with app.app_context():
+            ids = {}
+            for username in ("t1", "t2"):
+                user = User(username=username, email=f"{username}@example.com", role="Teacher", department="CS",
+                            password_hash=generate_password_hash("pw", HASH_METHOD))
+                db.session.add(user)
+                db.session.flush()
+                ids[username] = user.id
+            db.session.commit()
+        hubs.append(services(app).change_hub)
+        return app, services(app).change_hub, ids
+
+    hubs = []
+    yield make
+    for hub in hubs:
+        hub.stop()
+
+
+def file_leave(app, teacher_id, day):
+    with app.app_context():
+        db.session.add(LeaveRequest(teacher_id=teacher_id, date=day, session=1))
+        db.session.commit()
+
+
+def test_streams_wait_on_one_shared_hub(setup):
+    app, hub, ids = setup()
+    before = threading.active_count()
+    with app.app_context():
+        mine = [hub.subscribe(ids["t1"]) for _ in range(50)]
+        other = hub.subscribe(ids["t2"])
+    assert threading.active_count() <= before + 1  # The hub's reader thread, nothing per stream
+
+    file_leave(app, ids["t1"], date(2026, 3, 2))
+    for subscription in mine:
+        [(change_id, payload)] = hub.wait(subscription, 5)
+        assert payload == {'kinds': ["leave"], 'dates': ["2026-03-02"]}
+    assert hub.wait(other, 0.2) == []
+    assert hub.wait(mine[0], 0.1) == []  # Each change is handed over once
+
+    for subscription in mine + [other]:
+        hub.unsubscribe(subscription)
+    hub.unsubscribe(other)  # Closing twice is harmless
+    assert hub.subscriber_count() == 0
+
+
+def test_stream_behind_the_kept_broadcasts_is_reset(setup):
+    app, hub, ids = setup(CHANGE_BROADCASTS_KEPT=2)
+    with app.app_context():
+        reader, idle = hub.subscribe(ids["t1"]), hub.subscribe(ids["t1"])
+    for day in (2, 3, 4):
+        file_leave(app, ids["t1"], date(2026, 3, day))
+        assert len(hub.wait(reader, 5)) == 1  # One broadcast per commit
+    assert hub.wait(idle, 1) == []
+    assert idle.overflowed
+
+
+def test_overloaded_process_answers_503(setup):
+    app, hub, ids = setup(CHANGE_MAX_STREAMS=1)
+    client = app.test_client()
+    client.post("/login", data={"username": "t1", "password": "pw"})
+
+    first = client.get("/api/v1/changes", buffered=False)
+    assert first.status_code == 200
+    refused = client.get("/api/v1/changes")
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"] == "30"
+
+    first.close()  # Unsubscribes even though the stream was never read
+    assert hub.subscriber_count() == 0
+    again = client.get("/api/v1/changes", buffered=False)
+    assert again.status_code == 200
+    again.close()
@@ -0,0 +1,47 @@
+# tests/test_ical.py
+import re
+from werkzeug.security import generate_password_hash
+from database import db
+from flask_app import services
+from ical import TOKEN_SALT, feed_token
+from models import User
+from tests.conftest import HASH_METHOD
+
+
+def add_teacher(app):
+    with app.app_context():
+        user = User(username="t1", email="t1@example.com", role="Teacher", department="CS",
+                    password_hash=generate_password_hash("pw", HASH_METHOD))
+        db.session.add(user)
+        db.session.commit()
+        return user.id, feed_token(services(app).serializer, user)
+
+
+def dashboard_link(client):
+    return re.search(r'id="ical_url" value="http://localhost(/calendar/[^"]+\.ics)"', client.get("/dashboard").text).group(1)
+
+
+def test_replacing_the_link_revokes_earlier_ones(make_app):
+    app = make_app()
+    user_id, token = add_teacher(app)
+    with app.app_context():
+        legacy = services(app).serializer.dumps(user_id, salt=TOKEN_SALT)  # Signed before feed versions
+    client = app.test_client()
+    client.post("/login", data={"username": "t1", "password": "pw"})
+    old_link = dashboard_link(client)
+    for link in (f"/calendar/{token}.ics", f"/calendar/{legacy}.ics", old_link):
+        assert client.get(link).status_code == 200
+
+    client.post("/rotate_calendar_link")
+    for link in (f"/calendar/{token}.ics", f"/calendar/{legacy}.ics", old_link):
+        assert client.get(link).status_code == 404
+    new_link = dashboard_link(client)
+    response = client.get(new_link)
+    assert response.status_code == 200
+    assert response.text.startswith("BEGIN:VCALENDAR")
+
+
+def test_links_expire(make_app):
+    app = make_app(ICAL_TOKEN_MAX_AGE=-1)  # Already past its age when first used
+    _, token = add_teacher(app)
+    assert app.test_client().get(f"/calendar/{token}.ics").status_code == 404
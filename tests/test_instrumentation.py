@@ -0,0 +1,47 @@
+# tests/test_instrumentation.py
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from database import db
+from instrumentation import span
+
+
+def test_apps_keep_their_own_metrics(make_app):
+    enabled = make_app(METRICS_ENABLED=True)
+    disabled = make_app(METRICS_ENABLED=False)  # Created second; must not switch the first one off
+    with disabled.app_context():
+        with span("disabled.work"):
+            pass
+    with enabled.app_context():
+        with span("enabled.work"):
+            pass
+        rendered = enabled.extensions['instrumentation'].metrics.render()
+    assert 'span="enabled.work"' in rendered
+    assert "disabled.work" not in rendered
+    assert 'instrumentation' not in disabled.extensions
+
+
+def test_failed_statement_leaves_no_start_time(make_app):
+    app = make_app(METRICS_ENABLED=True)
+    with app.app_context():
+        with db.engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+            assert connection.info.get("query_started") == []
+            connection.execute(text("SELECT 1"))
+            assert connection.info.get("query_started") == []
+
+
+def test_metrics_needs_token_or_localhost(make_app):
+    client = make_app(METRICS_ENABLED=True).test_client()
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.5'}).status_code == 403
+    assert client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.5'}).status_code == 403
+
+    client = make_app(METRICS_ENABLED=True, METRICS_TOKEN="s3cret").test_client()
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.5'},
+                          headers={'Authorization': 'Bearer s3cret'})
+    assert response.status_code == 200
+    assert b"# TYPE http_request_duration_seconds histogram" in response.data
@@ -0,0 +1,99 @@
+# tests/test_migrations.py
+import pytest
+from sqlalchemy import create_engine, inspect
+from database import db
+from flask_app import create_app
+from migrations import MIGRATIONS, current_version, upgrade_database
+
+# The tables as the first release created them: no indexes besides the unique user columns
+BASELINE_SCHEMA = [
+    """CREATE TABLE user (
+        id INTEGER NOT NULL PRIMARY KEY,
+        username VARCHAR(80) NOT NULL UNIQUE,
+        email VARCHAR(120) NOT NULL UNIQUE,
+        password_hash VARCHAR(128) NOT NULL,
+        role VARCHAR(20) NOT NULL,
+        department VARCHAR(50) NOT NULL
+    )""",
+    """CREATE TABLE timetable (
+        id INTEGER NOT NULL PRIMARY KEY,
+        teacher_id INTEGER NOT NULL REFERENCES user (id),
+        day VARCHAR(10) NOT NULL,
+        date DATE,
+        session INTEGER NOT NULL,
+        status VARCHAR(10) NOT NULL,
+        substitute_id INTEGER REFERENCES user (id)
+    )""",
+    """CREATE TABLE leave_request (
+        id INTEGER NOT NULL PRIMARY KEY,
+        teacher_id INTEGER NOT NULL REFERENCES user (id),
+        substitute_id INTEGER REFERENCES user (id),
+        date DATE NOT NULL,
+        session INTEGER NOT NULL
+    )""",
+]
+
+BASELINE_ROWS = [
+    "INSERT INTO user VALUES (1, 'hod', 'hod@example.com', 'x', 'HOD', 'CS')",
+    "INSERT INTO user VALUES (2, 't1', 't1@example.com', 'x', 'Teacher', 'CS')",
+    "INSERT INTO user VALUES (3, 't2', 't2@example.com', 'x', 'Teacher', 'CS')",
+    # A day-based slot saved twice and a leave filed twice, as the old routes allowed
+    "INSERT INTO timetable VALUES (1, 2, 'Monday', NULL, 1, 'Free', NULL)",
+    "INSERT INTO timetable VALUES (2, 2, 'Monday', NULL, 1, 'Busy', NULL)",
+    "INSERT INTO timetable VALUES (3, 3, 'Monday', '2025-03-03', 1, 'Busy', NULL)",
+    "INSERT INTO leave_request VALUES (1, 2, 3, '2025-03-03', 1)",
+    "INSERT INTO leave_request VALUES (2, 2, NULL, '2025-03-03', 1)",
+]
+
+
+@pytest.fixture
+def baseline_app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    uri = f"sqlite:///{tmp_path / 'timetable.db'}"
+    engine = create_engine(uri)
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA + BASELINE_ROWS:
+            connection.exec_driver_sql(statement)
+    engine.dispose()
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': uri,
+        'SQLALCHEMY_BINDS': {'archive': f"sqlite:///{tmp_path / 'timetable-archive.db'}"},
+        'MAIL_OUTBOX_ENABLED': False,
+        'COVER_PLAN_ENABLED': False,
+        'METRICS_ENABLED': False,
+    })
+    yield app
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def test_baseline_database_upgrades_to_latest_version(baseline_app):
+    with baseline_app.app_context():
+        assert current_version(db) == 0
+        assert upgrade_database(db, log=lambda message: None) == MIGRATIONS[-1][0] == 11
+        assert current_version(db) == 11
+        assert 'feed_version' in {column['name'] for column in inspect(db.engine).get_columns('user')}
+
+        # Every index the models declare exists, in the main database and in the archive bind
+        for table in db.metadata.sorted_tables:
+            engine = db.engines[table.info.get('bind_key')]
+            existing = {index['name'] for index in inspect(engine).get_indexes(table.name)}
+            declared = {index.name for index in table.indexes}
+            assert declared <= existing, table.name
+
+        # Duplicates were cleared so the unique indexes could be built; the newest slot and first leave stay
+        with db.engine.connect() as connection:
+            slots = connection.exec_driver_sql(
+                "SELECT id, status FROM timetable WHERE date IS NULL").fetchall()
+            leaves = connection.exec_driver_sql("SELECT id, substitute_id FROM leave_request").fetchall()
+        assert slots == [(2, 'Busy')]
+        assert leaves == [(1, 3)]
+
+
+def test_upgrade_is_idempotent(baseline_app):
+    with baseline_app.app_context():
+        upgrade_database(db, log=lambda message: None)
+        applied = []
+        assert upgrade_database(db, log=applied.append) == 11
+        assert applied == []
@@ -0,0 +1,116 @@
+# tests/test_notifications.py
+import socket
+from datetime import datetime, timedelta
+import pytest
+from database import db
+from flask_app import services
+from models import Notification
+from notifications import queue_email
+
+aiosmtpd_controller = pytest.importorskip("aiosmtpd.controller")
+
+
+class Inbox:
+    # aiosmtpd handler that keeps every message with the client address of the connection it came on
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((session.peer, envelope.rcpt_tos, envelope.content.decode()))
+        return "250 OK"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_port():
+    return free_port()
+
+
+@pytest.fixture
+def smtp_server(smtp_port):
+    inbox = Inbox()
+    controller = aiosmtpd_controller.Controller(inbox, hostname="127.0.0.1", port=smtp_port)
+    controller.start()
+    yield inbox
+    controller.stop()
+
+
+@pytest.fixture
+def app(make_app, smtp_port):
+    return make_app(
+        MAIL_SERVER="127.0.0.1", MAIL_PORT=smtp_port, MAIL_USE_TLS=False, MAIL_USERNAME=None, MAIL_PASSWORD=None,
+        MAIL_OUTBOX_BATCH_SIZE=10, MAIL_OUTBOX_MAX_ATTEMPTS=3, MAIL_OUTBOX_BACKOFF=60,
+    )
+
+
+def queue(count):
+    for i in range(count):
+        queue_email(db, f"Notice {i}", [f"teacher{i}@example.com"], f"Body {i}", sender="office@example.com")
+    db.session.commit()
+
+
+def make_due():
+    # Stand in for the backoff delay passing
+    Notification.query.update({'next_attempt_at': datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+
+def test_batch_is_sent_over_one_connection(app, smtp_server):
+    with app.app_context():
+        queue(3)
+        assert services(app).outbox.drain() == 3
+        assert {row.status for row in Notification.query} == {"sent"}
+    assert sorted(rcpt for _, rcpt, _ in smtp_server.messages) == [
+        ["teacher0@example.com"], ["teacher1@example.com"], ["teacher2@example.com"]
+    ]
+    assert len({peer for peer, _, _ in smtp_server.messages}) == 1
+
+
+def test_refused_connection_is_retried_after_backoff(app, smtp_port):
+    with app.app_context():
+        queue(2)
+        failed_at = datetime.utcnow()
+        services(app).outbox.drain()  # Nothing is listening yet
+        for row in Notification.query:
+            assert (row.status, row.attempts) == ("pending", 1)
+            assert row.last_error
+            # First retry after MAIL_OUTBOX_BACKOFF seconds, with +-20% jitter
+            assert timedelta(seconds=47) < row.next_attempt_at - failed_at < timedelta(seconds=73)
+        assert services(app).outbox.drain() == 0  # Not due yet
+
+        inbox = Inbox()
+        controller = aiosmtpd_controller.Controller(inbox, hostname="127.0.0.1", port=smtp_port)
+        controller.start()
+        try:
+            make_due()
+            assert services(app).outbox.drain() == 2
+        finally:
+            controller.stop()
+        assert {(row.status, row.attempts) for row in Notification.query} == {("sent", 1)}
+    assert len(inbox.messages) == 2
+
+
+def test_dead_letter_after_attempt_limit(app):
+    with app.app_context():
+        queue(1)
+        outbox = services(app).outbox
+        delays = []
+        for attempt in range(3):
+            failed_at = datetime.utcnow()
+            outbox.drain()
+            row = Notification.query.one()
+            if row.status == "pending":
+                delays.append((row.next_attempt_at - failed_at).total_seconds())
+                make_due()
+        row = Notification.query.one()
+        assert (row.status, row.attempts) == ("dead", 3)
+        # The delay doubles between attempts
+        assert 47 < delays[0] < 73 and 95 < delays[1] < 145
+        make_due()
+        assert outbox.drain() == 0  # Dead letters are kept but never claimed again
+        assert Notification.query.one().status == "dead"
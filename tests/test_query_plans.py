@@ -0,0 +1,22 @@
+# tests/test_query_plans.py
+from database import db
+from query_plans import full_table_scans
+
+
+def test_routes_and_jobs_do_not_scan_hot_tables(make_app):
+    # The same check as flask check-query-plans, against an in-memory database at the latest schema
+    app = make_app(SQLALCHEMY_DATABASE_URI='sqlite://', SQLALCHEMY_BINDS={'archive': 'sqlite://'},
+                   SQLALCHEMY_ENGINE_OPTIONS={})
+    with app.app_context():
+        assert full_table_scans(db) == {}
+
+
+def test_missing_index_is_reported(make_app):
+    app = make_app(SQLALCHEMY_DATABASE_URI='sqlite://', SQLALCHEMY_BINDS={'archive': 'sqlite://'},
+                   SQLALCHEMY_ENGINE_OPTIONS={})
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("DROP INDEX ix_leave_substitute_date")
+        problems = full_table_scans(db)
+    assert problems
+    assert all(any(line.startswith("SCAN leave_request") for line in scans) for scans in problems.values())
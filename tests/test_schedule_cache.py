@@ -0,0 +1,88 @@
+# tests/test_schedule_cache.py
+from datetime import date, timedelta
+from werkzeug.security import generate_password_hash
+from database import db
+from flask_app import services
+from models import User
+from schedule_cache import MemoryBackend, ScheduleCache
+from signals import schedule_changed
+from tests.conftest import HASH_METHOD
+
+
+def seed(app):
+    with app.app_context():
+        ids = {}
+        for username in ("hod", "t1", "t2"):
+            user = User(username=username, email=f"{username}@example.com", role="HOD" if username == "hod" else "Teacher",
+                        department="CS", password_hash=generate_password_hash("pw", HASH_METHOD))
+            db.session.add(user)
+            db.session.flush()
+            ids[username] = user.id
+        services(app).timetable_logic.store.save_many({
+            teacher_id: {"Monday": {1: "Free", 2: "Busy"}} for teacher_id in ids.values()
+        })
+        db.session.commit()
+    return ids
+
+
+def test_commit_in_another_worker_reaches_memory_cache(make_app):
+    # Two apps on one database stand in for two workers; muting the signal keeps the writer's
+    # in-process invalidation from reaching the reader, as between real processes
+    reader, writer = make_app(SCHEDULE_CACHE='memory'), make_app(SCHEDULE_CACHE='memory')
+    ids = seed(reader)
+    monday = date.today() + timedelta(days=7 - date.today().weekday())
+    logic = services(reader).timetable_logic
+    with reader.app_context():
+        assert logic.effective_schedule(ids["t1"], monday, monday)[monday][0]['status'] == "Free"
+        assert ids["t1"] in logic.build_availability_index("CS", monday).free_teachers(1)
+
+    with writer.app_context(), schedule_changed.muted():
+        services(writer).coverage_repair.save_grids({ids["t1"]: {"Monday": {1: "Busy", 2: "Free"}}})
+        db.session.commit()
+
+    with reader.app_context():
+        assert logic.effective_schedule(ids["t1"], monday, monday)[monday][0]['status'] == "Busy"
+        assert ids["t1"] not in logic.build_availability_index("CS", monday).free_teachers(1)
+
+
+def test_load_racing_a_commit_is_not_stored():
+    versions = {1: 5}
+    loads = []
+
+    def load(start, end):
+        loads.append(start)
+        versions[1] += 1  # A commit lands while the (older) schedule is being read
+        return {start: [{'session': 1, 'status': "Free", 'substitute': None}]}
+
+    cache = ScheduleCache(MemoryBackend(100), teacher_version=lambda teacher_id: versions[teacher_id])
+    day = date(2026, 3, 2)
+    cache.schedule(1, day, day, load)
+    cache.schedule(1, day, day, load)
+    assert len(loads) == 2  # Neither result was filed under the version read before its load
+
+    cache.schedule(1, day, day, lambda start, end: {start: []})
+    assert cache.schedule(1, day, day, load) == {day: []}  # A quiet load is cached
+    assert len(loads) == 2
+
+
+def test_new_etag_never_comes_with_a_cached_body(make_app):
+    # The reader caches t1's day under the ETag's version; a commit in another worker moves both on
+    reader, writer = make_app(SCHEDULE_CACHE='memory'), make_app(SCHEDULE_CACHE='memory')
+    ids = seed(reader)
+    monday = date.today() + timedelta(days=7 - date.today().weekday())
+    client = reader.test_client()
+    client.post("/login", data={"username": "t1", "password": "pw"})
+    url = f"/api/v1/timetable?date={monday.isoformat()}"
+
+    first = client.get(url)
+    assert first.json[0]['status'] == "Free"
+    assert client.get(url, headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+    with writer.app_context(), schedule_changed.muted():
+        services(writer).coverage_repair.save_grids({ids["t1"]: {"Monday": {1: "Busy", 2: "Free"}}})
+        db.session.commit()
+
+    second = client.get(url, headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200
+    assert second.headers["ETag"] != first.headers["ETag"]
+    assert second.json[0]['status'] == "Busy"
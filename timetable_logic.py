@@ -2,7 +2,24 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
 from models import Timetable, User, LeaveRequest
-import random
+from availability import AvailabilityIndex, ALL_SESSIONS, session_bit
+from coverage import assign_cover
+from solver import SolveTask, solve_department, enforce_day_constraints, DEFAULT_MAX_CONSECUTIVE, DEFAULT_TIME_BUDGET
+from timetable_store import make_store
+from instrumentation import timed
+from schedule import resolve_schedule
+from schedule_cache import make_schedule_cache
+from data_versions import teacher_version, department_version
+from cover_plan import CoverPlanner
+from ranking import CoverRanking
+from signals import schedule_changed, schedule_touched
+from sqlalchemy.exc import IntegrityError, OperationalError
+import time
+
+
+class SubstituteUnavailable(Exception):
+    # The chosen substitute's slot was booked by a concurrent request
+    pass
 
 class TimetableLogic:
     def __init__(self, db, app):
@@ -10,7 +27,24 @@ class TimetableLogic:
         self.app = app
         # Define days of the week for scheduling
         self.days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+        # Day-based schedules live in Timetable rows or packed WeeklyPattern rows (TIMETABLE_STORAGE)
+        self.store = make_store(db, app.config.get('TIMETABLE_STORAGE', 'rows'))
+        # Resolved schedules and availability bitmaps, invalidated when a write commits (SCHEDULE_CACHE)
+        # in this process, and keyed on the persisted data versions for commits made by other workers
+        self.cache = make_schedule_cache(
+            app.config.get('SCHEDULE_CACHE', 'memory'),
+            app.config.get('SCHEDULE_CACHE_SIZE', 10000),
+            teacher_version=lambda teacher_id: teacher_version(db, teacher_id),
+            department_version=lambda department: department_version(db, department)
+        )
+        schedule_changed.connect(self.cache.on_schedule_changed)
+        # Cover counters over a rolling window of weeks, used to pick the least loaded substitute
+        self.ranking = CoverRanking(db, app.config.get('COVER_WINDOW_WEEKS', 8))
+        # Ranked substitutes planned ahead in the background, re-planned as schedules change (COVER_PLAN_*)
+        self.planner = CoverPlanner(app, db, self.store, self.ranking)
+        schedule_changed.connect(self.planner.on_schedule_changed)
 
+    @timed('timetable_logic.generate_timetable')
     def generate_timetable(self, teacher_id, num_days, num_sessions):
         # Validate input parameters
         if num_days < 1 or num_days > len(self.days):
@@ -20,97 +54,174 @@ class TimetableLogic:
         if num_sessions > 24:
             raise ValueError("Number of sessions per day cannot exceed 24 for performance reasons.")
 
-        # Select the days to schedule
-        selected_days = self.days[:num_days]
-
-        # Fetch the teacher's existing timetable entries (if any)
-        existing_entries = Timetable.query.filter_by(teacher_id=teacher_id, date=None).all()  # Only day-based entries
         teacher = User.query.get(teacher_id)
         if not teacher:
             raise ValueError("Teacher not found.")
 
-        # Initialize the timetable structure
-        timetable = []
-        for day in selected_days:
-            for session in range(1, num_sessions + 1):
-                # Check if an entry already exists for this day and session
-                existing_entry = next((entry for entry in existing_entries if entry.day == day and entry.session == session), None)
-                if existing_entry:
-                    # Use existing status (Busy/Free) if available
-                    status = existing_entry.status
-                else:
-                    # Default to "Free" if no prior entry exists; HOD can mark as "Busy" via UI
-                    status = random.choice(["Busy", "Free"])
+        # Existing day-based entries are kept; empty cells are filled by the department solver,
+        # which also accounts for colleagues' schedules when keeping substitutes available
+        result = self.generate_department_timetables(
+            teacher.department, num_days, num_sessions, teacher_ids=[teacher_id]
+        )
+        return self.timetable_entries(result, teacher_id)
+
+    @timed('timetable_logic.generate_department_timetables')
+    def generate_department_timetables(self, department, num_days, num_sessions, teacher_ids=None,
+                                       required_busy=None, min_free=None, seed=None, keep_existing=True):
+        # Solve day-based timetables for several teachers of a department in one call.
+        # Returns a SolverResult; use timetable_entries() to turn it into Timetable rows.
+        task = self.department_task(department, num_days, num_sessions, teacher_ids, min_free, seed, keep_existing)
+        return solve_department(task, required_busy)
+
+    def department_task(self, department, num_days, num_sessions, teacher_ids=None, min_free=None, seed=None,
+                        keep_existing=True):
+        # Everything the solver needs for one department, read from the database up front so the solve
+        # itself can run anywhere (see solve_department and generation.py)
+        if num_days < 1 or num_days > len(self.days):
+            raise ValueError("Number of days must be between 1 and 7.")
+        if num_sessions < 1 or num_sessions > 24:
+            raise ValueError("Number of sessions must be between 1 and 24.")
+
+        selected_days = self.days[:num_days]
+        members = [row[0] for row in self.db.session.query(User.id).filter(
+            User.role.in_(["Teacher", "HOD"]),
+            User.department == department
+        ).order_by(User.id)]
+        if teacher_ids is None:
+            teacher_ids = members
+        solve_ids = set(teacher_ids)
+
+        # Pin the existing day-based cells of the teachers being solved
+        fixed = {}
+        if keep_existing and teacher_ids:
+            for teacher_id, grid in self.store.load(teacher_ids).items():
+                cells = fixed.setdefault(teacher_id, {})
+                for day, sessions in grid.items():
+                    for session, status in sessions.items():
+                        cells[(day, session)] = status
+
+        # Colleagues outside the solve keep their schedules; count how many of them are free per slot
+        others = [member for member in members if member not in solve_ids]
+        others_free = {}
+        if others:
+            busy_counts = self.store.busy_counts(others, selected_days)
+            for day in selected_days:
+                for session in range(1, num_sessions + 1):
+                    others_free[(day, session)] = len(others) - busy_counts.get((day, session), 0)
 
-                # Create a new timetable entry (day-based, date=None)
-                entry = Timetable(
+        if min_free is None:
+            min_free = self.app.config.get('MIN_FREE_PER_SESSION', 1)
+        return SolveTask(
+            department, list(teacher_ids), selected_days, num_sessions, min_free,
+            self.app.config.get('SOLVER_TIME_BUDGET', DEFAULT_TIME_BUDGET), seed, fixed, others_free
+        )
+
+    def timetable_entries(self, result, teacher_id):
+        # Day-based Timetable objects (not added to the session) for one solved teacher
+        timetable = []
+        for day, sessions in result.statuses(teacher_id).items():
+            for session, status in sessions.items():
+                timetable.append(Timetable(
                     teacher_id=teacher_id,
                     day=day,
                     session=session,
                     status=status,
                     date=None  # Day-based entry
-                )
-                timetable.append(entry)
-
-        # Apply constraints and resolve conflicts using CSP backtracking
-        timetable = self.apply_constraints(timetable, teacher)
-
+                ))
         return timetable
 
+    @timed('timetable_logic.apply_constraints')
     def apply_constraints(self, timetable, teacher):
-        # Constraint 1: Ensure no teacher has more than 4 consecutive busy sessions per day
-        for day in set(entry.day for entry in timetable):
-            day_entries = [entry for entry in timetable if entry.day == day and entry.date is None]
+        # Enforce the per-day rules on a list of day-based entries:
+        # at most 4 consecutive busy sessions and at least one free session per day
+        entries_by_day = {}
+        for entry in timetable:
+            if entry.date is None:
+                entries_by_day.setdefault(entry.day, []).append(entry)
+
+        for day_entries in entries_by_day.values():
             day_entries.sort(key=lambda x: x.session)
+            statuses = enforce_day_constraints([entry.status for entry in day_entries], DEFAULT_MAX_CONSECUTIVE)
+            for entry, status in zip(day_entries, statuses):
+                entry.status = status
 
-            consecutive_busy = 0
-            for entry in day_entries:
-                if entry.status == "Busy":
-                    consecutive_busy += 1
-                    if consecutive_busy > 4:
-                        # Mark the session as Free to break the streak
-                        entry.status = "Free"
-                        consecutive_busy = 0
-                else:
-                    consecutive_busy = 0
+        return timetable
 
-        # Constraint 2: Ensure teachers have at least one free session per day
-        for day in set(entry.day for entry in timetable):
-            day_entries = [entry for entry in timetable if entry.day == day and entry.date is None]
-            if all(entry.status == "Busy" for entry in day_entries):
-                # Randomly mark one session as Free
-                random.choice(day_entries).status = "Free"
+    @timed('timetable_logic.effective_schedule')
+    def effective_schedule(self, teacher_id, start_date, end_date):
+        # {date: [{'session', 'status', 'substitute'}]} as get_timetable shows it, served from the cache
+        return self.cache.schedule(
+            teacher_id, start_date, end_date,
+            lambda start, end: resolve_schedule(teacher_id, start, end, self.store)
+        )
 
-        return timetable
+    @timed('timetable_logic.build_availability_index')
+    def build_availability_index(self, department, date):
+        # Bulk free/busy bitmasks for the whole department on the given date
+        def load():
+            index = AvailabilityIndex.build(self.db, department, date, self.store)
+            return index.teacher_ids, index.free_masks
 
-    def find_alternative_substitute(self, teacher, day, session, date):
-        # Find potential substitutes in the same department, excluding the teacher
-        potential_substitutes = User.query.filter(
-            User.role.in_(["Teacher", "HOD"]),
-            User.department == teacher.department,
-            User.id != teacher.id
-        ).all()
-
-        for user in potential_substitutes:
-            # Check if the substitute is free in this session on this date
-            sub_entry = Timetable.query.filter_by(
-                teacher_id=user.id,
+        teacher_ids, free_masks = self.cache.availability(department, date, load)
+        return AvailabilityIndex(department, date, teacher_ids, free_masks)
+
+    @timed('timetable_logic.find_alternative_substitute')
+    def find_alternative_substitute(self, teacher, day, session, date, index=None, exclude=()):
+        # Find the free colleague in the same department with the fewest recent covers, excluding the teacher.
+        # Availability follows the get_timetable precedence: date-specific > leave > day-based.
+        if index is None:
+            index = self.build_availability_index(teacher.department, date)
+        candidates = index.free_teachers(session).difference({teacher.id}, exclude)
+        if not candidates:
+            return None
+        substitute_id = self.ranking.least_loaded(candidates, date)
+        return User.query.get(substitute_id)
+
+    def lock_teachers(self, teacher_ids):
+        # Lock the teachers' User rows until commit, in id order, so bookings, leaves and timetable saves
+        # touching one teacher run one at a time and each re-check sees the others' commits. SQLite needs
+        # no lock: a transaction's first write already keeps every other writer out until it commits.
+        if not teacher_ids or self.db.engine.dialect.name == "sqlite":
+            return
+        self.db.session.query(User.id).filter(User.id.in_(sorted(set(teacher_ids)))).order_by(User.id).with_for_update().all()
+
+    def book_substitute(self, substitute_id, day, session, date):
+        # Claim the substitute's slot atomically. A Free date-specific row is flipped by a conditional
+        # UPDATE (zero rows means someone else took it); a missing row is inserted and the partial
+        # unique index uq_timetable_date_slot rejects a concurrent insert at flush. Only an inserted row
+        # carries substitute_id, so releasing the booking can tell the two apart (repair.py).
+        # The candidate was chosen from reads made before this transaction wrote anything, so the rest of
+        # the precedence is read again after the write: with no date-specific row the day-based slot must
+        # not be Busy, and the substitute must not be on leave in the slot.
+        self.lock_teachers([substitute_id])
+        claimed = Timetable.query.filter_by(
+            teacher_id=substitute_id,
+            session=session,
+            date=date,
+            status="Free"
+        ).update({'status': "Busy"}, synchronize_session='fetch')
+        if not claimed:
+            if Timetable.query.filter_by(teacher_id=substitute_id, session=session, date=date).first():
+                raise SubstituteUnavailable(substitute_id)
+            self.db.session.add(Timetable(
+                teacher_id=substitute_id,
                 day=day,
                 session=session,
-                date=date
-            ).first()
-            if not sub_entry or sub_entry.status == "Free":
-                # Ensure the substitute is not on leave for that specific date and session
-                leave = LeaveRequest.query.filter_by(
-                    teacher_id=user.id,
-                    date=date,
-                    session=session
-                ).first()
-                if not leave:
-                    return user
-        return None
+                status="Busy",  # Mark as Busy for this date and session
+                date=date,
+                substitute_id=substitute_id  # Inserted by the booking: a release deletes it
+            ))
+            self.db.session.flush()
+            if self.store.status(substitute_id, day, session) == "Busy":
+                raise SubstituteUnavailable(substitute_id)
+        if LeaveRequest.query.filter_by(teacher_id=substitute_id, date=date, session=session).first():
+            raise SubstituteUnavailable(substitute_id)
 
-    def assign_substitute(self, teacher_id, date, session):
+    @timed('timetable_logic.assign_substitute')
+    def assign_substitute(self, teacher_id, date, session, commit=True):
+        # With commit=False the caller commits, e.g. together with queued notifications.
+        # Concurrent requests may pick the same substitute; the loser of the race gets a unique
+        # constraint error (or an already-busy slot) and retries with that colleague excluded.
         teacher = User.query.get(teacher_id)
         if not teacher:
             return None
@@ -118,47 +229,229 @@ class TimetableLogic:
         # Determine the day of the week for the given date
         day = date.strftime('%A')
 
-        # Check if the teacher is busy in that session on that day
-        entry = Timetable.query.filter_by(
-            teacher_id=teacher_id,
-            day=day,
-            session=session,
-            date=None  # Check day-based entry
-        ).first()
-        if not entry or entry.status != "Busy":
+        # Check if the teacher is busy in that session on that day (day-based schedule)
+        if self.store.status(teacher_id, day, session) != "Busy":
             return None  # No need for a substitute if the teacher is not busy
 
-        # Find a substitute
-        substitute = self.find_alternative_substitute(teacher, day, session, date)
-        if substitute:
-            # Create a leave request entry
-            leave = LeaveRequest(
-                teacher_id=teacher_id,
-                substitute_id=substitute.id,
-                date=date,
-                session=session
+        # Planned candidates that are still free are tried first, in plan order; the live search
+        # covers unplanned slots and a used-up plan
+        planned = self.planner.candidates(teacher.department, date, session)
+        if planned:
+            planned = self.planner.still_free(
+                teacher.department, date, session, [candidate for candidate in planned if candidate != teacher_id]
             )
-            self.db.session.add(leave)
+        planned = planned or []
+        excluded = set()
+        retries = self.app.config.get('BOOKING_RETRIES', 5)
+        for attempt in range(retries):
+            planned = [candidate for candidate in planned if candidate not in excluded]
+            if planned:
+                substitute = User.query.get(planned.pop(0))
+            else:
+                substitute = self.find_alternative_substitute(teacher, day, session, date, exclude=excluded)
+            if not substitute:
+                return None
+            substitute_id = substitute.id
+            try:
+                self.lock_teachers([teacher_id, substitute_id])
+                # Create a leave request entry; uq_leave_teacher_date_session rejects a duplicate leave
+                self.db.session.add(LeaveRequest(
+                    teacher_id=teacher_id,
+                    substitute_id=substitute_id,
+                    date=date,
+                    session=session
+                ))
+                self.book_substitute(substitute_id, day, session, date)
+                schedule_touched(self.db.session, [teacher_id, substitute_id], [teacher.department])
+                if commit:
+                    self.db.session.commit()
+                else:
+                    self.db.session.flush()
+                return substitute
+            except (IntegrityError, SubstituteUnavailable):
+                self.db.session.rollback()
+                if LeaveRequest.query.filter_by(teacher_id=teacher_id, date=date, session=session).first():
+                    return None  # A concurrent request already filed this leave
+                excluded.add(substitute_id)
+            except OperationalError:
+                # "database is locked" after the busy timeout; back off and try again
+                self.db.session.rollback()
+                time.sleep(0.05 * (attempt + 1))
+            teacher = User.query.get(teacher_id)
+        return None
 
-            # Update the substitute's timetable for this specific date and session
-            sub_entry = Timetable.query.filter_by(
-                teacher_id=substitute.id,
-                day=day,
-                session=session,
-                date=date
-            ).first()
-            if not sub_entry:
-                sub_entry = Timetable(
-                    teacher_id=substitute.id,
-                    day=day,
-                    session=session,
-                    status="Busy",  # Mark as Busy for this date and session
-                    date=date
+    @timed('timetable_logic.assign_substitutes_bulk')
+    def assign_substitutes_bulk(self, teacher_ids, start_date, end_date, sessions=None, commit=True):
+        # Cover every busy session of several teachers over a date range in one assignment problem.
+        # sessions: optional set of sessions the teachers are away for (default: whole days).
+        # Absences without a free colleague are still recorded, without a substitute.
+        if end_date < start_date:
+            raise ValueError("End date must not be before start date.")
+        num_dates = (end_date - start_date).days + 1
+        if num_dates > self.app.config.get('BULK_LEAVE_MAX_DAYS', 62):
+            raise ValueError("Leave range is too long.")
+
+        teacher_ids = sorted(set(teacher_ids))
+        teachers = User.query.filter(User.id.in_(teacher_ids)).all()
+        if len(teachers) != len(teacher_ids):
+            raise ValueError("Teacher not found.")
+        wanted = set(sessions) if sessions else None
+        away_mask = ALL_SESSIONS
+        if wanted:
+            away_mask = 0
+            for session in wanted:
+                away_mask |= session_bit(session)
+
+        # Concurrent bookings surface as unique constraint errors or already-busy slots at write time;
+        # the whole plan is then recomputed against the committed state, bypassing the availability cache
+        retries = self.app.config.get('BOOKING_RETRIES', 5)
+        for attempt in range(retries):
+            try:
+                return self._book_bulk(teachers, wanted, away_mask, start_date, num_dates, commit, fresh=attempt > 0)
+            except (IntegrityError, SubstituteUnavailable, OperationalError):
+                self.db.session.rollback()
+                if attempt == retries - 1:
+                    raise
+                time.sleep(0.05 * (attempt + 1))
+
+    def _book_bulk(self, teachers, wanted, away_mask, start_date, num_dates, commit, fresh=False):
+        teacher_ids = [teacher.id for teacher in teachers]
+        end_date = start_date + timedelta(days=num_dates - 1)
+
+        # Day-based busy sessions of the absent teachers and leaves they already hold
+        busy = {}
+        for teacher_id, grid in self.store.load(teacher_ids).items():
+            for day, sessions in grid.items():
+                busy[(teacher_id, day)] = [session for session, status in sessions.items() if status == "Busy"]
+        existing = {
+            (leave.teacher_id, leave.date, leave.session)
+            for leave in LeaveRequest.query.filter(
+                LeaveRequest.teacher_id.in_(teacher_ids),
+                LeaveRequest.date >= start_date,
+                LeaveRequest.date <= end_date
+            )
+        }
+
+        # Sessions needing cover, keyed by (department, date, session)
+        dates = [start_date + timedelta(days=offset) for offset in range(num_dates)]
+        needs = {}
+        absent = {}  # (department, date) -> {teacher_id: sessions away bitmask}
+        for teacher in teachers:
+            for date in dates:
+                absent.setdefault((teacher.department, date), {})[teacher.id] = away_mask
+                for session in sorted(busy.get((teacher.id, date.strftime('%A')), [])):
+                    if wanted and session not in wanted:
+                        continue
+                    if (teacher.id, date, session) in existing:
+                        continue
+                    needs.setdefault((teacher.department, date, session), []).append(teacher.id)
+
+        # Free colleagues per slot from one availability index per (department, date)
+        free = {}
+        indexes = {}
+        for department, date, session in needs:
+            index = indexes.get((department, date))
+            if index is None:
+                index = indexes[(department, date)] = (
+                    AvailabilityIndex.build(self.db, department, date, self.store) if fresh
+                    else self.build_availability_index(department, date)
                 )
-                self.db.session.add(sub_entry)
+            away = absent.get((department, date), {})
+            bit = session_bit(session)
+            free[(department, date, session)] = [
+                teacher_id for teacher_id in index.teacher_ids
+                if index.free_masks[teacher_id] & bit and not away.get(teacher_id, 0) & bit
+            ]
+
+        # Recent covers from the counters count towards balancing
+        load = self.ranking.loads({teacher_id for ids in free.values() for teacher_id in ids}, end_date)
+
+        assignment, uncovered = assign_cover(needs, free, load)
+
+        # Write every leave and substitute booking in one transaction (committed here unless commit=False)
+        substitute_ids = set(assignment.values())
+        booked = {}
+        if substitute_ids:
+            for entry in Timetable.query.filter(
+                Timetable.teacher_id.in_(substitute_ids),
+                Timetable.date >= start_date,
+                Timetable.date <= end_date
+            ):
+                booked[(entry.teacher_id, entry.date, entry.session)] = entry
+
+        covered = []
+        inserted = []  # (substitute_id, date, session) of booking rows written without an override
+        try:
+            self.lock_teachers(set(teacher_ids) | substitute_ids)
+            for (department, date, session), teacher_ids_in_slot in needs.items():
+                for teacher_id in teacher_ids_in_slot:
+                    substitute_id = assignment.get(((department, date, session), teacher_id))
+                    self.db.session.add(LeaveRequest(
+                        teacher_id=teacher_id,
+                        substitute_id=substitute_id,
+                        date=date,
+                        session=session
+                    ))
+                    if substitute_id is None:
+                        continue
+                    sub_entry = booked.get((substitute_id, date, session))
+                    if sub_entry is None:
+                        self.db.session.add(Timetable(
+                            teacher_id=substitute_id,
+                            day=date.strftime('%A'),
+                            session=session,
+                            status="Busy",  # Mark as Busy for this date and session
+                            date=date,
+                            substitute_id=substitute_id  # Inserted by the booking: a release deletes it
+                        ))
+                        inserted.append((substitute_id, date, session))
+                    else:
+                        # Only a still-Free override may be claimed
+                        claimed = Timetable.query.filter_by(id=sub_entry.id, status="Free").update(
+                            {'status': "Busy"}, synchronize_session=False
+                        )
+                        if not claimed:
+                            raise SubstituteUnavailable(substitute_id)
+                    covered.append((teacher_id, date, session, substitute_id))
+            self.db.session.flush()
+            self._recheck_bookings(inserted, covered, start_date, end_date)
+            schedule_touched(
+                self.db.session,
+                set(teacher_ids) | set(assignment.values()),
+                {department for department, _, _ in needs}
+            )
+            if commit:
+                self.db.session.commit()
             else:
-                sub_entry.status = "Busy"
+                self.db.session.flush()
+        except Exception:
+            self.db.session.rollback()
+            raise
+
+        return {
+            'covered': sorted(covered, key=lambda item: (item[1], item[2], item[0])),
+            'uncovered': sorted(
+                ((teacher_id, date, session) for (_, date, session), teacher_id in uncovered),
+                key=lambda item: (item[1], item[2], item[0])
+            ),
+        }
 
-            self.db.session.commit()
-            return substitute
-        return None
\ No newline at end of file
+    def _recheck_bookings(self, inserted, covered, start_date, end_date):
+        # book_substitute's re-checks for a whole batch, after its rows are written: slots booked without an
+        # override must not be Busy in the substitute's day-based timetable, and no substitute may be on
+        # leave in a slot they cover. Two queries; SubstituteUnavailable makes the caller re-plan.
+        if inserted:
+            grids = self.store.load({substitute_id for substitute_id, _, _ in inserted})
+            for substitute_id, date, session in inserted:
+                if grids.get(substitute_id, {}).get(date.strftime('%A'), {}).get(session) == "Busy":
+                    raise SubstituteUnavailable(substitute_id)
+        bookings = {(substitute_id, date, session) for _, date, session, substitute_id in covered}
+        if not bookings:
+            return
+        for leave in LeaveRequest.query.filter(
+            LeaveRequest.teacher_id.in_({substitute_id for substitute_id, _, _ in bookings}),
+            LeaveRequest.date >= start_date,
+            LeaveRequest.date <= end_date
+        ):
+            if (leave.teacher_id, leave.date, leave.session) in bookings:
+                raise SubstituteUnavailable(leave.teacher_id)
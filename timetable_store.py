@@ -0,0 +1,213 @@
+# timetable_store.py
+from sqlalchemy import select, literal, func, insert, update, delete
+from models import Timetable, User, WeeklyPattern
+from signals import schedule_touched
+
+# Day-based schedules can be kept in two layouts:
+#   "rows"   - one Timetable row per (teacher, day, session), the original layout
+#   "packed" - one WeeklyPattern row per (teacher, day) holding a busy bitmask
+# Date-specific overrides always stay sparse Timetable rows (date set).
+# Both stores expose the same read/write methods so TimetableLogic and the routes work with either.
+
+LAYOUTS = ("rows", "packed")
+
+
+class RowTimetableStore:
+    layout = "rows"
+
+    def __init__(self, db):
+        self.db = db
+
+    def load(self, teacher_ids, days=None):
+        # {teacher_id: {day: {session: status}}} for the given teachers
+        query = Timetable.query.filter(Timetable.teacher_id.in_(list(teacher_ids)), Timetable.date.is_(None))
+        if days is not None:
+            query = query.filter(Timetable.day.in_(list(days)))
+        grids = {}
+        for entry in query:
+            grids.setdefault(entry.teacher_id, {}).setdefault(entry.day, {})[entry.session] = entry.status
+        return grids
+
+    def status(self, teacher_id, day, session):
+        entry = Timetable.query.filter_by(teacher_id=teacher_id, day=day, session=session, date=None).first()
+        return entry.status if entry else None
+
+    def busy_counts(self, teacher_ids, days):
+        # {(day, session): number of the given teachers that are Busy}
+        return {
+            (day, session): count
+            for day, session, count in self.db.session.query(
+                Timetable.day, Timetable.session, func.count(Timetable.id)
+            ).filter(
+                Timetable.teacher_id.in_(list(teacher_ids)),
+                Timetable.date.is_(None),
+                Timetable.day.in_(list(days)),
+                Timetable.status == "Busy"
+            ).group_by(Timetable.day, Timetable.session)
+        }
+
+    def save(self, teacher_id, grid):
+        # Replace the teacher's day-based schedule with grid {day: {session: status}}
+        return self.save_many({teacher_id: grid})
+
+    def save_many(self, grids):
+        # Diff the submitted grids against the stored rows and write only what changed,
+        # through bulk UPDATE / INSERT / DELETE statements. Returns the number of cells written.
+        if not grids:
+            return 0
+        schedule_touched(self.db.session, grids)
+        stored = {}
+        for entry_id, teacher_id, day, session, status in self.db.session.query(
+            Timetable.id, Timetable.teacher_id, Timetable.day, Timetable.session, Timetable.status
+        ).filter(Timetable.teacher_id.in_(list(grids)), Timetable.date.is_(None)):
+            stored[(teacher_id, day, session)] = (entry_id, status)
+
+        updates, inserts = [], []
+        for teacher_id, grid in grids.items():
+            for day, sessions in grid.items():
+                for session, status in sessions.items():
+                    current = stored.pop((teacher_id, day, session), None)
+                    if current is None:
+                        inserts.append({'teacher_id': teacher_id, 'day': day, 'session': session,
+                                        'status': status, 'date': None})
+                    elif current[1] != status:
+                        updates.append({'id': current[0], 'status': status})
+        # Cells no longer in the grid (e.g. fewer days or sessions than before)
+        deletes = [entry_id for entry_id, _ in stored.values()]
+
+        if deletes:
+            self.db.session.execute(delete(Timetable).where(Timetable.id.in_(deletes)))
+        if updates:
+            self.db.session.execute(update(Timetable), updates)
+        if inserts:
+            self.db.session.execute(insert(Timetable), inserts)
+        return len(updates) + len(inserts) + len(deletes)
+
+    def delete(self, teacher_id):
+        schedule_touched(self.db.session, [teacher_id])
+        Timetable.query.filter_by(teacher_id=teacher_id, date=None).delete()
+
+    def department_day_query(self, department, day):
+        # (teacher_id, session, status, kind) rows for the availability index
+        return (
+            select(Timetable.teacher_id, Timetable.session, Timetable.status, literal('day').label('kind'))
+            .join(User, Timetable.teacher_id == User.id)
+            .where(User.department == department, Timetable.day == day, Timetable.date.is_(None))
+        )
+
+
+class PackedTimetableStore:
+    layout = "packed"
+
+    def __init__(self, db):
+        self.db = db
+
+    @staticmethod
+    def unpack(pattern):
+        return {
+            session: "Busy" if (pattern.busy_mask >> (session - 1)) & 1 else "Free"
+            for session in range(1, pattern.num_sessions + 1)
+        }
+
+    @staticmethod
+    def pack(sessions):
+        busy_mask = 0
+        for session, status in sessions.items():
+            if status == "Busy":
+                busy_mask |= 1 << (session - 1)
+        return busy_mask, max(sessions) if sessions else 0
+
+    def load(self, teacher_ids, days=None):
+        query = WeeklyPattern.query.filter(WeeklyPattern.teacher_id.in_(list(teacher_ids)))
+        if days is not None:
+            query = query.filter(WeeklyPattern.day.in_(list(days)))
+        grids = {}
+        for pattern in query:
+            grids.setdefault(pattern.teacher_id, {})[pattern.day] = self.unpack(pattern)
+        return grids
+
+    def status(self, teacher_id, day, session):
+        pattern = WeeklyPattern.query.filter_by(teacher_id=teacher_id, day=day).first()
+        if not pattern or session < 1 or session > pattern.num_sessions:
+            return None
+        return "Busy" if (pattern.busy_mask >> (session - 1)) & 1 else "Free"
+
+    def busy_counts(self, teacher_ids, days):
+        counts = {}
+        for pattern in WeeklyPattern.query.filter(
+            WeeklyPattern.teacher_id.in_(list(teacher_ids)),
+            WeeklyPattern.day.in_(list(days))
+        ):
+            mask, session = pattern.busy_mask, 1
+            while mask:
+                if mask & 1:
+                    counts[(pattern.day, session)] = counts.get((pattern.day, session), 0) + 1
+                mask >>= 1
+                session += 1
+        return counts
+
+    def save(self, teacher_id, grid):
+        return self.save_many({teacher_id: grid})
+
+    def save_many(self, grids):
+        # Upsert one row per (teacher, day) through bulk statements; days missing from a grid are dropped
+        if not grids:
+            return 0
+        schedule_touched(self.db.session, grids)
+        stored = {}
+        for pattern_id, teacher_id, day, num_sessions, busy_mask in self.db.session.query(
+            WeeklyPattern.id, WeeklyPattern.teacher_id, WeeklyPattern.day,
+            WeeklyPattern.num_sessions, WeeklyPattern.busy_mask
+        ).filter(WeeklyPattern.teacher_id.in_(list(grids))):
+            stored[(teacher_id, day)] = (pattern_id, num_sessions, busy_mask)
+
+        updates, inserts = [], []
+        for teacher_id, grid in grids.items():
+            for day, sessions in grid.items():
+                busy_mask, num_sessions = self.pack(sessions)
+                current = stored.pop((teacher_id, day), None)
+                if current is None:
+                    inserts.append({'teacher_id': teacher_id, 'day': day,
+                                    'num_sessions': num_sessions, 'busy_mask': busy_mask})
+                elif current[1:] != (num_sessions, busy_mask):
+                    updates.append({'id': current[0], 'num_sessions': num_sessions, 'busy_mask': busy_mask})
+        deletes = [pattern_id for pattern_id, _, _ in stored.values()]
+
+        if deletes:
+            self.db.session.execute(delete(WeeklyPattern).where(WeeklyPattern.id.in_(deletes)))
+        if updates:
+            self.db.session.execute(update(WeeklyPattern), updates)
+        if inserts:
+            self.db.session.execute(insert(WeeklyPattern), inserts)
+        return len(updates) + len(inserts) + len(deletes)
+
+    def delete(self, teacher_id):
+        schedule_touched(self.db.session, [teacher_id])
+        WeeklyPattern.query.filter_by(teacher_id=teacher_id).delete()
+
+    def department_day_query(self, department, day):
+        # The whole day travels as one row; the session column carries the busy bitmask
+        return (
+            select(WeeklyPattern.teacher_id, WeeklyPattern.busy_mask, literal('Busy'), literal('mask').label('kind'))
+            .join(User, WeeklyPattern.teacher_id == User.id)
+            .where(User.department == department, WeeklyPattern.day == day)
+        )
+
+
+def make_store(db, layout):
+    if layout == "rows":
+        return RowTimetableStore(db)
+    if layout == "packed":
+        return PackedTimetableStore(db)
+    raise ValueError(f"Unknown timetable storage layout: {layout}")
+
+
+def convert_layout(db, source, target):
+    # Copy every day-based schedule from one store to the other and clear the source
+    teacher_ids = [row[0] for row in db.session.query(User.id)]
+    grids = source.load(teacher_ids)
+    target.save_many(grids)
+    for teacher_id in grids:
+        source.delete(teacher_id)
+    db.session.commit()
+    return len(grids)